@@ -1,9 +1,29 @@
 # -*- coding: utf-8 -*-
 
-from aqimon.monitor import AqiMonitor
-from aqimon.storage import AqiStorage
-from aqimon.plot import AqiPlot
+import importlib
+
+# Public classes and their modules. Modules are imported on first access to
+# their classes, so importing the package (e.g. by twistd plugin discovery)
+# doesn't load NumPy, serial port support and Telegram bot modules.
+_LAZY_ATTRS = {
+    'AqiMonitor': 'aqimon.monitor',
+    'AqiStorage': 'aqimon.storage',
+    'AqiPlot': 'aqimon.plot',
+}
 
 __all__ = [
-    AqiMonitor, AqiStorage, AqiPlot
+    'AqiMonitor', 'AqiStorage', 'AqiPlot'
 ]
+
+
+def __getattr__(name):
+    module = _LAZY_ATTRS.get(name)
+    if module is None:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    value = getattr(importlib.import_module(module), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY_ATTRS))
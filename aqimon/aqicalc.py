@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+'''
+EPA AQI calculation for PM2.5 and PM10 concentrations.
+
+Results are identical to C{aqi.to_aqi()} of python-aqi package with EPA algorithm:
+concentrations are truncated to breakpoints precision (0.1 ug/m^3 for PM2.5 and 1 ug/m^3
+for PM10) by exact value of given float, like C{Decimal(float)} does, then AQI is linearly
+interpolated between breakpoints and rounded half to even.
+
+Since truncated concentrations take a small finite set of values, IAQI is calculated
+for all of them once, so AQI of any number of samples is a couple of table lookups.
+
+'''
+
+import bisect
+
+from decimal import Decimal
+
+import numpy as np
+
+# AQI breakpoints
+AQI_BREAKPOINTS = np.array([
+    (0, 50),
+    (51, 100),
+    (101, 150),
+    (151, 200),
+    (201, 300),
+    (301, 400),
+    (401, 500),
+])
+
+# PM2.5 breakpoints, in 0.1 ug/m^3
+PM25_BREAKPOINTS = np.array([
+    (0, 120),
+    (121, 354),
+    (355, 554),
+    (555, 1504),
+    (1505, 2504),
+    (2505, 3504),
+    (3505, 5004),
+])
+
+# PM10 breakpoints, in ug/m^3
+PM10_BREAKPOINTS = np.array([
+    (0, 54),
+    (55, 154),
+    (155, 254),
+    (255, 354),
+    (355, 424),
+    (425, 504),
+    (505, 604),
+])
+
+# Upper AQI values of levels: Good, Moderate, Unhealthy for Sensitive Groups,
+# Unhealthy, Very Unhealthy (and Hazardous above)
+AQI_LEVEL_BOUNDS = np.array([50, 100, 150, 200, 300])
+AQI_LEVEL_BOUNDS_LIST = AQI_LEVEL_BOUNDS.tolist()
+
+
+def _truncation_thresholds(n, scale):
+    '''
+    Get smallest floats truncated to each of C{n} values 0, 1/scale, 2/scale, ...
+    and the one truncated to the value next to them.
+    '''
+    thresholds = []
+    for k in range(n + 1):
+        # negative values above -1/scale are truncated to (negative) zero
+        exact = Decimal(k if k else -1) / scale
+        x = float(exact)
+        if k == 0 and Decimal(x) <= exact:
+            x = np.nextafter(x, np.inf)
+        elif k and Decimal(x) < exact:
+            x = np.nextafter(x, np.inf)
+        thresholds.append(float(x))
+    return np.array(thresholds)
+
+
+def _iaqi_table(breakpoints):
+    '''
+    Interpolate IAQI for every truncated concentration value within breakpoints.
+    '''
+    cc = np.arange(breakpoints[-1, 1] + 1)
+    i = np.searchsorted(breakpoints[:, 1], cc, side='left')
+    bp_lo, bp_hi = breakpoints[i, 0], breakpoints[i, 1]
+    aqi_lo, aqi_hi = AQI_BREAKPOINTS[i, 0], AQI_BREAKPOINTS[i, 1]
+    iaqi = (aqi_hi - aqi_lo) / (bp_hi - bp_lo) * (cc - bp_lo) + aqi_lo
+    return np.rint(iaqi).astype(np.int64)
+
+
+class _Pollutant(object):
+
+    def __init__(self, name, breakpoints, scale):
+        self.name = name
+        self.iaqi = _iaqi_table(breakpoints)
+        self.thresholds = _truncation_thresholds(len(self.iaqi), scale)
+        # plain lists are faster for scalars
+        self.iaqi_list = self.iaqi.tolist()
+        self.thresholds_list = self.thresholds.tolist()
+
+    def out_of_range(self, cc):
+        return ValueError('%s concentration out of AQI range: %r' % (self.name, cc))
+
+    def to_iaqi(self, cc):
+        if isinstance(cc, (float, int)) or np.ndim(cc) == 0:
+            i = bisect.bisect_right(self.thresholds_list, cc) - 1
+            if i < 0 or i >= len(self.iaqi_list):
+                raise self.out_of_range(cc)
+            return self.iaqi_list[i]
+        cc = np.asarray(cc, dtype=np.float64)
+        i = np.searchsorted(self.thresholds, cc, side='right') - 1
+        bad = (i < 0) | (i >= len(self.iaqi))
+        if bad.any():
+            raise self.out_of_range(cc[bad][0])
+        return self.iaqi[i]
+
+
+PM25 = _Pollutant('PM2.5', PM25_BREAKPOINTS, 10)
+PM10 = _Pollutant('PM10', PM10_BREAKPOINTS, 1)
+
+
+def to_aqi(pm_25, pm_10):
+    '''
+    Get AQI for PM2.5 and PM10 concentrations (in ug/m^3), given as scalars or arrays.
+
+    @return: integer AQI value, or int64 array of AQI values for array arguments.
+    @raise ValueError: if any concentration is out of AQI breakpoints range.
+    '''
+    iaqi_25, iaqi_10 = PM25.to_iaqi(pm_25), PM10.to_iaqi(pm_10)
+    if isinstance(iaqi_25, int) and isinstance(iaqi_10, int):
+        return max(iaqi_25, iaqi_10)
+    return np.maximum(iaqi_25, iaqi_10)
+
+
+def to_aqi_level(aqi):
+    '''
+    Get AQI level (0 for Good to 5 for Hazardous) for AQI value, given as scalar or array.
+    '''
+    if isinstance(aqi, (float, int)) or np.ndim(aqi) == 0:
+        return bisect.bisect_left(AQI_LEVEL_BOUNDS_LIST, aqi)
+    return np.searchsorted(AQI_LEVEL_BOUNDS, aqi, side='left')
+
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+import os
+import glob
+import gzip
+import datetime
+
+import numpy as np
+
+
+class PmArchive(object):
+    '''
+    Append-only archive of expired PM measurement data.
+
+    Data are stored in gzip-compressed monthly segment files of fixed-size binary
+    records. Every append adds a new gzip member to the end of the segment file,
+    so already written data are never rewritten. Already archived rows are skipped
+    by append, so appending the same rows again is harmless.
+
+    '''
+    record_dtype = np.dtype([('tstamp', '<i8'), ('pm25', '<f4'), ('pm10', '<f4')])
+
+    segment_pattern = 'pm_data-%04d-%02d.gz'
+
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+        # timestamp of the latest archived record, loaded lazily
+        self._last_tstamp = None
+
+    @staticmethod
+    def _month(tstamp):
+        dt = datetime.datetime.utcfromtimestamp(tstamp)
+        return dt.year, dt.month
+
+    def segment_path(self, year, month):
+        return os.path.join(self.archive_dir, self.segment_pattern % (year, month))
+
+    def segments(self):
+        '''
+        Get list of archive segment file paths, ordered by month.
+        '''
+        return sorted(glob.glob(os.path.join(self.archive_dir, 'pm_data-*.gz')))
+
+    def _read_segment(self, path):
+        with gzip.open(path, 'rb') as gz:
+            return np.frombuffer(gz.read(), dtype=self.record_dtype)
+
+    def last_tstamp(self):
+        '''
+        Get timestamp of the latest archived record, or -1 if archive is empty.
+        Blocks on file I/O, so should not be called from reactor thread.
+        '''
+        if self._last_tstamp is None:
+            last = -1
+            for path in reversed(self.segments()):
+                records = self._read_segment(path)
+                if len(records):
+                    last = int(records['tstamp'].max())
+                    break
+            self._last_tstamp = last
+        return self._last_tstamp
+
+    def append(self, rows):
+        '''
+        Append (tstamp, pm25, pm10) rows to archive segments, skipping rows with
+        already archived timestamps. Blocks on file I/O, so should not be called
+        from reactor thread.
+        '''
+        if not rows:
+            return
+        records = np.array([tuple(row) for row in rows], dtype=self.record_dtype)
+        last = self.last_tstamp()
+        old = records['tstamp'] <= last
+        if old.any():
+            # only rows not newer than the latest archived one may be already archived
+            archived = self.read(int(records['tstamp'][old].min()), last + 1)['tstamp']
+            records = records[~np.isin(records['tstamp'], archived)]
+            if not len(records):
+                return
+        if not os.path.isdir(self.archive_dir):
+            os.makedirs(self.archive_dir)
+        months = [self._month(tstamp) for tstamp in records['tstamp']]
+        try:
+            for month in sorted(set(months)):
+                mask = np.array([m == month for m in months])
+                with open(self.segment_path(*month), 'ab') as f:
+                    with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+                        gz.write(records[mask].tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+        except Exception:
+            # segments may be partially written, reload latest timestamp next time
+            self._last_tstamp = None
+            raise
+        self._last_tstamp = max(last, int(records['tstamp'].max()))
+
+    def read_segments(self, ts_start, ts_end):
+        '''
+        Read archived rows with timestamps in [ts_start, ts_end) segment by segment,
+        so only one segment is kept in memory at a time. Blocks on file I/O, so should
+        not be called from reactor thread.
+
+        @return: iterator over non-empty records arrays of segments, ordered by timestamp.
+        '''
+        first_path = self.segment_path(*self._month(max(ts_start, 0)))
+        for path in self.segments():
+            if path < first_path:
+                continue
+            records = self._read_segment(path)
+            if len(records) and records['tstamp'].min() >= ts_end:
+                break
+            records = records[(records['tstamp'] >= ts_start) & (records['tstamp'] < ts_end)]
+            if len(records):
+                # drop duplicates, possible in archives written before append skipped
+                # already archived rows
+                _, idx = np.unique(records['tstamp'], return_index=True)
+                yield records[idx]
+
+    def read(self, ts_start, ts_end):
+        '''
+        Read archived rows with timestamps in [ts_start, ts_end). Blocks on file I/O,
+        so should not be called from reactor thread.
+
+        @return: records array ordered by timestamp.
+        '''
+        parts = list(self.read_segments(ts_start, ts_end))
+        if not parts:
+            return np.empty(0, dtype=self.record_dtype)
+        return np.concatenate(parts)
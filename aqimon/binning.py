@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+
+import numpy as np
+
+# Aggregates of data series binned by timestamps, NaN for empty bins
+SeriesBins = namedtuple('SeriesBins', ['count', 'mean', 'min', 'max', 'sum'])
+
+
+def bin_series(ts, series, ts_bins):
+    '''
+    Aggregate data series sampled at timestamps C{ts} into bins with edges C{ts_bins}.
+
+    Samples are grouped into contiguous runs by bin once for all series (for ordered
+    timestamps, just by binary search of bin edges), then bin minimums and maximums
+    are computed with single vectorized reductions over these runs.
+
+    @return: list of L{SeriesBins}, one per series.
+    '''
+    n_bins = len(ts_bins) - 1
+    ts = np.asarray(ts)
+    series = [np.asarray(d) for d in series]
+    if len(ts) > 1 and (ts[1:] < ts[:-1]).any():
+        # stable sort by bin keeps samples order within bins
+        idx = np.digitize(ts, ts_bins)
+        order = np.argsort(idx, kind='stable')
+        series = [d[order] for d in series]
+        bounds = np.cumsum(np.bincount(idx, minlength=n_bins+2))[:n_bins+1]
+    else:
+        bounds = np.searchsorted(ts, ts_bins, side='left')
+    count = np.diff(bounds)
+    nonempty = np.flatnonzero(count)
+    starts, ends = bounds[:-1][nonempty], bounds[1:][nonempty]
+    result = []
+    for d in series:
+        mean, d_min, d_max, d_sum = (np.full(n_bins, np.nan) for _ in range(4))
+        if len(nonempty):
+            d_min[nonempty] = np.minimum.reduceat(d[:ends[-1]], starts)
+            d_max[nonempty] = np.maximum.reduceat(d[:ends[-1]], starts)
+            # sum every bin like np.mean() does (pairwise), so means are bit-identical
+            dtype = np.float64 if issubclass(d.dtype.type, (np.integer, np.bool_)) else None
+            sums = np.array([np.add.reduce(d[s:e], dtype=dtype) for s, e in zip(starts, ends)])
+            d_sum[nonempty] = sums
+            mean[nonempty] = sums / count[nonempty]
+        result.append(SeriesBins(count, mean, d_min, d_max, d_sum))
+    return result
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+
+'''
+Bulk import and export of PM measurement data.
+
+Usage::
+
+    python -m aqimon.datatool -c config.ini export pm_data.csv --start 2020-01-01
+    python -m aqimon.datatool -c config.ini import pm_data.npz
+
+Supported formats are CSV and NDJSON (C{tstamp}, C{pm25}, C{pm10} columns or keys)
+and NPZ (single C{pm_data} structured array of int64 C{tstamp}, float32 C{pm25} and
+C{pm10} fields). Format is detected by file extension, C{-} is stdin/stdout for text
+formats. Data are streamed in chunks, so memory usage doesn't depend on data size.
+
+'''
+
+import io
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import calendar
+import datetime
+import zipfile
+import configparser
+
+import numpy as np
+
+from twisted.internet import defer, task
+
+from db import DbSession
+from aqimon.archive import PmArchive
+from aqimon.storage import AqiStorage, PM_RECORD_DTYPE
+
+FORMATS = ('csv', 'ndjson', 'npz')
+
+DEFAULT_DB_FILENAME = 'db.sqlite'
+DEFAULT_DB_RETENTION_DAYS = 0
+DEFAULT_DB_ARCHIVE_DIR = 'archive'
+
+# Database connection PRAGMAs configurable in [db] section
+DB_PRAGMAS = ('synchronous', 'cache_size', 'mmap_size', 'temp_store')
+
+# Number of PM data records written to database in one transaction
+DEFAULT_IMPORT_CHUNK = 50000
+
+# Progress report interval (in seconds)
+REPORT_INTERVAL = 5
+
+NPZ_MEMBER = 'pm_data.npy'
+
+
+class Progress(object):
+    '''
+    Processed records counter, periodically reporting throughput to stderr.
+    '''
+    def __init__(self, action, out=sys.stderr):
+        self.action = action
+        self.out = out
+        self.records = 0
+        self.added = 0
+        self.started = self.reported = time.time()
+
+    def update(self, records, added=0):
+        self.records += records
+        self.added += added
+        now = time.time()
+        if now - self.reported >= REPORT_INTERVAL:
+            self.reported = now
+            self.report()
+
+    def report(self, done=False):
+        elapsed = max(time.time() - self.started, 1e-6)
+        msg = '%s %d record(s)' % (self.action, self.records)
+        if self.action == 'imported':
+            msg += ', %d added' % self.added
+        msg += ' in %.1f s (%d records/s)' % (elapsed, self.records / elapsed)
+        self.out.write(msg + ('\n' if done else '\r'))
+        self.out.flush()
+
+
+def parse_time(s):
+    '''
+    Parse UTC date/time (ISO 8601) or UNIX timestamp to UNIX timestamp.
+    '''
+    if s is None:
+        return None
+    try:
+        return int(s)
+    except ValueError:
+        pass
+    for fmt in ('%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return calendar.timegm(datetime.datetime.strptime(s, fmt).timetuple())
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('invalid date/time: %s' % s)
+
+
+def detect_format(path, fmt):
+    if fmt is not None:
+        return fmt
+    ext = os.path.splitext(path)[1].lstrip('.').lower()
+    if ext == 'jsonl':
+        ext = 'ndjson'
+    if ext not in FORMATS:
+        raise ValueError("Can't detect format of %s, use --format" % path)
+    return ext
+
+
+def open_text(path, mode):
+    if path == '-':
+        stream = sys.stdin if mode == 'r' else sys.stdout
+        return io.TextIOWrapper(stream.buffer, newline='', closefd=False)
+    return open(path, mode, newline='')
+
+
+# Readers yield lists of (tstamp, pm25, pm10) tuples
+
+def read_csv(path, chunk_size):
+    with open_text(path, 'r') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header != ['tstamp', 'pm25', 'pm10']:
+            raise ValueError('Unexpected CSV header: %r' % header)
+        chunk = []
+        for line, row in enumerate(reader, 2):
+            try:
+                tstamp, pm_25, pm_10 = row
+                chunk.append((int(tstamp), float(pm_25), float(pm_10)))
+            except ValueError:
+                raise ValueError('Invalid CSV row at line %d: %r' % (line, row))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def read_ndjson(path, chunk_size):
+    with open_text(path, 'r') as f:
+        chunk = []
+        for line, s in enumerate(f, 1):
+            if not s.strip():
+                continue
+            try:
+                d = json.loads(s)
+                chunk.append((int(d['tstamp']), float(d['pm25']), float(d['pm10'])))
+            except (ValueError, KeyError, TypeError):
+                raise ValueError('Invalid NDJSON record at line %d: %r' % (line, s))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def read_npz(path, chunk_size):
+    with zipfile.ZipFile(path) as z, z.open(NPZ_MEMBER) as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        if dtype != PM_RECORD_DTYPE or len(shape) != 1:
+            raise ValueError('Unexpected NPZ array: %s %r' % (dtype, shape))
+        remaining = shape[0]
+        while remaining:
+            n = min(remaining, chunk_size)
+            records = np.frombuffer(f.read(n * dtype.itemsize), dtype=dtype)
+            if len(records) != n:
+                raise ValueError('Truncated NPZ array in %s' % path)
+            remaining -= n
+            # restore exact sensor values (0.1 ug/m^3 resolution) from float32 records
+            yield list(zip(records['tstamp'].tolist(),
+                           np.round(records['pm25'].astype(np.float64), 1).tolist(),
+                           np.round(records['pm10'].astype(np.float64), 1).tolist()))
+
+
+# Writers are called in a database thread with number of records and iterator
+# over lists of (tstamp, pm25, pm10) tuples, see AqiStorage.export_pm_data()
+
+def write_csv(path, progress):
+    def exporter(count, chunks):
+        with open_text(path, 'w') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(('tstamp', 'pm25', 'pm10'))
+            for rows in chunks:
+                writer.writerows(rows)
+                progress.update(len(rows))
+    return exporter
+
+
+def write_ndjson(path, progress):
+    def exporter(count, chunks):
+        with open_text(path, 'w') as f:
+            for rows in chunks:
+                f.write(''.join('{"tstamp": %d, "pm25": %r, "pm10": %r}\n' % row
+                                for row in rows))
+                progress.update(len(rows))
+    return exporter
+
+
+def write_npz(path, progress):
+    def exporter(count, chunks):
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z, \
+                z.open(NPZ_MEMBER, 'w', force_zip64=True) as f:
+            # array size is known up front, so header is written before streamed data
+            np.lib.format.write_array_header_2_0(f, {
+                'descr': np.lib.format.dtype_to_descr(PM_RECORD_DTYPE),
+                'fortran_order': False,
+                'shape': (count,),
+            })
+            written = 0
+            for rows in chunks:
+                f.write(np.array(rows, dtype=PM_RECORD_DTYPE).tobytes())
+                written += len(rows)
+                progress.update(len(rows))
+            if written != count:
+                raise RuntimeError('Exported %d record(s), expected %d' % (written, count))
+    return exporter
+
+
+READERS = {'csv': read_csv, 'ndjson': read_ndjson, 'npz': read_npz}
+WRITERS = {'csv': write_csv, 'ndjson': write_ndjson, 'npz': write_npz}
+
+
+@defer.inlineCallbacks
+def import_pm_data(aqi_storage, chunks, ts_start=None, ts_end=None):
+    progress = Progress('imported')
+    writing = None
+    for rows in chunks:
+        n = len(rows)
+        if ts_start is not None or ts_end is not None:
+            rows = [row for row in rows
+                    if (ts_start is None or row[0] >= ts_start) and
+                    (ts_end is None or row[0] < ts_end)]
+        # parse next chunk while previous one is written
+        if writing is not None:
+            yield writing
+        writing = aqi_storage.import_pm_data(rows) \
+            .addCallback(lambda added, n=n: progress.update(n, added))
+    if writing is not None:
+        yield writing
+    progress.report(done=True)
+
+
+@defer.inlineCallbacks
+def export_pm_data(aqi_storage, writer, path, ts_start=None, ts_end=None):
+    progress = Progress('exported')
+    yield aqi_storage.export_pm_data(ts_start if ts_start is not None else 0,
+                                     ts_end if ts_end is not None else 2**63-1,
+                                     writer(path, progress))
+    progress.report(done=True)
+
+
+def open_storage(args):
+    '''
+    Open database and storage with the same [db] section settings as the bot uses:
+    connection PRAGMAs, and raw data retention with archive of expired data.
+    '''
+    cfg = configparser.ConfigParser()
+    if args.config is not None:
+        if not cfg.read(args.config):
+            raise ValueError("Can't read config file %s" % args.config)
+    db_filename = args.database or cfg.get('db', 'filename', fallback=DEFAULT_DB_FILENAME)
+    db_pragmas = {}
+    for pragma in DB_PRAGMAS:
+        if cfg.has_option('db', pragma):
+            db_pragmas[pragma] = cfg.get('db', pragma)
+    db_session = DbSession(db_filename, pragmas=db_pragmas)
+    db_retention_days = int(cfg.get('db', 'retention_days',
+                                    fallback=DEFAULT_DB_RETENTION_DAYS))
+    db_archive_dir = cfg.get('db', 'archive_dir',
+                             fallback=os.path.join(os.path.dirname(db_filename),
+                                                   DEFAULT_DB_ARCHIVE_DIR))
+    return AqiStorage(db_session, retention=db_retention_days*86400,
+                      archive=PmArchive(db_archive_dir))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='python -m aqimon.datatool',
+                                     description='Import or export PM measurement data.')
+    parser.add_argument('-c', '--config', help='bot configuration file')
+    parser.add_argument('-d', '--database', help='database file (overrides configuration)')
+    parser.add_argument('action', choices=('import', 'export'))
+    parser.add_argument('path', help='data file, "-" for stdin/stdout')
+    parser.add_argument('-f', '--format', choices=FORMATS,
+                        help='data file format (default: detected by extension)')
+    parser.add_argument('--start', type=parse_time,
+                        help='skip records before this UTC date/time or UNIX timestamp')
+    parser.add_argument('--end', type=parse_time,
+                        help='skip records at or after this UTC date/time or UNIX timestamp')
+    parser.add_argument('--chunk', type=int, default=DEFAULT_IMPORT_CHUNK,
+                        help='records per import transaction (default: %(default)s)')
+    args = parser.parse_args(argv)
+    try:
+        args.format = detect_format(args.path, args.format)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.format == 'npz' and args.path == '-':
+        parser.error('NPZ format needs a seekable file')
+    return args
+
+
+@defer.inlineCallbacks
+def run(reactor, args):
+    aqi_storage = open_storage(args)
+    db_session = aqi_storage.db_session
+    try:
+        yield aqi_storage.migrate()
+        if args.action == 'import':
+            chunks = READERS[args.format](args.path, args.chunk)
+            yield import_pm_data(aqi_storage, chunks, args.start, args.end)
+        else:
+            yield export_pm_data(aqi_storage, WRITERS[args.format], args.path,
+                                 args.start, args.end)
+    finally:
+        db_session.close()
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    task.react(run, (args,))
+
+
+if __name__ == '__main__':
+    main()
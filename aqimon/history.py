@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from aqimon.storage import PM_RECORD_DTYPE, PmColumns, bin_pm_records
+
+
+class PmHistory(object):
+    '''
+    Recent PM measurement data history.
+
+    Data are kept in a fixed-size ring buffer of records, so memory usage doesn't
+    depend on uptime. History covers given time if it was loaded from storage
+    up to that time and no records since then were evicted from buffer.
+
+    '''
+    def __init__(self, window, capacity):
+        self.window = window
+        self._records = np.zeros(capacity, dtype=PM_RECORD_DTYPE)
+        self._start = 0
+        self._size = 0
+        # nothing is covered until history is loaded
+        self._covered_from = float('inf')
+
+    @property
+    def capacity(self):
+        return len(self._records)
+
+    def __len__(self):
+        return self._size
+
+    def append(self, tstamp, pm_25, pm_10):
+        '''
+        Append PM measurement data to history, evicting the oldest record if full.
+        '''
+        capacity = self.capacity
+        if self._size == capacity:
+            self._covered_from = max(self._covered_from,
+                                     self._records['tstamp'][self._start] + 1)
+            self._start = (self._start + 1) % capacity
+            self._size -= 1
+        self._records[(self._start + self._size) % capacity] = (tstamp, pm_25, pm_10)
+        self._size += 1
+
+    def load(self, columns, ts_start):
+        '''
+        Load PM measurement data columns, covering time since C{ts_start}, into history.
+        Records already in history take precedence over loaded ones.
+        '''
+        records = self.records()
+        tstamp = columns.tstamp
+        if len(records):
+            tstamp = tstamp[tstamp < records['tstamp'][0]]
+        n = len(tstamp)
+        loaded = np.empty(n + len(records), dtype=PM_RECORD_DTYPE)
+        loaded['tstamp'][:n] = tstamp
+        loaded['pm25'][:n] = columns.pm_25[:n]
+        loaded['pm10'][:n] = columns.pm_10[:n]
+        loaded[n:] = records
+        # keep the newest records only
+        loaded = loaded[-self.capacity:]
+        self._records[:len(loaded)] = loaded
+        self._start = 0
+        self._size = len(loaded)
+        self._covered_from = ts_start
+        if n + len(records) > len(loaded):
+            self._covered_from = max(ts_start, loaded['tstamp'][0])
+
+    def records(self):
+        '''
+        Get history records array, ordered by timestamp.
+        '''
+        end = self._start + self._size
+        if end <= self.capacity:
+            return self._records[self._start:end].copy()
+        return np.concatenate((self._records[self._start:],
+                               self._records[:end - self.capacity]))
+
+    def latest(self):
+        '''
+        Get the newest (tstamp, pm25, pm10) record, or None if history is empty.
+        '''
+        if not self._size:
+            return None
+        return self._records[(self._start + self._size - 1) % self.capacity].tolist()
+
+    def covers(self, ts_start):
+        '''
+        Check history contains all PM measurement data since given timestamp.
+        '''
+        return ts_start >= self._covered_from
+
+    def period_pm_records(self, ts_start, ts_end):
+        records = self.records()
+        tstamp = records['tstamp']
+        return records[np.searchsorted(tstamp, ts_start):np.searchsorted(tstamp, ts_end)]
+
+    def period_pm_columns(self, ts_start, ts_end):
+        '''
+        Get PM measurement data with timestamps in [ts_start, ts_end) as columns.
+
+        @return: a L{PmColumns}, see L{AqiStorage.period_pm_columns}.
+        '''
+        records = self.period_pm_records(ts_start, ts_end)
+        return PmColumns(np.ascontiguousarray(records['tstamp']),
+                         np.ascontiguousarray(records['pm25']),
+                         np.ascontiguousarray(records['pm10']))
+
+    def binned_pm_data(self, ts_start, ts_end, n_bins, with_aqi=False):
+        '''
+        Get PM measurement data aggregated into bins.
+
+        @return: a L{PmBins}, see L{AqiStorage.binned_pm_data}.
+        '''
+        ts_start, ts_end = int(ts_start), int(ts_end)
+        records = self.period_pm_records(ts_start, ts_end)
+        return bin_pm_records(records, ts_start, ts_end, n_bins, with_aqi)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+from zope.interface import Interface, Attribute  # @UnresolvedImport
+
+
+class IAqiStorage(Interface):
+    '''
+    AQI-related data storage backend.
+
+    Storage is a service named C{aqi_storage}, stopping it must persist all
+    accepted PM measurement data.
+
+    '''
+    pending_count = Attribute('Number of accepted PM data records, not yet persisted.')
+
+    def when_ready():
+        '''
+        Wait for storage to become ready to use.
+
+        @return: a L{Deferred} which will fire when storage is ready.
+        '''
+
+    def add_pm_data(tstamp, pm_25, pm_10):
+        '''
+        Add PM measurement data. Records with already stored timestamps are ignored.
+        '''
+
+    def flush():
+        '''
+        Persist accepted PM measurement data.
+
+        @return: a L{Deferred} which will fire when data are persisted.
+        '''
+
+    def last_period_pm_data(period):
+        '''
+        Get last PM measurement data for given period (in seconds).
+
+        @return: a L{Deferred} which will fire a list of (tstamp, pm25, pm10) tuples
+            ordered by timestamp.
+        '''
+
+    def period_pm_columns(ts_start, ts_end):
+        '''
+        Get PM measurement data with timestamps in [ts_start, ts_end) as columns.
+
+        @return: a L{Deferred} which will fire a L{aqimon.storage.PmColumns}. Columns
+            may be views of storage records, not necessarily contiguous.
+        '''
+
+    def binned_pm_data(ts_start, ts_end, n_bins, with_aqi=False):
+        '''
+        Get PM measurement data with timestamps in [ts_start, ts_end), aggregated
+        into C{n_bins} bins of equal width.
+
+        @return: a L{Deferred} which will fire a L{aqimon.storage.PmBins}.
+        '''
+
+    def banded_pm_data(ts_start, ts_end, n_bins, quantiles=(0.1, 0.9)):
+        '''
+        Get means and quantile bands of PM measurement data and their AQI values with
+        timestamps in [ts_start, ts_end), aggregated into C{n_bins} bins of equal width
+        aligned to hours. Bands are estimated from mergeable quantile sketches, without
+        reading all samples.
+
+        @return: a L{Deferred} which will fire a L{aqimon.storage.PmBands}.
+        '''
@@ -11,12 +11,14 @@ from serial.serialutil import SerialException
 
 from telegram.bot import Bot as TelegramBot
 
-import aqi as aqi_calc
-
+from aqimon import aqicalc
 from aqimon.sensor import Sds011, SensorDisconnected
+from aqimon.history import PmHistory
 
 log = Logger()
 
+DEFAULT_HISTORY_WINDOW = 86400  # 1 day
+
 
 class AqiMonitor(service.Service):
     '''
@@ -27,7 +29,11 @@ class AqiMonitor(service.Service):
 
     sensor_reconnect_timeout = 5
 
-    def __init__(self, aqi_storage, sensor_device, sensor_baudrate, poll_period, debug=False):
+    # Extra history capacity, in fraction of expected number of records
+    history_reserve = 0.25
+
+    def __init__(self, aqi_storage, sensor_device, sensor_baudrate, poll_period,
+                 history_window=DEFAULT_HISTORY_WINDOW, debug=False):
         self.debug = debug
         self.sensor = None
         self.sensor_device = sensor_device
@@ -38,10 +44,42 @@ class AqiMonitor(service.Service):
         self.pm_10 = None
         self.aqi_storage = aqi_storage
         self.listeners = []
+        # poll period 0 means continuous sensor operation with 1 second period
+        n_records = history_window // max(poll_period * 60, 1)
+        self.history = PmHistory(history_window,
+                                 int(n_records * (1 + self.history_reserve)) + 1)
 
+    @defer.inlineCallbacks
     def startService(self):
         self._bot = self.parent.getServiceNamed(TelegramBot.name)
-        reactor.callLater(0, self.connect_sensor)  # @UndefinedVariable
+        # don't write any data until storage is ready
+        try:
+            yield self.aqi_storage.when_ready()
+        except Exception:
+            log.error("Storage is not available, sensor data won't be collected")
+            return
+        yield self.load_history()
+        self.connect_sensor()
+
+    @defer.inlineCallbacks
+    def load_history(self):
+        ts_end = time.time()
+        ts_start = ts_end - self.history.window
+        try:
+            columns = yield self.aqi_storage.period_pm_columns(ts_start, ts_end+1)
+        except Exception:
+            log.failure("Can't load PM data history")
+            return
+        self.history.load(columns, ts_start)
+        latest = self.history.latest()
+        if latest is not None and self.pm_timestamp is None:
+            # restore current values from the newest stored data
+            pm_timestamp, pm_25, pm_10 = latest
+            self.pm_timestamp = pm_timestamp
+            # restore sensor resolution lost in float32 history records
+            self.pm_25, self.pm_10 = round(pm_25, 1), round(pm_10, 1)
+        if self.debug:
+            log.debug("Loaded %d PM data record(s) to history" % len(self.history))
 
     def add_listener(self, listener):
         if listener not in self.listeners:
@@ -82,6 +120,7 @@ class AqiMonitor(service.Service):
         self.pm_10 = pm_10
         self.pm_timestamp = time.time()
         self.aqi_storage.add_pm_data(int(self.pm_timestamp), pm_25, pm_10)
+        self.history.append(int(self.pm_timestamp), pm_25, pm_10)
         for listener in self.listeners:
             try:
                 listener.pm_data_updated(pm_25, pm_10, self.aqi)
@@ -96,17 +135,9 @@ class AqiMonitor(service.Service):
 
     @staticmethod
     def to_aqi_level(aqi):
-        if aqi <= 50:
-            return 0  # Good
-        elif aqi <= 100:
-            return 1  # Moderate
-        elif aqi <= 150:
-            return 2  # Unhealthy for Sensitive Groups
-        elif aqi <= 200:
-            return 3  # Unhealthy
-        elif aqi <= 300:
-            return 4  # Very Unhealthy
-        return 5      # Hazardous
+        # 0 - Good, 1 - Moderate, 2 - Unhealthy for Sensitive Groups, 3 - Unhealthy,
+        # 4 - Very Unhealthy, 5 - Hazardous
+        return aqicalc.to_aqi_level(aqi)
 
     @property
     def aqi_level(self):
@@ -118,8 +149,7 @@ class AqiMonitor(service.Service):
     def aqi(self):
         if self.pm_timestamp is None:
             return None
-        return aqi_calc.to_aqi([(aqi_calc.POLLUTANT_PM25, self.pm_25),
-                                (aqi_calc.POLLUTANT_PM10, self.pm_10)])
+        return aqicalc.to_aqi(self.pm_25, self.pm_10)
 
     @property
     def pm(self):
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import io
+import datetime
+import collections
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.dates import DateFormatter, date2num
+from matplotlib.ticker import MaxNLocator
+
+import numpy as np
+
+# Max number of plot templates kept by renderer
+DEFAULT_MAX_TEMPLATES = 16
+
+
+class PlotTemplate(object):
+    '''
+    Reusable figure for plots of the same kind.
+
+    Figure, axes, formatters, locators, texts and bars are created once, only bars
+    positions, heights and colors are updated for every rendered plot. Figure is not
+    registered with pyplot, so it's freed with template.
+
+    Series bands, if any, are drawn as whiskers over bars.
+
+    '''
+    band_color = 'black'
+    band_alpha = 0.6
+
+    def __init__(self, n_bars, labels, colors, title, ylabel, banded=(), time_format='%H:%M'):
+        self.figure = Figure()
+        FigureCanvasAgg(self.figure)
+        ax = self.axes = self.figure.add_subplot()
+        ax.xaxis_date()
+        ax.xaxis.set_major_formatter(DateFormatter(time_format))
+        ax.yaxis.set_major_locator(MaxNLocator(integer=True))
+        self.bars = [ax.bar(np.zeros(n_bars), np.zeros(n_bars), color=color, label=label)
+                     for label, color in zip(labels, colors)]
+        self.bands = [ax.vlines([], [], [], colors=self.band_color, alpha=self.band_alpha)
+                      if b else None for b in banded]
+        ax.set_title(title)
+        ax.set_ylabel(ylabel)
+        if any(labels):
+            ax.legend(loc=2)
+        ax.grid(alpha=0.5)
+        self.figure.subplots_adjust(bottom=0.2)
+
+    @staticmethod
+    def key(spec):
+        # series colors are fixed by template (and its legend), per-bar ones are not
+        colors = tuple(c if isinstance(c, str) else None for c in spec.colors)
+        banded = tuple(b is not None for b in spec.bands) if spec.bands else ()
+        return (len(spec.ts_bins)-1, tuple(spec.labels), colors, spec.title, spec.ylabel,
+                banded, spec.time_format)
+
+    def render(self, spec):
+        n_days = (spec.ts_end-spec.ts_start)/86400
+        width = n_days*0.75/spec.n_ts_bins
+
+        t = date2num([datetime.datetime.fromtimestamp(ts_bin) for ts_bin in spec.ts_bins[1:]])
+
+        for bars, d, color in zip(self.bars, spec.data_bins, spec.colors):
+            per_bar_color = not isinstance(color, str)
+            for i, rect in enumerate(bars.patches):
+                rect.set_x(t[i] - width/2)
+                rect.set_width(width)
+                rect.set_height(d[i])
+                if per_bar_color:
+                    rect.set_facecolor(color[i])
+        ax = self.axes
+        ax.relim()
+        for k, (lines, band) in enumerate(zip(self.bands, spec.bands or ())):
+            if lines is None:
+                continue
+            # spread whiskers of series drawn over each other
+            x = t + (k - (len(self.bands)-1)/2.) * width/4
+            low, high = (np.asarray(b, dtype=np.float64) for b in band)
+            shown = np.isfinite(low) & np.isfinite(high)
+            lines.set_segments([[(xi, lo), (xi, hi)] for xi, lo, hi
+                                in zip(x[shown], low[shown], high[shown])])
+            # line collections are not accounted by relim()
+            if shown.any():
+                ax.update_datalim(np.column_stack((x[shown], high[shown])))
+        ax.autoscale_view()
+        for label in ax.get_xticklabels():
+            label.set_horizontalalignment('right')
+            label.set_rotation(30)
+
+        buf = io.BytesIO()
+        self.figure.savefig(buf, format='png')
+        return buf.getvalue()
+
+
+class PlotRenderer(object):
+    '''
+    Plot renderer, keeping templates of recently rendered plot kinds.
+    '''
+    def __init__(self, max_templates=DEFAULT_MAX_TEMPLATES):
+        self.max_templates = max_templates
+        self._templates = collections.OrderedDict()
+
+    def render(self, spec):
+        '''
+        Render plot to PNG image.
+
+        @return: PNG image bytes.
+        '''
+        key = PlotTemplate.key(spec)
+        template = self._templates.get(key)
+        if template is None:
+            template = PlotTemplate(key[0], spec.labels, spec.colors, spec.title, spec.ylabel,
+                                    key[5], spec.time_format)
+            self._templates[key] = template
+            if len(self._templates) > self.max_templates:
+                self._templates.popitem(last=False)
+        else:
+            self._templates.move_to_end(key)
+        return template.render(spec)
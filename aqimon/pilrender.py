@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+import io
+import math
+import datetime
+
+import numpy as np
+
+from PIL import Image, ImageDraw, ImageFont
+
+DEFAULT_FONT = 'DejaVuSans.ttf'
+
+# Plain text replacements of TeX markup used in plot texts
+TEX_REPLACEMENTS = (
+    ('$', ''),
+    ('\\mu ', u'µ'),
+    ('\\mu', u'µ'),
+    ('^3', u'³'),
+)
+
+
+def plain_text(s):
+    for tex, text in TEX_REPLACEMENTS:
+        s = s.replace(tex, text)
+    return s
+
+
+def nice_ticks(y_max, max_ticks=8):
+    '''
+    Get integer ticks from 0 covering C{y_max}, with 1, 2, 2.5 or 5 times power of 10 step.
+    '''
+    if not y_max > 0:
+        y_max = 1
+    raw_step = y_max / max_ticks
+    magnitude = 10 ** math.floor(math.log10(raw_step))
+    for m in (1, 2, 2.5, 5, 10):
+        step = max(m * magnitude, 1)
+        if step >= raw_step and step == int(step):
+            break
+    step = int(step)
+    n = int(math.ceil(y_max / step))
+    return [i * step for i in range(n + 1)]
+
+
+class PilPlotRenderer(object):
+    '''
+    Lightweight bar chart renderer, drawing plots with Pillow.
+
+    Draws the same plots as matplotlib renderer (title, y axis label, integer y ticks,
+    time ticks, grid, bars and legend) at a fraction of its import and render costs,
+    with simpler typography.
+
+    '''
+    width = 640
+    height = 480
+
+    # plot area margins: left, top, right, bottom
+    margins = (70, 40, 20, 40)
+
+    # max number of time axis labels
+    max_time_ticks = 8
+
+    # time ticks steps to choose from, in minutes
+    time_tick_steps = (1, 2, 5, 10, 15, 20, 30, 60, 120, 180, 240, 360, 720,
+                       1440, 2880, 4320, 10080)
+
+    grid_color = (216, 216, 216)
+    axes_color = (0, 0, 0)
+    text_color = (0, 0, 0)
+    band_color = (64, 64, 64)
+
+    def __init__(self, font=DEFAULT_FONT, font_size=12):
+        try:
+            self.font = ImageFont.truetype(font, font_size)
+            self.title_font = ImageFont.truetype(font, font_size + 2)
+        except IOError:
+            self.font = ImageFont.load_default(font_size)
+            self.title_font = ImageFont.load_default(font_size + 2)
+
+    def render(self, spec):
+        '''
+        Render plot to PNG image.
+
+        @return: PNG image bytes.
+        '''
+        image = Image.new('RGB', (self.width, self.height), 'white')
+        draw = ImageDraw.Draw(image)
+        left, top = self.margins[0], self.margins[1]
+        right, bottom = self.width - self.margins[2], self.height - self.margins[3]
+
+        # bars are centered at right edges of bins, like matplotlib plots
+        ts = np.asarray(spec.ts_bins[1:], dtype=np.float64)
+        bar_width = (spec.ts_end - spec.ts_start) * 0.75 / spec.n_ts_bins
+        x_min, x_max = ts[0] - bar_width, ts[-1] + bar_width
+
+        def x_pos(t):
+            return left + (t - x_min) / (x_max - x_min) * (right - left)
+
+        bands = [b for b in spec.bands or () if b is not None]
+        values = np.concatenate([np.asarray(d, dtype=np.float64) for d in spec.data_bins] +
+                                [np.asarray(b[1], dtype=np.float64) for b in bands])
+        y_ticks = nice_ticks(np.nanmax(values) if np.isfinite(values).any() else 0)
+        y_top = y_ticks[-1]
+
+        def y_pos(v):
+            return bottom - v / y_top * (bottom - top)
+
+        # grid and y ticks
+        for y_tick in y_ticks:
+            y = y_pos(y_tick)
+            draw.line([(left, y), (right, y)], fill=self.grid_color)
+            draw.line([(left - 4, y), (left, y)], fill=self.axes_color)
+            draw.text((left - 6, y), str(y_tick), font=self.font, fill=self.text_color,
+                      anchor='rm')
+
+        # time ticks
+        for t in self._time_ticks(x_min, x_max):
+            x = x_pos(t)
+            draw.line([(x, top), (x, bottom)], fill=self.grid_color)
+            draw.line([(x, bottom), (x, bottom + 4)], fill=self.axes_color)
+            label = datetime.datetime.fromtimestamp(t).strftime(spec.time_format)
+            draw.text((x, bottom + 6), label, font=self.font, fill=self.text_color,
+                      anchor='mt')
+
+        # bars, later series are drawn over earlier ones
+        half_width = bar_width / (x_max - x_min) * (right - left) / 2
+        for d, color in zip(spec.data_bins, spec.colors):
+            for i, v in enumerate(d):
+                if not np.isfinite(v) or v <= 0:
+                    continue
+                x = x_pos(ts[i])
+                c = color if isinstance(color, str) else color[i]
+                draw.rectangle([(x - half_width, y_pos(v)), (x + half_width, bottom)], fill=c)
+
+        # bands whiskers over bars, spread for series drawn over each other
+        n_bands = len(spec.bands or ())
+        for k, band in enumerate(spec.bands or ()):
+            if band is None:
+                continue
+            dx = (k - (n_bands - 1) / 2.) * half_width / 2
+            for i, (low, high) in enumerate(zip(*band)):
+                if not (np.isfinite(low) and np.isfinite(high)):
+                    continue
+                x = x_pos(ts[i]) + dx
+                draw.line([(x, y_pos(low)), (x, y_pos(high))], fill=self.band_color, width=2)
+
+        draw.rectangle([(left, top), (right, bottom)], outline=self.axes_color)
+
+        # texts
+        draw.text(((left + right) / 2, top / 2), plain_text(spec.title), font=self.title_font,
+                  fill=self.text_color, anchor='mm')
+        self._draw_ylabel(image, plain_text(spec.ylabel), 16, (top + bottom) / 2)
+        if any(spec.labels):
+            self._draw_legend(draw, spec, left + 8, top + 8)
+
+        buf = io.BytesIO()
+        image.save(buf, format='PNG')
+        return buf.getvalue()
+
+    def _time_ticks(self, ts_start, ts_end):
+        # ticks at round local time
+        for step in self.time_tick_steps:
+            step *= 60
+            if (ts_end - ts_start) / step <= self.max_time_ticks:
+                break
+        utc_offset = (datetime.datetime.fromtimestamp(ts_start) -
+                      datetime.datetime.utcfromtimestamp(ts_start)).total_seconds()
+        t = math.ceil((ts_start + utc_offset) / step) * step - utc_offset
+        while t <= ts_end:
+            yield t
+            t += step
+
+    def _draw_ylabel(self, image, text, x, y):
+        # draw text on separate image and rotate it to vertical
+        w, h = self.font.getbbox(text)[2:]
+        label = Image.new('RGB', (w + 2, h + 2), 'white')
+        ImageDraw.Draw(label).text((1, 1), text, font=self.font, fill=self.text_color)
+        label = label.rotate(90, expand=True)
+        image.paste(label, (int(x - label.width / 2), int(y - label.height / 2)))
+
+    def _draw_legend(self, draw, spec, x, y):
+        entries = [(label, color) for label, color in zip(spec.labels, spec.colors)
+                   if label and isinstance(color, str)]
+        if not entries:
+            return
+        line_height = self.font.size + 6
+        width = max(self.font.getlength(label) for label, _ in entries) + 36
+        draw.rectangle([(x, y), (x + width, y + line_height * len(entries) + 6)],
+                       fill='white', outline=self.grid_color)
+        for i, (label, color) in enumerate(entries):
+            ly = y + 4 + i * line_height
+            draw.rectangle([(x + 6, ly + 2), (x + 24, ly + line_height - 4)], fill=color)
+            draw.text((x + 30, ly + line_height / 2 - 1), label, font=self.font,
+                      fill=self.text_color, anchor='lm')
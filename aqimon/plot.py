@@ -1,24 +1,15 @@
 # -*- coding: utf-8 -*-
 
-import io
 import time
-import datetime
-
-import matplotlib
-matplotlib.use("Agg")  # use headless plotting
-
-import matplotlib.pyplot as plt
-from matplotlib.dates import DateFormatter
-from matplotlib.ticker import MaxNLocator
 
 import numpy as np
 
-import aqi
-
 from datetime import timedelta
 
 from twisted.internet import defer
 from aqimon.monitor import AqiMonitor
+from aqimon.plotcache import SingleFlight, plot_image
+from aqimon.render import PlotSpec, render_plot, DEFAULT_BACKEND
 
 
 class AqiPlot(object):
@@ -28,121 +19,206 @@ class AqiPlot(object):
     '''
     aqi_colors = ('green', 'gold', 'orange', 'red', 'purple', 'maroon')
 
-    def __init__(self, l10n_support, aqi_storage):
+    def __init__(self, l10n_support, aqi_storage, pm_history=None, plot_cache=None,
+                 render_pool=None, render_backend=DEFAULT_BACKEND):
         self.l10n_support = l10n_support
         self.aqi_storage = aqi_storage
-
-    def plot_data(self, ts, data, ts_start, ts_end, n_ts_bins, colors, labels, title, ylabel):
-        ts_bins = np.linspace(ts_start, ts_end, n_ts_bins)
-
-        d_bins = np.digitize(ts, ts_bins)
-
-        data_bins = []
-        for d in data:
-            b = []
-            d = np.array(d)
-            for i in range(1, len(ts_bins)):
-                d_bin_i = d[d_bins == i]
-                if len(d_bin_i) > 0:
-                    b.append(np.mean(d_bin_i))
-                else:
-                    b.append(float('nan'))
-            data_bins.append(b)
-
-        n_days = (ts_end-ts_start)/86400
-        width = n_days*0.75/n_ts_bins
-
-        t = [datetime.datetime.fromtimestamp(ts_bin) for ts_bin in ts_bins[1:]]
-
-        plt.figure()
-        for i, d in enumerate(data_bins):
-            color = colors[i]
-            if callable(color):
-                color = [color(v) for v in np.nan_to_num(d)]
-            plt.bar(t, d, width=width, color=color, label=labels[i])
-        plt.title(title)
-        plt.ylabel(ylabel)
-        plt.gca().xaxis_date()
-        plt.gca().xaxis.set_major_formatter(DateFormatter('%H:%M'))
-        plt.gca().yaxis.set_major_locator(MaxNLocator(integer=True))
-        plt.gcf().autofmt_xdate()
-        if any(labels):
-            plt.legend(loc=2)
-        plt.grid(alpha=0.5)
-
-        buf = io.BytesIO()
-        buf.name = "plot.png"
-        plt.savefig(buf, format='png')
-        buf.seek(0)
-
-        return buf
-
-    def plot_pm_data(self, pm_data, ts_start, ts_end, ts_n_bins, title):
-        pm_ts, pm_25, pm_10 = np.transpose(pm_data)
-        return self.plot_data(pm_ts, (pm_10, pm_25), ts_start, ts_end, ts_n_bins,
-                              ('steelblue', 'firebrick'), ('PM10', 'PM2.5'),
-                              title, '$\mu g/m^3$')
+        self.pm_history = pm_history
+        self.plot_cache = plot_cache
+        self.render_pool = render_pool
+        self.render_backend = render_backend
+        # incremented on every PM data update
+        self.data_version = 0
+        # plots being rendered, if there is no plot cache (which coalesces renders itself)
+        self.renders = SingleFlight()
+
+    def pm_data_updated(self, pm_25, pm_10, aqi):
+        # AqiMonitor listener: cached plots don't show new data
+        self.data_version += 1
+        if self.plot_cache is not None:
+            self.plot_cache.invalidate()
+
+    def cached_plot(self, kind, period, n_bins, title, render):
+        '''
+        Get plot from cache, or render it by C{render(period, n_bins, title)}.
+        Concurrent requests for the same plot share a single rendering.
+
+        Plots are keyed by data version and current bin, so plot is re-rendered
+        at least once per bin width even without new data.
+        '''
+        key = (kind, period, n_bins, self.l10n_support.locale, self.data_version,
+               int(time.time() // (period / (n_bins-1))))
+        if self.plot_cache is not None:
+            return self.plot_cache.get(key, lambda: render(period, n_bins, title))
+
+        def rendered():
+            # share image data, every requester gets its own file-like object
+            return defer.maybeDeferred(render, period, n_bins, title) \
+                .addCallback(lambda img: img.getvalue() if img is not None else None)
+
+        return self.renders.call(key, rendered).addCallback(plot_image)
+
+    def binned_pm_data(self, ts_start, ts_end, n_bins, with_aqi=False):
+        '''
+        Get binned PM data from recent data history, if it covers given period,
+        or from storage otherwise.
+        '''
+        if self.pm_history is not None and self.pm_history.covers(ts_start):
+            return defer.succeed(self.pm_history.binned_pm_data(ts_start, ts_end, n_bins,
+                                                                with_aqi=with_aqi))
+        return self.aqi_storage.binned_pm_data(ts_start, ts_end, n_bins, with_aqi=with_aqi)
+
+    def plot_bins(self, ts_bins, data_bins, ts_start, ts_end, n_ts_bins,
+                  colors, labels, title, ylabel, bands=None, time_format='%H:%M'):
+        # resolve bin colors here, plot spec must be picklable
+        colors = [color(np.nan_to_num(d)) if callable(color) else color
+                  for color, d in zip(colors, data_bins)]
+        if bands is not None:
+            bands = [(np.asarray(low), np.asarray(high)) for low, high in bands]
+        spec = PlotSpec(np.asarray(ts_bins), [np.asarray(d) for d in data_bins], ts_start,
+                        ts_end, n_ts_bins, colors, labels, title, ylabel, bands, time_format)
+        return self.render(spec)
+
+    def render(self, spec):
+        '''
+        Render plot in render pool, if any, or in place otherwise.
+
+        @return: a L{Deferred} which will fire a file-like object with PNG image.
+        '''
+        if self.render_pool is not None:
+            d = self.render_pool.render(spec)
+        else:
+            d = defer.maybeDeferred(render_plot, spec, self.render_backend)
+
+        return d.addCallback(plot_image)
 
     @defer.inlineCallbacks
     def plot_period_pm_data(self, period, n_bins, title):
-        pm_data = yield self.aqi_storage.last_period_pm_data(period)
+        t_start, t_end = self.aligned_period(period, n_bins)
 
-        if not pm_data:
-            defer.returnValue(None)
+        pm_bins = yield self.binned_pm_data(t_start, t_end, n_bins-1)
 
-        t_end = time.time()
-        t_start = t_end-period
+        if not pm_bins.count.any():
+            defer.returnValue(None)
 
-        plot = self.plot_pm_data(pm_data, t_start, t_end, n_bins, title)
+        ts_bins = np.linspace(t_start, t_end, n_bins)
+        plot = yield self.plot_bins(ts_bins, (pm_bins.pm_10, pm_bins.pm_25), t_start, t_end,
+                                    n_bins, ('steelblue', 'firebrick'), ('PM10', 'PM2.5'),
+                                    title, '$\mu g/m^3$')
 
         defer.returnValue(plot)
 
-    @defer.inlineCallbacks
     def plot_hourly_pm_data(self):
         period = timedelta(hours=1).total_seconds()
-        plot = yield self.plot_period_pm_data(period, 20, _(u'Hourly PM concentrations'))
-        defer.returnValue(plot)
+        # bins of 3 minutes, aligned to minute rollups
+        return self.cached_plot('pm', period, 21, _(u'Hourly PM concentrations'),
+                                self.plot_period_pm_data)
 
-    @defer.inlineCallbacks
     def plot_daily_pm_data(self):
-        period = timedelta(days=1).total_seconds()
-        plot = yield self.plot_period_pm_data(period, 48, _(u'Daily PM concentrations'))
+        # 47 bins of half an hour, aligned to minute rollups
+        period = timedelta(minutes=47*30).total_seconds()
+        return self.cached_plot('pm', period, 48, _(u'Daily PM concentrations'),
+                                self.plot_period_pm_data)
+
+    @staticmethod
+    def aligned_period(period, n_bins):
+        '''
+        Get start and end of the last period, split into C{n_bins}-1 bins aligned
+        to bin width, with the current bin being the last one.
+        '''
+        bin_width = period / (n_bins-1)
+        t_end = (time.time() // bin_width + 1) * bin_width
+        return t_end-period, t_end
+
+    @defer.inlineCallbacks
+    def plot_period_pm_bands(self, period, n_bins, title):
+        t_start, t_end = self.aligned_period(period, n_bins)
+
+        pm_bands = yield self.aqi_storage.banded_pm_data(t_start, t_end, n_bins-1)
+
+        if not pm_bands.count.any():
+            defer.returnValue(None)
+
+        # center bars in bins
+        ts_bins = np.linspace(t_start, t_end, n_bins) - period/(n_bins-1)/2
+        plot = yield self.plot_bins(ts_bins, (pm_bands.pm_10, pm_bands.pm_25), t_start, t_end,
+                                    n_bins, ('steelblue', 'firebrick'), ('PM10', 'PM2.5'),
+                                    title, '$\mu g/m^3$',
+                                    bands=((pm_bands.pm_10_low, pm_bands.pm_10_high),
+                                           (pm_bands.pm_25_low, pm_bands.pm_25_high)),
+                                    time_format=_(u'%m/%d'))
+
         defer.returnValue(plot)
 
-    def plot_aqi_data(self, aqi_data, ts, ts_start, ts_end, ts_n_bins, title):
-        def aqi_color_fn(a):
+    def plot_weekly_pm_data(self):
+        period = timedelta(weeks=1).total_seconds()
+        return self.cached_plot('pm_bands', period, 29, _(u'Weekly PM concentrations'),
+                                self.plot_period_pm_bands)
+
+    def plot_monthly_pm_data(self):
+        period = timedelta(days=30).total_seconds()
+        return self.cached_plot('pm_bands', period, 31, _(u'Monthly PM concentrations'),
+                                self.plot_period_pm_bands)
+
+    def aqi_color(self, a):
+        '''
+        Get AQI level color for AQI value, or list of colors for array of AQI values.
+        '''
+        if np.ndim(a) == 0:
             return self.aqi_colors[AqiMonitor.to_aqi_level(a)]
-
-        return self.plot_data(ts, (aqi_data,), ts_start, ts_end, ts_n_bins,
-                              (aqi_color_fn,), (None,), title, 'AQI')
+        return [self.aqi_colors[level] for level in AqiMonitor.to_aqi_level(a)]
 
     @defer.inlineCallbacks
     def plot_period_aqi_data(self, period, n_bins, title):
-        pm_data = yield self.aqi_storage.last_period_pm_data(period)
+        t_start, t_end = self.aligned_period(period, n_bins)
 
-        if not pm_data:
-            defer.returnValue(None)
-
-        t_end = time.time()
-        t_start = t_end-period
+        pm_bins = yield self.binned_pm_data(t_start, t_end, n_bins-1, with_aqi=True)
 
-        t, pm_25, pm_10 = np.transpose(pm_data)
-
-        aqi_data = [int(aqi.to_aqi([(aqi.POLLUTANT_PM25, pm[0]), (aqi.POLLUTANT_PM10, pm[1])]))
-                    for pm in zip(pm_25, pm_10)]
+        if not pm_bins.count.any():
+            defer.returnValue(None)
 
-        plot = self.plot_aqi_data(aqi_data, t, t_start, t_end, n_bins, title)
+        ts_bins = np.linspace(t_start, t_end, n_bins)
+        plot = yield self.plot_bins(ts_bins, (pm_bins.aqi,), t_start, t_end, n_bins,
+                                    (self.aqi_color,), (None,), title, 'AQI')
 
         defer.returnValue(plot)
 
-    @defer.inlineCallbacks
     def plot_hourly_aqi_data(self):
         period = timedelta(hours=1).total_seconds()
-        plot = yield self.plot_period_aqi_data(period, 20, _(u'Hourly AQI values'))
-        defer.returnValue(plot)
+        # bins of 3 minutes, AQI values are aggregated from raw data
+        return self.cached_plot('aqi', period, 21, _(u'Hourly AQI values'),
+                                self.plot_period_aqi_data)
 
-    @defer.inlineCallbacks
     def plot_daily_aqi_data(self):
-        period = timedelta(days=1).total_seconds()
-        plot = yield self.plot_period_aqi_data(period, 48, _(u'Daily AQI values'))
+        # 47 bins of half an hour, AQI values are aggregated from raw data
+        period = timedelta(minutes=47*30).total_seconds()
+        return self.cached_plot('aqi', period, 48, _(u'Daily AQI values'),
+                                self.plot_period_aqi_data)
+
+    @defer.inlineCallbacks
+    def plot_period_aqi_bands(self, period, n_bins, title):
+        t_start, t_end = self.aligned_period(period, n_bins)
+
+        pm_bands = yield self.aqi_storage.banded_pm_data(t_start, t_end, n_bins-1)
+
+        if not pm_bands.count.any():
+            defer.returnValue(None)
+
+        # center bars in bins
+        ts_bins = np.linspace(t_start, t_end, n_bins) - period/(n_bins-1)/2
+        plot = yield self.plot_bins(ts_bins, (pm_bands.aqi,), t_start, t_end, n_bins,
+                                    (self.aqi_color,), (None,), title, 'AQI',
+                                    bands=((pm_bands.aqi_low, pm_bands.aqi_high),),
+                                    time_format=_(u'%m/%d'))
+
         defer.returnValue(plot)
+
+    def plot_weekly_aqi_data(self):
+        period = timedelta(weeks=1).total_seconds()
+        return self.cached_plot('aqi_bands', period, 29, _(u'Weekly AQI values'),
+                                self.plot_period_aqi_bands)
+
+    def plot_monthly_aqi_data(self):
+        period = timedelta(days=30).total_seconds()
+        return self.cached_plot('aqi_bands', period, 31, _(u'Monthly AQI values'),
+                                self.plot_period_aqi_bands)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+import io
+
+from collections import OrderedDict
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024  # 4 MiB
+
+
+def plot_image(data):
+    '''
+    Wrap PNG image data into a file-like object, or return C{None} if there is no image.
+    '''
+    if data is None:
+        return None
+    buf = io.BytesIO(data)
+    buf.name = "plot.png"
+    return buf
+
+
+class SingleFlight(object):
+    '''
+    Table of in-flight calls by key, e.g. by plot kind and data version.
+
+    Concurrent calls with the same key are attached to the call already running
+    and share its result, instead of starting new ones. Attached calls are counted
+    as coalesced.
+
+    '''
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._waiters = {}
+
+    def __len__(self):
+        return len(self._waiters)
+
+    def __contains__(self, key):
+        return key in self._waiters
+
+    @property
+    def stats(self):
+        return {'calls': self.calls, 'coalesced': self.coalesced,
+                'in_flight': len(self._waiters)}
+
+    def call(self, key, f, *args, **kwargs):
+        '''
+        Call C{f(*args, **kwargs)}, unless a call with the same key is in flight.
+
+        @return: a L{Deferred} which will fire with result of the call.
+        '''
+        d = defer.Deferred()
+        waiters = self._waiters.get(key)
+        if waiters is not None:
+            self.coalesced += 1
+            waiters.append(d)
+            return d
+        self.calls += 1
+        self._waiters[key] = [d]
+        defer.maybeDeferred(f, *args, **kwargs).addBoth(self._done, key)
+        return d
+
+    def _done(self, result, key):
+        waiters = self._waiters.pop(key)
+        for d in waiters:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+
+class PlotCache(object):
+    '''
+    LRU cache of rendered plot images, bounded by total size of images.
+
+    Concurrent requests for the same missing plot share a single rendering
+    (see L{SingleFlight}).
+    Cache is cleared by L{invalidate}, e.g. when new sensor data arrive.
+
+    '''
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._plots = OrderedDict()
+        self._rendering = SingleFlight()
+        self._generation = 0
+
+    def __len__(self):
+        return len(self._plots)
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'coalesced': self._rendering.coalesced, 'evictions': self.evictions,
+                'plots': len(self._plots), 'size': self.size}
+
+    def get(self, key, render):
+        '''
+        Get plot image for given key, rendering it by C{render()} if not cached.
+        C{render} should return a file-like object with image (or a L{Deferred}
+        firing it) or C{None} if there are no data to plot.
+
+        @return: a L{Deferred} which will fire a new file-like object with plot image
+            or C{None}.
+        '''
+        data = self._plots.get(key)
+        if data is not None:
+            self._plots.move_to_end(key)
+            self.hits += 1
+            return defer.succeed(plot_image(data))
+        if key not in self._rendering:
+            self.misses += 1
+        return self._rendering.call(key, self._render, key, render, self._generation) \
+            .addCallback(plot_image)
+
+    def _render(self, key, render, generation):
+        def rendered(result):
+            data = result.getvalue() if result is not None else None
+            # don't keep plot of data invalidated while rendering
+            if data is not None and generation == self._generation:
+                self._put(key, data)
+            return data
+
+        return defer.maybeDeferred(render).addCallback(rendered)
+
+    def _put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        self._plots[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self._plots.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def invalidate(self):
+        '''
+        Drop all cached plots.
+        '''
+        self._plots.clear()
+        self.size = 0
+        self._generation += 1
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import multiprocessing
+
+from twisted.application import service
+from twisted.internet import defer, threads
+from twisted.logger import Logger
+
+log = Logger()
+
+DEFAULT_PROCESSES = 2
+DEFAULT_QUEUE_SIZE = 16
+DEFAULT_TIMEOUT = 30
+DEFAULT_MAX_TASKS = 100
+
+# Plot renderer backends: high-fidelity matplotlib or lightweight Pillow one
+BACKENDS = ('matplotlib', 'pillow')
+DEFAULT_BACKEND = 'matplotlib'
+
+# Picklable plot description: bins edges timestamps, per-series bin values, colors
+# (color name or list of names per bin) and labels, plot period and text, optional
+# per-series (low, high) bands of bin values and time axis labels format
+PlotSpec = collections.namedtuple('PlotSpec', ['ts_bins', 'data_bins', 'ts_start', 'ts_end',
+                                               'n_ts_bins', 'colors', 'labels', 'title',
+                                               'ylabel', 'bands', 'time_format'],
+                                  defaults=[None, '%H:%M'])
+
+
+class RenderError(Exception):
+    pass
+
+
+class RenderTimeout(RenderError):
+    pass
+
+
+class RenderQueueFull(RenderError):
+    pass
+
+
+def make_renderer(backend):
+    '''
+    Create plot renderer of given backend. Backend modules are imported on demand,
+    so unused plotting library is never loaded.
+    '''
+    if backend == 'matplotlib':
+        from aqimon.mplrender import PlotRenderer
+        return PlotRenderer()
+    elif backend == 'pillow':
+        from aqimon.pilrender import PilPlotRenderer
+        return PilPlotRenderer()
+    raise ValueError('Unknown plot renderer backend: %s' % backend)
+
+
+_renderers = {}
+
+
+def get_renderer(backend=DEFAULT_BACKEND):
+    '''
+    Get this process renderer of given backend, creating it on first call.
+    '''
+    renderer = _renderers.get(backend)
+    if renderer is None:
+        renderer = _renderers[backend] = make_renderer(backend)
+    return renderer
+
+
+def render_plot(spec, backend=DEFAULT_BACKEND):
+    '''
+    Render plot to PNG image with this process renderer of given backend.
+
+    @return: PNG image bytes.
+    '''
+    return get_renderer(backend).render(spec)
+
+
+def warm_up(backend=DEFAULT_BACKEND):
+    '''
+    Import plotting library and create this process renderer in background thread,
+    so the first plot is not delayed by them.
+
+    @return: a L{Deferred} which will fire when renderer is created.
+    '''
+    d = threads.deferToThread(get_renderer, backend)
+    d.addErrback(lambda f: log.failure("Can't create plot renderer", f))
+    return d
+
+
+def _worker_main(conn, backend):
+    # load plotting library while waiting for the first plot
+    get_renderer(backend)
+    # render plots until asked to stop or parent is gone
+    while True:
+        try:
+            spec = conn.recv()
+        except EOFError:
+            break
+        if spec is None:
+            break
+        try:
+            result = ('ok', render_plot(spec, backend))
+        except Exception as e:
+            result = ('error', '%s: %s' % (type(e).__name__, e))
+        conn.send(result)
+
+
+class _Worker(object):
+
+    def __init__(self, context, backend):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, backend),
+                                       daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.tasks = 0
+
+    def render(self, spec, timeout):
+        # blocks, so should not be called from reactor thread
+        self.conn.send(spec)
+        if not self.conn.poll(timeout):
+            raise RenderTimeout('Plot was not rendered in %s seconds' % timeout)
+        status, result = self.conn.recv()
+        if status != 'ok':
+            raise RenderError(result)
+        return result
+
+    def stop(self):
+        # blocks, so should not be called from reactor thread
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.conn.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+
+class RenderPool(service.Service):
+    '''
+    Pool of plot rendering worker processes.
+
+    Plots are rendered out of reactor thread and process, since pyplot is not
+    thread-safe. Requests exceeding number of workers are queued, up to C{queue_size}
+    requests. Worker is replaced after C{max_tasks} renders (to free memory held by
+    plotting library), or when it doesn't render plot in C{timeout} seconds or dies.
+
+    '''
+    name = 'render_pool'
+
+    def __init__(self, processes=DEFAULT_PROCESSES, queue_size=DEFAULT_QUEUE_SIZE,
+                 timeout=DEFAULT_TIMEOUT, max_tasks=DEFAULT_MAX_TASKS,
+                 backend=DEFAULT_BACKEND):
+        if backend not in BACKENDS:
+            raise ValueError('Unknown plot renderer backend: %s' % backend)
+        self.processes = processes
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.max_tasks = max_tasks
+        self.backend = backend
+        # don't fork reactor process with its threads and descriptors
+        self._context = multiprocessing.get_context('spawn')
+        self._idle = []
+        self._queue = collections.deque()
+
+    def startService(self):
+        service.Service.startService(self)
+        # plots requested before workers are started are queued
+        for _ in range(self.processes):
+            self._start_worker()
+
+    def stopService(self):
+        service.Service.stopService(self)
+        while self._queue:
+            _, d = self._queue.popleft()
+            d.errback(RenderError('Render pool stopped'))
+        workers, self._idle = self._idle, []
+        return defer.DeferredList([threads.deferToThread(w.stop) for w in workers])
+
+    @property
+    def queued(self):
+        return len(self._queue)
+
+    def render(self, spec):
+        '''
+        Render plot in worker process.
+
+        @return: a L{Deferred} which will fire with PNG image bytes.
+        '''
+        if not self.running:
+            return defer.fail(RenderError('Render pool is not running'))
+        d = defer.Deferred()
+        if self._idle:
+            self._dispatch(self._idle.pop(), spec, d)
+        elif len(self._queue) >= self.queue_size:
+            return defer.fail(RenderQueueFull('Too many plots queued for rendering'))
+        else:
+            self._queue.append((spec, d))
+        return d
+
+    def _dispatch(self, worker, spec, d):
+        worker.tasks += 1
+        threads.deferToThread(worker.render, spec, self.timeout) \
+            .addBoth(self._rendered, worker, d)
+
+    def _rendered(self, result, worker, d):
+        # worker state is unknown after timeout or I/O error, replace it
+        if isinstance(result, bytes):
+            failed = False
+        else:
+            failed = result.check(RenderTimeout) or not result.check(RenderError)
+        if failed or worker.tasks >= self.max_tasks or not self.running:
+            if failed:
+                log.warn("Replacing plot render worker: {error}", error=result.value)
+            threads.deferToThread(worker.stop)
+            if self.running:
+                self._start_worker()
+        else:
+            self._worker_started(worker)
+        if isinstance(result, bytes):
+            d.callback(result)
+        else:
+            d.errback(result)
+
+    def _start_worker(self):
+        # starting process takes a while, don't block reactor
+        threads.deferToThread(_Worker, self._context, self.backend) \
+            .addCallbacks(self._worker_started, self._worker_start_failed)
+
+    def _worker_started(self, worker):
+        if not self.running:
+            threads.deferToThread(worker.stop)
+        elif self._queue:
+            self._dispatch(worker, *self._queue.popleft())
+        else:
+            self._idle.append(worker)
+
+    def _worker_start_failed(self, f):
+        log.failure("Can't start plot render worker", f)
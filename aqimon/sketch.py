@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+'''
+Mergeable quantile sketches of PM concentrations and AQI values.
+
+Sketch is a histogram of values over fixed logarithmic bins (like DDSketch), so any
+quantile is estimated within C{RELATIVE_ACCURACY} of the actual value. Sketch of any
+number of samples has the same bounded size, and sketches of adjacent periods are
+merged just by adding their counts.
+
+Sketches are serialized sparsely, as indices and counts of non-empty bins. Stored
+sketches depend on bins layout, so it must not be changed.
+
+'''
+
+import math
+
+import numpy as np
+
+RELATIVE_ACCURACY = 0.025
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+
+# Smallest distinguished non-zero value (sensor resolution) and the largest one
+MIN_VALUE = 0.1
+MAX_VALUE = 1000.
+
+# Bin 0 holds values below MIN_VALUE, bin i holds values in [EDGES[i-1], EDGES[i]),
+# the last bin also holds all values above MAX_VALUE
+N_BINS = 2 + int(math.ceil(math.log(MAX_VALUE / MIN_VALUE) / math.log(GAMMA)))
+EDGES = MIN_VALUE * GAMMA ** np.arange(N_BINS - 1)
+
+# Bins values with the least relative error
+VALUES = np.concatenate(([0.], EDGES[:-1] * 2 * GAMMA / (GAMMA + 1), EDGES[-1:]))
+
+_INDEX_DTYPE = np.dtype('<u2')
+_COUNT_DTYPE = np.dtype('<u4')
+
+
+def histograms(groups, values, n_groups):
+    '''
+    Build sketches of values by group.
+
+    @param groups: group index (0 to C{n_groups}-1) of every value.
+    @return: int64 array of shape (C{n_groups}, L{N_BINS}) of sketches counts.
+    '''
+    idx = np.asarray(groups, dtype=np.int64) * N_BINS + \
+        np.searchsorted(EDGES, values, side='right')
+    return np.bincount(idx, minlength=n_groups * N_BINS).reshape(n_groups, N_BINS)
+
+
+def quantiles(counts, q):
+    '''
+    Estimate q-quantile of sketched values.
+
+    @param counts: sketches counts array of shape (..., L{N_BINS}).
+    @return: array of estimates of shape (...), NaN for empty sketches.
+    '''
+    cum = np.cumsum(counts, axis=-1)
+    total = cum[..., -1]
+    # the first bin with cumulative count above quantile rank
+    rank = q * (total - 1)
+    i = np.minimum((cum <= rank[..., np.newaxis]).sum(axis=-1), N_BINS - 1)
+    return np.where(total > 0, VALUES[i], np.nan)
+
+
+def to_bytes(counts):
+    '''
+    Serialize sketch counts array.
+    '''
+    idx = np.flatnonzero(counts)
+    return idx.astype(_INDEX_DTYPE).tobytes() + counts[idx].astype(_COUNT_DTYPE).tobytes()
+
+
+def from_bytes(data):
+    '''
+    Deserialize sketch counts array.
+
+    @return: int64 array of L{N_BINS} counts.
+    '''
+    n = len(data) // (_INDEX_DTYPE.itemsize + _COUNT_DTYPE.itemsize)
+    counts = np.zeros(N_BINS, dtype=np.int64)
+    counts[np.frombuffer(data, dtype=_INDEX_DTYPE, count=n)] = \
+        np.frombuffer(data, dtype=_COUNT_DTYPE, count=n, offset=n * _INDEX_DTYPE.itemsize)
+    return counts
+
+
+def merge_bytes(data, other):
+    '''
+    Merge serialized sketches.
+    '''
+    if data is None:
+        return other
+    if other is None:
+        return data
+    return to_bytes(from_bytes(data) + from_bytes(other))
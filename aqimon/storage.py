@@ -2,41 +2,949 @@
 
 import time
 
-from twisted.internet import defer
+from collections import defaultdict, namedtuple
 
+import numpy as np
 
-class AqiStorage(object):
+from zope.interface import implementer  # @UnresolvedImport
+
+from twisted.application import service
+from twisted.internet import defer, reactor, task, threads
+from twisted.logger import Logger
+
+from db.migrations import Migrator
+
+from aqimon import aqicalc, sketch
+from aqimon.binning import bin_series
+from aqimon.interfaces import IAqiStorage
+
+log = Logger()
+
+DEFAULT_FLUSH_SIZE = 50
+DEFAULT_FLUSH_INTERVAL = 300  # 5 min
+DEFAULT_RETENTION_INTERVAL = 86400  # 1 day
+
+# PM measurement data record
+PM_RECORD_DTYPE = np.dtype([('tstamp', '<i8'), ('pm25', '<f4'), ('pm10', '<f4')])
+
+PmColumns = namedtuple('PmColumns', ('tstamp', 'pm_25', 'pm_10'))
+
+# PM measurement data row, as stored in database
+PM_ROW_DTYPE = np.dtype([('tstamp', '<i8'), ('pm25', '<f8'), ('pm10', '<f8')])
+
+PmBins = namedtuple('PmBins', ('count', 'pm_25', 'pm_25_min', 'pm_25_max',
+                               'pm_10', 'pm_10_min', 'pm_10_max', 'aqi'))
+
+# Means and quantile bands of PM data and AQI values, NaN for empty bins
+PmBands = namedtuple('PmBands', ('count', 'pm_25', 'pm_25_low', 'pm_25_high',
+                                 'pm_10', 'pm_10_low', 'pm_10_high',
+                                 'aqi', 'aqi_low', 'aqi_high'))
+
+# Quantile sketches of PM data and AQI values for buckets, with values counts and sums
+PmSketches = namedtuple('PmSketches', ('bucket', 'n', 'pm_25_sum', 'pm_10_sum', 'aqi_sum',
+                                       'pm_25', 'pm_10', 'aqi'))
+
+# Default quantiles of band bounds
+DEFAULT_BAND_QUANTILES = (0.1, 0.9)
+
+# Upper bounds of concentrations with AQI, higher ones are counted as having AQI of 500
+PM25_AQI_MAX = aqicalc.PM25_BREAKPOINTS[-1, 1] / 10.
+PM10_AQI_MAX = float(aqicalc.PM10_BREAKPOINTS[-1, 1])
+
+
+def pm_aqi(pm_25, pm_10):
+    '''
+    Get integer AQI value (or array of values) for given PM2.5 and PM10 concentrations,
+    clipped to AQI range like quantile sketches do.
+    '''
+    if np.ndim(pm_25) == 0 and np.ndim(pm_10) == 0:
+        # scalars, as database calls it
+        return aqicalc.to_aqi(min(max(pm_25, 0), PM25_AQI_MAX),
+                              min(max(pm_10, 0), PM10_AQI_MAX))
+    return aqicalc.to_aqi(np.clip(pm_25, 0, PM25_AQI_MAX), np.clip(pm_10, 0, PM10_AQI_MAX))
+
+
+def bin_pm_records(records, ts_start, ts_end, n_bins, with_aqi=False):
+    '''
+    Aggregate PM data records array into C{n_bins} bins of equal width over
+    [ts_start, ts_end), the same way as L{AqiStorage.binned_pm_data} does.
+
+    @param records: records array, or list of records arrays (e.g. views of storage
+        segments), which are binned one by one, without concatenation.
+    @return: a L{PmBins}.
+    '''
+    if not isinstance(records, list):
+        records = [records]
+    rows = [row for r in records
+            for row in AqiStorage._binned_pm_records(r, ts_start, ts_end, n_bins, with_aqi)]
+    return AqiStorage._pm_bins(rows, n_bins, with_aqi)
+
+
+def sketch_pm_records(tstamp, pm_25, pm_10, level):
+    '''
+    Build quantile sketches of PM data and their AQI values for buckets of given
+    width (in seconds).
+
+    @return: a L{PmSketches} of non-empty buckets, ordered by bucket.
+    '''
+    buckets, groups = np.unique(np.asarray(tstamp) // level * level, return_inverse=True)
+    n_buckets = len(buckets)
+    # restore exact sensor values (0.1 ug/m^3 resolution) from float32 columns
+    pm_25 = np.round(np.asarray(pm_25, dtype=np.float64), 1)
+    pm_10 = np.round(np.asarray(pm_10, dtype=np.float64), 1)
+    aqi = pm_aqi(pm_25, pm_10)
+    return PmSketches(buckets, np.bincount(groups, minlength=n_buckets),
+                      np.bincount(groups, weights=pm_25, minlength=n_buckets),
+                      np.bincount(groups, weights=pm_10, minlength=n_buckets),
+                      np.bincount(groups, weights=aqi, minlength=n_buckets),
+                      sketch.histograms(groups, pm_25, n_buckets),
+                      sketch.histograms(groups, pm_10, n_buckets),
+                      sketch.histograms(groups, aqi, n_buckets))
+
+
+def band_pm_sketches(sketches, ts_start, ts_end, n_bins, quantiles=DEFAULT_BAND_QUANTILES):
+    '''
+    Merge bucket sketches into C{n_bins} bins of equal width over [ts_start, ts_end).
+
+    @param sketches: L{PmSketches} of buckets, not necessarily distinct or ordered.
+    @param quantiles: pair of quantiles of bands lower and upper bounds.
+    @return: a L{PmBands}.
+    '''
+    bins = (np.asarray(sketches.bucket, dtype=np.int64) - ts_start) * n_bins // \
+        (ts_end - ts_start)
+    inside = (bins >= 0) & (bins < n_bins)
+    bins = bins[inside]
+    n = np.bincount(bins, weights=sketches.n[inside], minlength=n_bins)
+    empty = n == 0
+    result = [n.astype(np.int64)]
+    for values_sum, values_sketch in ((sketches.pm_25_sum, sketches.pm_25),
+                                      (sketches.pm_10_sum, sketches.pm_10),
+                                      (sketches.aqi_sum, sketches.aqi)):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.bincount(bins, weights=values_sum[inside], minlength=n_bins) / n
+        mean[empty] = np.nan
+        counts = np.zeros((n_bins, sketch.N_BINS), dtype=np.int64)
+        np.add.at(counts, bins, values_sketch[inside])
+        result.extend([mean] + [sketch.quantiles(counts, q) for q in quantiles])
+    return PmBands(*result)
+
+
+@implementer(IAqiStorage)
+class AqiStorage(service.Service):
     '''
     AQI-related data storage.
 
+    PM measurement data are buffered in memory and written to database in batches,
+    when buffer size reaches C{flush_size} records or C{flush_interval} seconds
+    passed since the first buffered record.
+
+    If C{retention} (in seconds) is set, raw PM data older than it are periodically moved
+    to C{archive} and freed database pages are reclaimed by incremental vacuum. Database
+    is switched to incremental vacuum by one-time full vacuum, in background after start.
+
     '''
-    def __init__(self, db_session):
+    name = 'aqi_storage'
+
+    # Rollup bucket widths (in seconds): minute, hour and day
+    rollup_levels = (60, 3600, 86400)
+
+    # Quantile sketch bucket widths (in seconds): hour and day
+    sketch_levels = (3600, 86400)
+
+    # Max number of PM data records copied in one transaction by schema migration
+    migration_chunk = 10000
+    # Max time span (in seconds) of raw PM data archived in one transaction
+    archive_chunk = 86400
+    # Max number of pages freed by one incremental vacuum step
+    vacuum_step_pages = 256
+    # Delay (in seconds) between incremental vacuum steps
+    vacuum_step_delay = 0.1
+    # Number of PM data records fetched at once by export
+    export_chunk = 10000
+    # Time span (in seconds) of PM data sketched in one transaction by schema migration
+    sketch_migration_chunk = 86400
+
+    # Merge new rollup buckets into already stored ones
+    _rollup_upsert = (
+        'ON CONFLICT (level, bucket) DO UPDATE SET n = n + excluded.n, ' +
+        'pm25_sum = pm25_sum + excluded.pm25_sum, ' +
+        'pm25_min = min(pm25_min, excluded.pm25_min), ' +
+        'pm25_max = max(pm25_max, excluded.pm25_max), ' +
+        'pm10_sum = pm10_sum + excluded.pm10_sum, ' +
+        'pm10_min = min(pm10_min, excluded.pm10_min), ' +
+        'pm10_max = max(pm10_max, excluded.pm10_max)')
+
+    # AQI sum of rollup bucket r, from its sketch s if any, or from bucket means otherwise
+    _aqi_sum = 'coalesce(s.aqi_sum, pm_aqi(r.pm25_sum / r.n, r.pm10_sum / r.n) * r.n)'
+
+    # Merge new quantile sketches into already stored ones
+    _sketch_upsert = (
+        'ON CONFLICT (level, bucket) DO UPDATE SET n = n + excluded.n, ' +
+        'pm25_sum = pm25_sum + excluded.pm25_sum, ' +
+        'pm10_sum = pm10_sum + excluded.pm10_sum, ' +
+        'aqi_sum = aqi_sum + excluded.aqi_sum, ' +
+        'pm25 = sketch_merge(pm25, excluded.pm25), ' +
+        'pm10 = sketch_merge(pm10, excluded.pm10), ' +
+        'aqi = sketch_merge(aqi, excluded.aqi)')
+
+    def __init__(self, db_session, flush_size=DEFAULT_FLUSH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, retention=None, archive=None,
+                 retention_interval=DEFAULT_RETENTION_INTERVAL):
         # open database
         self.db_session = db_session
-        # create tables, if needed
-        self._create_tables()
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.retention = retention
+        self.archive = archive
+        self.retention_interval = retention_interval
+        self._retention_call = None
+        # buffered PM data records, not yet written to database
+        self._pending = []
+        self._flush_call = None
+        self._flushing = None
+        self._ready = False
+        self._ready_waiters = []
+        # register SQL functions
+        db_session.add_connect_hook(self._create_functions)
+
+    def startService(self):
+        service.Service.startService(self)
+        self.migrate().addCallbacks(self._migrated, self._migration_failed)
+
+    def migrate(self):
+        '''
+        Bring database schema to the latest version.
+
+        @return: a L{Deferred} which will fire with resulting schema version.
+        '''
+        return Migrator(self.db_session, self.name,
+                        [self._migrate_initial, self._migrate_clustered,
+                         self._migrate_sketches]).migrate()
+
+    def _migrated(self, version):
+        log.info("Database schema is up to date (version {version})", version=version)
+        self._ready = True
+        waiters, self._ready_waiters = self._ready_waiters, []
+        for d in waiters:
+            d.callback(None)
+        # reclaim pages freed by migrations (or left by interrupted vacuum) in background,
+        # database is switched to incremental vacuum only if retention frees pages regularly
+        d = defer.succeed(None)
+        if self.retention_horizon is not None:
+            d.addCallback(lambda _: self.db_session.runInteraction(
+                self._enable_incremental_vacuum))
+        d.addCallback(lambda _: self.incremental_vacuum())
+        d.addErrback(lambda f: log.failure("Can't reclaim free database pages", f))
+        if self.retention_horizon is not None:
+            d.addCallback(self._start_retention)
+
+    def _start_retention(self, _):
+        if self.running:
+            self._retention_call = task.LoopingCall(self.apply_retention)
+            self._retention_call.start(self.retention_interval, now=True)
+
+    def _migration_failed(self, f):
+        log.failure("Can't migrate database schema", f)
+        waiters, self._ready_waiters = self._ready_waiters, []
+        for d in waiters:
+            d.errback(f)
+
+    def when_ready(self):
+        '''
+        Wait for database schema migrations to complete.
+
+        @return: a L{Deferred} which will fire when storage is ready to use.
+        '''
+        if self._ready:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._ready_waiters.append(d)
+        return d
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._retention_call is not None and self._retention_call.running:
+            self._retention_call.stop()
+        return self.flush()
+
+    @staticmethod
+    def _create_functions(conn):
+        conn.create_function('pm_aqi', 2, pm_aqi)
+        conn.create_function('sketch_merge', 2, sketch.merge_bytes)
 
     @defer.inlineCallbacks
-    def _create_tables(self):
+    def _migrate_initial(self, db_session):
         # create PM data table
-        yield self.db_session.runQuery(
+        yield db_session.runOperation(
             'CREATE TABLE IF NOT EXISTS pm_data ' +
             '(id INTEGER PRIMARY KEY AUTOINCREMENT, tstamp INTEGER, pm25 REAL, pm10 REAL)')
-        yield self.db_session.runQuery(
+        yield db_session.runOperation(
             'CREATE INDEX IF NOT EXISTS pm_data_tstamp_idx ON pm_data (tstamp)')
+        # create PM data rollup table
+        yield db_session.runInteraction(self._create_rollup_table)
+
+    def _create_rollup_table(self, txn):
+        txn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='pm_rollup'")
+        if txn.fetchone() is not None:
+            return
+        txn.execute(
+            'CREATE TABLE pm_rollup ' +
+            '(level INTEGER, bucket INTEGER, n INTEGER, ' +
+            'pm25_sum REAL, pm25_min REAL, pm25_max REAL, ' +
+            'pm10_sum REAL, pm10_min REAL, pm10_max REAL, ' +
+            'PRIMARY KEY (level, bucket)) WITHOUT ROWID')
+        # fill rollups from already collected data, counting only the first record of
+        # every timestamp, the one kept by migration to clustered table
+        for level in self.rollup_levels:
+            txn.execute(
+                'INSERT INTO pm_rollup SELECT ?, tstamp / ? * ? AS bucket, count(*), ' +
+                'sum(pm25), min(pm25), max(pm25), sum(pm10), min(pm10), max(pm10) ' +
+                'FROM pm_data WHERE id IN (SELECT min(id) FROM pm_data GROUP BY tstamp) ' +
+                'GROUP BY bucket',
+                (level, level, level))
+
+    @defer.inlineCallbacks
+    def _migrate_clustered(self, db_session):
+        # move PM data to table clustered by timestamp, so inserts and range scans
+        # touch a single B-tree, without secondary index and sqlite_sequence updates
+        ts_start = yield db_session.runInteraction(self._create_clustered_table)
+        if ts_start is None:
+            return
+        while ts_start is not None:
+            ts_start = yield db_session.runInteraction(self._copy_clustered_chunk, ts_start)
+        yield db_session.runInteraction(self._replace_with_clustered_table)
+        # pages freed by the old table are reclaimed after storage is ready
+
+    @staticmethod
+    def _create_clustered_table(txn):
+        txn.execute('PRAGMA table_info(pm_data)')
+        if 'id' not in [column[1] for column in txn.fetchall()]:
+            # already migrated
+            txn.execute('DROP TABLE IF EXISTS pm_data_clustered')
+            return None
+        txn.execute(
+            'CREATE TABLE IF NOT EXISTS pm_data_clustered ' +
+            '(tstamp INTEGER PRIMARY KEY, pm25 REAL, pm10 REAL)')
+        # resume interrupted migration
+        txn.execute('SELECT max(tstamp) FROM pm_data_clustered')
+        ts_start = txn.fetchone()[0]
+        return ts_start if ts_start is not None else 0
+
+    def _copy_clustered_chunk(self, txn, ts_start):
+        txn.execute(
+            'SELECT max(tstamp), count(*) FROM ' +
+            '(SELECT tstamp FROM pm_data WHERE tstamp >= ? ORDER BY tstamp LIMIT ?)',
+            (ts_start, self.migration_chunk))
+        ts_last, n = txn.fetchone()
+        if not n:
+            return None
+        # duplicate timestamps are dropped
+        txn.execute(
+            'INSERT OR IGNORE INTO pm_data_clustered (tstamp, pm25, pm10) ' +
+            'SELECT tstamp, pm25, pm10 FROM pm_data WHERE tstamp >= ? AND tstamp <= ? ' +
+            'ORDER BY tstamp, id',
+            (ts_start, ts_last))
+        return ts_last + 1 if n == self.migration_chunk else None
+
+    @staticmethod
+    def _replace_with_clustered_table(txn):
+        txn.execute('BEGIN')
+        txn.execute('DROP TABLE pm_data')
+        txn.execute('ALTER TABLE pm_data_clustered RENAME TO pm_data')
+
+    @defer.inlineCallbacks
+    def _migrate_sketches(self, db_session):
+        # sketch already collected data by days, so every transaction is short
+        ts_start = yield db_session.runInteraction(self._create_sketch_table)
+        while ts_start is not None:
+            ts_start = yield db_session.runInteraction(self._sketch_chunk, ts_start)
+
+    @staticmethod
+    def _create_sketch_table(txn):
+        txn.execute(
+            'CREATE TABLE IF NOT EXISTS pm_sketch ' +
+            '(level INTEGER, bucket INTEGER, n INTEGER, ' +
+            'pm25_sum REAL, pm10_sum REAL, aqi_sum REAL, pm25 BLOB, pm10 BLOB, aqi BLOB, ' +
+            'PRIMARY KEY (level, bucket)) WITHOUT ROWID')
+        # start over interrupted migration
+        txn.execute('DELETE FROM pm_sketch')
+        txn.execute('SELECT min(tstamp) FROM pm_data')
+        return txn.fetchone()[0]
+
+    def _sketch_chunk(self, txn, ts_start):
+        ts_start = ts_start // self.sketch_migration_chunk * self.sketch_migration_chunk
+        ts_end = ts_start + self.sketch_migration_chunk
+        cursor = txn.execute(
+            'SELECT tstamp, pm25, pm10 FROM pm_data WHERE tstamp >= ? AND tstamp < ?',
+            (ts_start, ts_end))
+        self._add_sketches(txn, np.fromiter(cursor, dtype=PM_ROW_DTYPE))
+        txn.execute('SELECT min(tstamp) FROM pm_data WHERE tstamp >= ?', (ts_end,))
+        return txn.fetchone()[0]
+
+    def _add_sketches(self, txn, records):
+        if not len(records):
+            return
+        for level in self.sketch_levels:
+            s = sketch_pm_records(records['tstamp'], records['pm25'], records['pm10'], level)
+            txn.executemany(
+                'INSERT INTO pm_sketch VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ' +
+                self._sketch_upsert,
+                [(level, bucket, n, pm_25_sum, pm_10_sum, aqi_sum, sketch.to_bytes(pm_25),
+                  sketch.to_bytes(pm_10), sketch.to_bytes(aqi))
+                 for bucket, n, pm_25_sum, pm_10_sum, aqi_sum, pm_25, pm_10, aqi
+                 in zip(s.bucket.tolist(), s.n.tolist(), s.pm_25_sum.tolist(),
+                        s.pm_10_sum.tolist(), s.aqi_sum.tolist(), s.pm_25, s.pm_10, s.aqi)])
+
+    @staticmethod
+    def _enable_incremental_vacuum(txn):
+        txn.execute('PRAGMA auto_vacuum')
+        if txn.fetchone()[0] == 2:
+            return
+        log.info("Enabling incremental vacuum by full vacuum, this may take a while...")
+        txn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        # auto_vacuum mode change takes effect after full vacuum
+        txn.execute('VACUUM')
+
+    @property
+    def retention_horizon(self):
+        '''
+        Timestamp of the oldest raw PM data kept in database, or None if all data are kept.
+        '''
+        if not self.retention or self.archive is None:
+            return None
+        return int(time.time()-self.retention)
+
+    @defer.inlineCallbacks
+    def apply_retention(self):
+        '''
+        Move raw PM data older than retention horizon to archive, then reclaim
+        freed database pages.
+        '''
+        horizon = self.retention_horizon
+        if horizon is None:
+            return
+        archived = 0
+        while True:
+            n = yield self.db_session.runInteraction(self._archive_expired, horizon)
+            if n is None:
+                break
+            archived += n
+        if archived:
+            log.info("Archived {n} PM data record(s)", n=archived)
+            yield self.incremental_vacuum()
+
+    def _archive_expired(self, txn, horizon):
+        txn.execute('SELECT min(tstamp) FROM pm_data')
+        ts_start = txn.fetchone()[0]
+        if ts_start is None or ts_start >= horizon:
+            return None
+        ts_end = min(horizon, ts_start + self.archive_chunk)
+        txn.execute(
+            'SELECT tstamp, pm25, pm10 FROM pm_data WHERE tstamp < ? ORDER BY tstamp',
+            (ts_end,))
+        rows = txn.fetchall()
+        # archive skips already archived rows, so if the DELETE below doesn't commit,
+        # rows are not archived twice by the next run
+        self.archive.append(rows)
+        txn.execute('DELETE FROM pm_data WHERE tstamp < ?', (ts_end,))
+        return len(rows)
+
+    @defer.inlineCallbacks
+    def incremental_vacuum(self):
+        '''
+        Reclaim free database pages in small steps, so writes are never blocked for long.
+        '''
+        while True:
+            free_pages = yield self.db_session.runInteraction(self._incremental_vacuum_step)
+            if not free_pages:
+                break
+            yield task.deferLater(reactor, self.vacuum_step_delay, lambda: None)
+
+    def _incremental_vacuum_step(self, txn):
+        txn.execute('PRAGMA auto_vacuum')
+        if txn.fetchone()[0] != 2:
+            # free pages are just reused, without incremental vacuum
+            return 0
+        # incremental_vacuum frees one page per result row fetched by execute(),
+        # while executescript() runs it to completion
+        txn.executescript('PRAGMA incremental_vacuum(%d);' % self.vacuum_step_pages)
+        txn.execute('PRAGMA freelist_count')
+        return txn.fetchone()[0]
+
+    def archived_pm_data(self, ts_start, ts_end):
+        '''
+        Get archived PM measurement data with timestamps in [ts_start, ts_end).
+
+        @return: a L{Deferred} which will fire a list of (tstamp, pm25, pm10) tuples
+            ordered by timestamp.
+        '''
+        if self.archive is None:
+            return defer.succeed([])
+        return threads.deferToThread(self.archive.read, ts_start, ts_end) \
+            .addCallback(lambda records: records.tolist())
 
     def add_pm_data(self, tstamp, pm_25, pm_10):
         '''
-        Add PM measurement data to database.
+        Add PM measurement data to write buffer.
+        '''
+        self._pending.append((tstamp, pm_25, pm_10))
+        if len(self._pending) >= self.flush_size:
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = reactor.callLater(self.flush_interval,  # @UndefinedVariable
+                                                 self.flush)
+
+    @property
+    def pending_count(self):
+        '''
+        Number of buffered PM data records, not yet written to database.
+        '''
+        return len(self._pending)
+
+    def flush(self):
+        '''
+        Write buffered PM data records to database in a single transaction.
+
+        @return: a L{Deferred} which will fire when records are written.
+        '''
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        if self._flushing is not None:
+            # wait for flush in progress, then flush records buffered after it started
+            d = defer.Deferred()
+            self._flushing.addBoth(lambda _: self.flush().chainDeferred(d))
+            return d
+        if not self._pending:
+            return defer.succeed(None)
+        if not self._ready:
+            # keep data buffered until database schema is migrated
+            return self.when_ready().addCallback(lambda _: self.flush())
+        rows = list(self._pending)
+
+        def flushed(_):
+            self._flushing = None
+            # keep records buffered after flush started
+            del self._pending[:len(rows)]
+            log.debug("Flushed {n} PM data record(s)", n=len(rows))
+
+        def flush_failed(f):
+            self._flushing = None
+            log.failure("Can't write {n} PM data record(s)", f, n=len(rows))
+            if self._flush_call is None:
+                self._flush_call = reactor.callLater(self.flush_interval,  # @UndefinedVariable
+                                                     self.flush)
+
+        self._flushing = self.db_session.runInteraction(self._add_pm_data, rows)
+        self._flushing.addCallbacks(flushed, flush_failed)
+        return self._flushing
+
+    def _add_pm_data(self, txn, rows):
+        # ignore records with already stored (or already buffered) timestamps, which are
+        # looked up by a single range scan, so the batch is inserted at once
+        ts_first, ts_last = min(row[0] for row in rows), max(row[0] for row in rows)
+        txn.execute('SELECT tstamp FROM pm_data WHERE tstamp >= ? AND tstamp <= ?',
+                    (ts_first, ts_last))
+        stored = set(tstamp for tstamp, in txn.fetchall())
+        # archived records are already counted by rollups and sketches
+        for tstamps in self._archived_tstamps(ts_first, ts_last):
+            stored.update(tstamps.tolist())
+        added = []
+        for row in rows:
+            if row[0] not in stored:
+                stored.add(row[0])
+                added.append(row)
+        rows = added
+        horizon = self.retention_horizon
+        expired = [row for row in rows if horizon is not None and row[0] < horizon]
+        txn.executemany('INSERT INTO pm_data (tstamp, pm25, pm10) VALUES (?, ?, ?)',
+                        [row for row in rows if horizon is None or row[0] >= horizon])
+        txn.executemany(
+            'INSERT INTO pm_rollup VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ' + self._rollup_upsert,
+            [(level,) + bucket for level in self.rollup_levels
+             for bucket in self._rollup(rows, level)])
+        self._add_sketches(txn, np.array(rows, dtype=PM_ROW_DTYPE))
+        if expired:
+            # after everything else succeeded, so they aren't archived if it failed
+            self.archive.append(expired)
+
+    def _archived_tstamps(self, ts_first, ts_last):
+        '''
+        Get timestamps of archived PM data records in [ts_first, ts_last], as arrays
+        of archive segments. Blocks on file I/O, so should not be called from reactor
+        thread.
+        '''
+        if self.archive is None or ts_first is None:
+            return
+        archive_last = self.archive.last_tstamp()
+        if ts_first > archive_last:
+            return
+        for records in self.archive.read_segments(ts_first, min(ts_last, archive_last) + 1):
+            yield records['tstamp']
+
+    def import_pm_data(self, rows):
+        '''
+        Write PM measurement data records to database in a single transaction,
+        bypassing write buffer. Records with already stored or archived timestamps,
+        or duplicating timestamps of preceding records, are ignored. Records older
+        than retention horizon are moved right to archive.
+
+        @return: a L{Deferred} which will fire with number of added records.
         '''
-        return self.db_session.runQuery(
-            'INSERT INTO pm_data (tstamp, pm25, pm10) VALUES (?, ?, ?)',
-            (tstamp, pm_25, pm_10))
+        return self.db_session.runInteraction(self._import_pm_data, rows)
 
+    def _import_pm_data(self, txn, rows):
+        # deduplicate and aggregate records in SQL, so bulk imports don't pay
+        # per-record round trips
+        txn.execute(
+            'CREATE TEMP TABLE IF NOT EXISTS pm_import ' +
+            '(tstamp INTEGER PRIMARY KEY, pm25 REAL, pm10 REAL)')
+        txn.execute('DELETE FROM pm_import')
+        txn.executemany('INSERT OR IGNORE INTO pm_import (tstamp, pm25, pm10) VALUES (?, ?, ?)',
+                        rows)
+        txn.execute(
+            'DELETE FROM pm_import WHERE EXISTS ' +
+            '(SELECT 1 FROM pm_data WHERE pm_data.tstamp = pm_import.tstamp)')
+        # archived records are already counted by rollups and sketches
+        txn.execute('SELECT min(tstamp), max(tstamp) FROM pm_import')
+        for tstamps in self._archived_tstamps(*txn.fetchone()):
+            txn.executemany('DELETE FROM pm_import WHERE tstamp = ?',
+                            [(tstamp,) for tstamp in tstamps.tolist()])
+        # records older than retention horizon are moved right to archive
+        horizon = self.retention_horizon
+        if horizon is None:
+            expired = []
+        else:
+            txn.execute('SELECT tstamp, pm25, pm10 FROM pm_import WHERE tstamp < ? ' +
+                        'ORDER BY tstamp', (horizon,))
+            expired = txn.fetchall()
+        txn.execute('INSERT INTO pm_data (tstamp, pm25, pm10) ' +
+                    'SELECT tstamp, pm25, pm10 FROM pm_import WHERE tstamp >= ? ' +
+                    'ORDER BY tstamp', (horizon or 0,))
+        added = txn.rowcount + len(expired)
+        for level in self.rollup_levels:
+            txn.execute(
+                'INSERT INTO pm_rollup SELECT ?, tstamp / ? * ? AS bucket, count(*), ' +
+                'sum(pm25), min(pm25), max(pm25), sum(pm10), min(pm10), max(pm10) ' +
+                'FROM pm_import WHERE true GROUP BY bucket ' + self._rollup_upsert,
+                (level, level, level))
+        cursor = txn.execute('SELECT tstamp, pm25, pm10 FROM pm_import')
+        self._add_sketches(txn, np.fromiter(cursor, dtype=PM_ROW_DTYPE))
+        txn.execute('DELETE FROM pm_import')
+        if expired:
+            self.archive.append(expired)
+        return added
+
+    def export_pm_data(self, ts_start, ts_end, exporter):
+        '''
+        Export PM measurement data with timestamps in [ts_start, ts_end) from
+        a consistent database snapshot, preceded by data moved to archive. C{exporter}
+        is called in a database thread with number of exported records and an iterator
+        over lists of up to C{export_chunk} (tstamp, pm25, pm10) tuples, ordered by
+        timestamp.
+
+        @return: a L{Deferred} which will fire the return value of C{exporter}.
+        '''
+        return self.db_session.runReadInteraction(self._export_pm_data, int(ts_start),
+                                                  int(ts_end), exporter)
+
+    def _export_pm_data(self, txn, ts_start, ts_end, exporter):
+        # keep the same snapshot for counting and fetching records
+        txn.execute('BEGIN')
+        txn.execute('SELECT min(tstamp) FROM pm_data')
+        first_tstamp = txn.fetchone()[0]
+        archive_end = ts_start
+        if self.archive is not None:
+            # archived data precede stored ones, archive segments are read twice
+            # (to count and to export records), so only one is in memory at a time
+            archive_end = ts_end if first_tstamp is None else min(ts_end, first_tstamp)
+        archived = sum(len(records) for records
+                       in self.archive.read_segments(ts_start, archive_end)) \
+            if archive_end > ts_start else 0
+        txn.execute('SELECT count(*) FROM pm_data WHERE tstamp >= ? AND tstamp < ?',
+                    (ts_start, ts_end))
+        count = txn.fetchone()[0]
+
+        def chunks():
+            if archived:
+                for records in self.archive.read_segments(ts_start, archive_end):
+                    for i in range(0, len(records), self.export_chunk):
+                        r = records[i:i+self.export_chunk]
+                        # restore exact sensor values (0.1 ug/m^3 resolution) from
+                        # float32 records
+                        yield list(zip(r['tstamp'].tolist(),
+                                       np.round(r['pm25'].astype(np.float64), 1).tolist(),
+                                       np.round(r['pm10'].astype(np.float64), 1).tolist()))
+            txn.execute(
+                'SELECT tstamp, pm25, pm10 FROM pm_data WHERE tstamp >= ? AND tstamp < ? ' +
+                'ORDER BY tstamp', (ts_start, ts_end))
+            for rows in iter(lambda: txn.fetchmany(self.export_chunk), []):
+                yield rows
+
+        return exporter(archived + count, chunks())
+
+    @staticmethod
+    def _rollup(rows, level):
+        '''
+        Aggregate PM data records into buckets of given rollup level.
+
+        @return: a list of (bucket, n, pm25_sum, pm25_min, pm25_max, pm10_sum, pm10_min,
+            pm10_max) tuples ordered by bucket.
+        '''
+        buckets = defaultdict(list)
+        for tstamp, pm_25, pm_10 in rows:
+            buckets[tstamp // level * level].append((pm_25, pm_10))
+        rollup = []
+        for bucket in sorted(buckets):
+            pm_25, pm_10 = zip(*buckets[bucket])
+            rollup.append((bucket, len(pm_25), sum(pm_25), min(pm_25), max(pm_25),
+                           sum(pm_10), min(pm_10), max(pm_10)))
+        return rollup
+
+    def _pending_after(self, tstamp):
+        '''
+        Get buffered PM data records newer than given timestamp.
+        '''
+        return [row for row in self._pending if tstamp is None or row[0] > tstamp]
+
+    @defer.inlineCallbacks
     def last_period_pm_data(self, period):
         '''
         Get last PM measurement data for given period (in seconds).
         '''
-        return self.db_session.runQuery(
-            'SELECT tstamp, pm25, pm10 FROM pm_data WHERE tstamp > ?',
-            (int(time.time()-period),))
+        ts_start = int(time.time()-period)
+        pm_data = yield self.db_session.runQuery(
+            'SELECT tstamp, pm25, pm10 FROM pm_data WHERE tstamp > ? ORDER BY tstamp',
+            (ts_start,))
+        horizon = self.retention_horizon
+        if horizon is not None and ts_start < horizon:
+            # prepend data moved to archive
+            ts_end = pm_data[0][0] if pm_data else horizon
+            archived = yield self.archived_pm_data(ts_start+1, ts_end)
+            pm_data = archived + pm_data
+        last_tstamp = pm_data[-1][0] if pm_data else ts_start
+        defer.returnValue(pm_data + self._pending_after(last_tstamp))
+
+    @defer.inlineCallbacks
+    def period_pm_columns(self, ts_start, ts_end):
+        '''
+        Get PM measurement data with timestamps in [ts_start, ts_end) as columns.
+
+        @return: a L{Deferred} which will fire a L{PmColumns} of contiguous arrays:
+            int64 timestamps and float32 PM2.5 and PM10 values, ordered by timestamp.
+        '''
+        ts_start, ts_end = int(ts_start), int(ts_end)
+        records = yield self.db_session.runReadInteraction(self._period_pm_records,
+                                                           ts_start, ts_end)
+        horizon = self.retention_horizon
+        if horizon is not None and ts_start < horizon:
+            # prepend data moved to archive
+            archive_end = records['tstamp'][0] if len(records) else min(horizon, ts_end)
+            archived = yield threads.deferToThread(self.archive.read, ts_start, archive_end)
+            records = np.concatenate((archived, records))
+        last_tstamp = records['tstamp'][-1] if len(records) else ts_start-1
+        pending = [row for row in self._pending_after(last_tstamp) if row[0] < ts_end]
+        if pending:
+            records = np.concatenate((records, np.array(pending, dtype=PM_RECORD_DTYPE)))
+        defer.returnValue(PmColumns(np.ascontiguousarray(records['tstamp']),
+                                    np.ascontiguousarray(records['pm25']),
+                                    np.ascontiguousarray(records['pm10'])))
+
+    @staticmethod
+    def _period_pm_records(txn, ts_start, ts_end):
+        # fill records array right from cursor, without intermediate list of rows
+        cursor = txn.execute(
+            'SELECT tstamp, pm25, pm10 FROM pm_data WHERE tstamp >= ? AND tstamp < ? ' +
+            'ORDER BY tstamp', (ts_start, ts_end))
+        return np.fromiter(cursor, dtype=PM_RECORD_DTYPE)
+
+    def rollup_level(self, ts_start, ts_end, n_bins, with_aqi=False):
+        '''
+        Get the coarsest rollup level with buckets exactly fitting into given bins,
+        or None if there is no such level. AQI sums are kept by quantile sketches only,
+        so levels without sketches don't fit bins C{with_aqi}.
+        '''
+        levels = [level for level in self.rollup_levels
+                  if ts_start % level == 0 and (ts_end-ts_start) % (n_bins*level) == 0 and
+                  (not with_aqi or level in self.sketch_levels)]
+        return max(levels) if levels else None
+
+    @defer.inlineCallbacks
+    def binned_pm_data(self, ts_start, ts_end, n_bins, with_aqi=False):
+        '''
+        Get PM measurement data with timestamps in [ts_start, ts_end), aggregated
+        into C{n_bins} bins of equal width. Aggregation is done by database, using
+        rollups instead of raw data if bin boundaries are aligned to rollup buckets.
+
+        @param with_aqi: If C{True}, also aggregate per-sample AQI values, which are
+            summed by quantile sketches of rollup buckets, if any.
+
+        @return: a L{Deferred} which will fire a L{PmBins} of arrays of length C{n_bins},
+            with NaN means, minimums and maximums for empty bins.
+        '''
+        ts_start, ts_end = int(ts_start), int(ts_end)
+        level = self.rollup_level(ts_start, ts_end, n_bins, with_aqi)
+        rows, first_tstamp, last_tstamp = yield self.db_session.runReadInteraction(
+            self._binned_pm_rows, ts_start, ts_end, n_bins, level, with_aqi)
+        records = []
+        horizon = self.retention_horizon
+        if level is None and horizon is not None and ts_start < horizon:
+            # rollups are kept forever, but raw data may be moved to archive
+            archive_end = min(horizon, ts_end)
+            if first_tstamp is not None:
+                archive_end = min(archive_end, first_tstamp)
+            archived = yield threads.deferToThread(self.archive.read, ts_start, archive_end)
+            records.append(archived)
+        pending = [row for row in self._pending_after(last_tstamp)
+                   if ts_start <= row[0] < ts_end]
+        if pending:
+            records.append(np.array(pending, dtype=PM_RECORD_DTYPE))
+        if records:
+            rows = rows + self._binned_pm_records(np.concatenate(records), ts_start, ts_end,
+                                                  n_bins, with_aqi)
+        defer.returnValue(self._pm_bins(rows, n_bins, with_aqi))
+
+    def sketch_level(self, ts_start, ts_end, n_bins):
+        '''
+        Get the coarsest sketch level with buckets exactly fitting into given bins,
+        or None if there is no such level.
+        '''
+        levels = [level for level in self.sketch_levels
+                  if ts_start % level == 0 and (ts_end-ts_start) % (n_bins*level) == 0]
+        return max(levels) if levels else None
+
+    @defer.inlineCallbacks
+    def banded_pm_data(self, ts_start, ts_end, n_bins, quantiles=DEFAULT_BAND_QUANTILES):
+        '''
+        Get means and quantile bands of PM measurement data and their AQI values with
+        timestamps in [ts_start, ts_end), aggregated into C{n_bins} bins of equal width.
+        Bands are estimated by merging stored quantile sketches, so only a few of them
+        are read for every bin, whatever the number of samples.
+
+        @param quantiles: pair of quantiles of bands lower and upper bounds.
+
+        @return: a L{Deferred} which will fire a L{PmBands} of arrays of length C{n_bins},
+            with NaN values for empty bins, or fail with L{ValueError} if bin boundaries
+            are not aligned to sketch buckets.
+        '''
+        ts_start, ts_end = int(ts_start), int(ts_end)
+        level = self.sketch_level(ts_start, ts_end, n_bins)
+        if level is None:
+            raise ValueError('Bins are not aligned to sketch buckets')
+        stored, last_tstamp = yield self.db_session.runReadInteraction(
+            self._pm_sketches, ts_start, ts_end, level)
+        sketches = [stored]
+        pending = [row for row in self._pending_after(last_tstamp)
+                   if ts_start <= row[0] < ts_end]
+        if pending:
+            records = np.array(pending, dtype=PM_ROW_DTYPE)
+            sketches.append(sketch_pm_records(records['tstamp'], records['pm25'],
+                                              records['pm10'], level))
+        sketches = PmSketches(*[np.concatenate(c) for c in zip(*sketches)])
+        defer.returnValue(band_pm_sketches(sketches, ts_start, ts_end, n_bins, quantiles))
+
+    @staticmethod
+    def _pm_sketches(txn, ts_start, ts_end, level):
+        # read sketches and the last stored timestamp from the same snapshot
+        txn.execute('BEGIN')
+        txn.execute('SELECT max(tstamp) FROM pm_data')
+        last_tstamp = txn.fetchone()[0]
+        # buckets without sketches (rolled up before sketches were introduced) are
+        # counted by means, with AQI of bucket means, but not by bands
+        txn.execute(
+            'SELECT r.bucket, r.n, r.pm25_sum, r.pm10_sum, ' + AqiStorage._aqi_sum + ', ' +
+            "coalesce(s.pm25, x''), coalesce(s.pm10, x''), coalesce(s.aqi, x'') " +
+            'FROM pm_rollup r LEFT JOIN pm_sketch s ON s.level = r.level AND s.bucket = r.bucket ' +
+            'WHERE r.level = ? AND r.bucket >= ? AND r.bucket < ? ORDER BY r.bucket',
+            (level, ts_start, ts_end))
+        rows = txn.fetchall()
+        columns = list(zip(*rows)) if rows else [()] * len(PmSketches._fields)
+        sketches = [np.array(c, dtype=np.int64) for c in columns[:2]] + \
+            [np.array(c, dtype=np.float64) for c in columns[2:5]] + \
+            [np.array([sketch.from_bytes(data) for data in c], dtype=np.int64)
+             .reshape(len(rows), sketch.N_BINS) for c in columns[5:]]
+        return PmSketches(*sketches), last_tstamp
+
+    @staticmethod
+    def _binned_pm_rows(txn, ts_start, ts_end, n_bins, level, with_aqi):
+        # read bins and stored timestamps range from the same snapshot
+        txn.execute('BEGIN')
+        # separate subqueries, so both are answered by B-tree ends instead of a table scan
+        txn.execute('SELECT (SELECT min(tstamp) FROM pm_data), (SELECT max(tstamp) FROM pm_data)')
+        first_tstamp, last_tstamp = txn.fetchone()
+        if level is None:
+            txn.execute(
+                'SELECT (tstamp - ?) * ? / ? AS bin, count(*), ' +
+                'sum(pm25), min(pm25), max(pm25), sum(pm10), min(pm10), max(pm10)' +
+                (', sum(pm_aqi(pm25, pm10)) ' if with_aqi else ' ') +
+                'FROM pm_data WHERE tstamp >= ? AND tstamp < ? GROUP BY bin',
+                (ts_start, n_bins, ts_end-ts_start, ts_start, ts_end))
+        elif with_aqi:
+            # buckets without sketches (rolled up before sketches were introduced)
+            # are counted too, with AQI of bucket means
+            txn.execute(
+                'SELECT (r.bucket - ?) * ? / ? AS bin, sum(r.n), ' +
+                'sum(r.pm25_sum), min(r.pm25_min), max(r.pm25_max), ' +
+                'sum(r.pm10_sum), min(r.pm10_min), max(r.pm10_max), ' +
+                'sum(' + AqiStorage._aqi_sum + ') ' +
+                'FROM pm_rollup r LEFT JOIN pm_sketch s ' +
+                'ON s.level = r.level AND s.bucket = r.bucket ' +
+                'WHERE r.level = ? AND r.bucket >= ? AND r.bucket < ? GROUP BY bin',
+                (ts_start, n_bins, ts_end-ts_start, level, ts_start, ts_end))
+        else:
+            txn.execute(
+                'SELECT (bucket - ?) * ? / ? AS bin, sum(n), ' +
+                'sum(pm25_sum), min(pm25_min), max(pm25_max), ' +
+                'sum(pm10_sum), min(pm10_min), max(pm10_max) ' +
+                'FROM pm_rollup WHERE level = ? AND bucket >= ? AND bucket < ? GROUP BY bin',
+                (ts_start, n_bins, ts_end-ts_start, level, ts_start, ts_end))
+        return txn.fetchall(), first_tstamp, last_tstamp
+
+    @staticmethod
+    def _binned_pm_records(records, ts_start, ts_end, n_bins, with_aqi):
+        '''
+        Aggregate PM data records array into bins, the same way as database does.
+        '''
+        bins = (records['tstamp'] - ts_start) * n_bins // (ts_end - ts_start)
+        # restore exact sensor values (0.1 ug/m^3 resolution) from float32 columns
+        pm_25 = np.round(records['pm25'].astype(np.float64), 1)
+        pm_10 = np.round(records['pm10'].astype(np.float64), 1)
+        series = (pm_25, pm_10, pm_aqi(pm_25, pm_10)) if with_aqi else (pm_25, pm_10)
+        # bin indices are binned into bins of unit width
+        binned = bin_series(bins, series, np.arange(n_bins + 1))
+        nonempty = np.flatnonzero(binned[0].count)
+        columns = [nonempty, binned[0].count[nonempty]]
+        for b in binned[:2]:
+            columns.extend([b.sum[nonempty], b.min[nonempty], b.max[nonempty]])
+        if with_aqi:
+            columns.append(binned[2].sum[nonempty].astype(np.int64))
+        return list(zip(*[c.tolist() for c in columns]))
+
+    @staticmethod
+    def _pm_bins(rows, n_bins, with_aqi):
+        n = np.zeros(n_bins)
+        sums = np.zeros((3, n_bins))
+        mins = np.full((2, n_bins), np.inf)
+        maxs = np.full((2, n_bins), -np.inf)
+        for row in rows:
+            i = row[0]
+            if i < 0 or i >= n_bins:
+                continue
+            n[i] += row[1]
+            sums[0, i] += row[2]
+            mins[0, i] = min(mins[0, i], row[3])
+            maxs[0, i] = max(maxs[0, i], row[4])
+            sums[1, i] += row[5]
+            mins[1, i] = min(mins[1, i], row[6])
+            maxs[1, i] = max(maxs[1, i], row[7])
+            if with_aqi:
+                sums[2, i] += row[8]
+        empty = n == 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums / n
+        means[:, empty] = np.nan
+        mins[:, empty] = np.nan
+        maxs[:, empty] = np.nan
+        return PmBins(n.astype(np.int64), means[0], mins[0], maxs[0],
+                      means[1], mins[1], maxs[1], means[2] if with_aqi else None)
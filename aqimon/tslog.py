@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import time
+import bisect
+import struct
+import datetime
+import threading
+
+from collections import OrderedDict
+
+import numpy as np
+
+from zope.interface import implementer  # @UnresolvedImport
+
+from twisted.application import service
+from twisted.internet import defer, task, threads
+from twisted.logger import Logger
+
+from aqimon.interfaces import IAqiStorage
+from aqimon.storage import PM_RECORD_DTYPE, PmColumns, PmSketches, bin_pm_records, \
+    sketch_pm_records, band_pm_sketches, DEFAULT_BAND_QUANTILES
+
+log = Logger()
+
+DEFAULT_FLUSH_INTERVAL = 300  # 5 min
+DEFAULT_RETENTION_INTERVAL = 86400  # 1 day
+DEFAULT_SKETCH_CACHE_SIZE = 62  # 2 months of daily segments
+
+
+@implementer(IAqiStorage)
+class PmLogStorage(service.Service):
+    '''
+    AQI-related data storage in append-only time series log.
+
+    PM measurement data are stored as fixed-size binary records in daily segment
+    files, ordered by timestamp. Segments are memory-mapped for reading, so range
+    lookups are binary searches over timestamps and return views of mapped files
+    without copying. Records are appended to segment right away and synced to disk
+    every C{flush_interval} seconds.
+
+    If C{retention} (in seconds) is set, segments older than it are periodically deleted.
+
+    Quantile sketches of completed segments are built on first use and kept in a cache
+    of up to C{sketch_cache_size} segments.
+
+    '''
+    name = 'aqi_storage'
+
+    # Segment time span (in seconds)
+    segment_span = 86400
+
+    segment_pattern = 'pm_data-%s.log'
+    segment_re = re.compile(r'^pm_data-(\d{8})\.log$')
+
+    record_format = struct.Struct('<qff')
+
+    # Quantile sketch bucket width (in seconds)
+    sketch_level = 3600
+
+    def __init__(self, log_dir, flush_interval=DEFAULT_FLUSH_INTERVAL, retention=None,
+                 retention_interval=DEFAULT_RETENTION_INTERVAL,
+                 sketch_cache_size=DEFAULT_SKETCH_CACHE_SIZE):
+        assert self.record_format.size == PM_RECORD_DTYPE.itemsize
+        self.log_dir = log_dir
+        self.flush_interval = flush_interval
+        self.retention = retention
+        self.retention_interval = retention_interval
+        # sorted list of segment numbers (days since epoch)
+        self._segments = []
+        # segment number -> (number of records, mapped records)
+        self._maps = {}
+        # segments list and maps are changed in reactor thread and read in worker threads,
+        # mapped records are unmapped only when no reader keeps a view of them
+        self._segments_lock = threading.Lock()
+        self._file = None
+        self._file_segment = None
+        self._last_tstamp = None
+        self._unsynced = 0
+        self._flush_call = None
+        self._retention_call = None
+        self.sketch_cache_size = sketch_cache_size
+        # segment number -> sketches of segment, for completed segments
+        self._sketches = OrderedDict()
+        self._sketches_lock = threading.Lock()
+
+    def segment_path(self, segment):
+        day = datetime.datetime.utcfromtimestamp(segment * self.segment_span)
+        return os.path.join(self.log_dir, self.segment_pattern % day.strftime('%Y%m%d'))
+
+    def _segment_of(self, tstamp):
+        return int(tstamp) // self.segment_span
+
+    def startService(self):
+        service.Service.startService(self)
+        if not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+        for filename in os.listdir(self.log_dir):
+            m = self.segment_re.match(filename)
+            if m is not None:
+                day = datetime.datetime.strptime(m.group(1), '%Y%m%d')
+                epoch_day = (day - datetime.datetime(1970, 1, 1)).days
+                self._segments.append(epoch_day * 86400 // self.segment_span)
+        self._segments.sort()
+        if self._segments:
+            path = self.segment_path(self._segments[-1])
+            size = os.path.getsize(path)
+            if size % self.record_format.size:
+                # drop partially written record
+                log.warn("Truncating partially written record in {path}", path=path)
+                with open(path, 'r+b') as f:
+                    f.truncate(size - size % self.record_format.size)
+            records = self._segment_records(self._segments[-1])
+            if len(records):
+                self._last_tstamp = int(records['tstamp'][-1])
+        self._flush_call = task.LoopingCall(self.flush)
+        self._flush_call.start(self.flush_interval, now=False)
+        if self.retention:
+            self._retention_call = task.LoopingCall(self.apply_retention)
+            self._retention_call.start(self.retention_interval, now=True)
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        service.Service.stopService(self)
+        for call in (self._flush_call, self._retention_call):
+            if call is not None and call.running:
+                call.stop()
+        yield self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def when_ready(self):
+        return defer.succeed(None)
+
+    def add_pm_data(self, tstamp, pm_25, pm_10):
+        '''
+        Append PM measurement data to log. Records not newer than the last
+        stored one are ignored, to keep the log ordered by timestamp.
+        '''
+        tstamp = int(tstamp)
+        if self._last_tstamp is not None and tstamp <= self._last_tstamp:
+            return
+        segment = self._segment_of(tstamp)
+        if segment != self._file_segment:
+            if self._file is not None:
+                f = self._file
+                self.flush().addBoth(lambda _: f.close())
+            self._file = open(self.segment_path(segment), 'ab', buffering=0)
+            self._file_segment = segment
+            with self._segments_lock:
+                if segment not in self._segments:
+                    bisect.insort(self._segments, segment)
+        self._file.write(self.record_format.pack(tstamp, pm_25, pm_10))
+        self._last_tstamp = tstamp
+        self._unsynced += 1
+
+    @property
+    def pending_count(self):
+        '''
+        Number of appended PM data records, not yet synced to disk.
+        '''
+        return self._unsynced
+
+    def flush(self):
+        '''
+        Sync appended PM data records to disk.
+
+        @return: a L{Deferred} which will fire when records are synced.
+        '''
+        if self._file is None or not self._unsynced:
+            return defer.succeed(None)
+        n, self._unsynced = self._unsynced, 0
+        d = threads.deferToThread(os.fsync, self._file.fileno())
+
+        def sync_failed(f):
+            self._unsynced += n
+            log.failure("Can't sync {n} PM data record(s)", f, n=n)
+
+        return d.addErrback(sync_failed)
+
+    def apply_retention(self):
+        '''
+        Delete segments older than retention horizon.
+        '''
+        horizon = self._segment_of(time.time()-self.retention)
+        while self._segments and self._segments[0] < horizon:
+            # segment is unlisted before its file is deleted, so readers don't map it anymore
+            with self._segments_lock:
+                segment = self._segments.pop(0)
+                self._maps.pop(segment, None)
+            with self._sketches_lock:
+                self._sketches.pop(segment, None)
+            try:
+                os.remove(self.segment_path(segment))
+            except OSError as e:
+                log.error("Can't delete segment: %s" % e)
+            else:
+                log.info("Deleted expired segment {path}", path=self.segment_path(segment))
+
+    def _list_segments(self, ts_start, ts_end):
+        '''
+        Get list of numbers of segments, which may have records with timestamps
+        in [ts_start, ts_end].
+        '''
+        with self._segments_lock:
+            first = bisect.bisect_left(self._segments, self._segment_of(ts_start))
+            last = bisect.bisect_right(self._segments, self._segment_of(ts_end))
+            return self._segments[first:last]
+
+    def _is_listed(self, segment):
+        # called with segments lock held
+        i = bisect.bisect_left(self._segments, segment)
+        return i < len(self._segments) and self._segments[i] == segment
+
+    def _segment_records(self, segment):
+        '''
+        Get memory-mapped segment records, or no records if segment is deleted.
+        '''
+        path = self.segment_path(segment)
+        with self._segments_lock:
+            if not self._is_listed(segment):
+                return np.empty(0, dtype=PM_RECORD_DTYPE)
+            try:
+                n = os.path.getsize(path) // self.record_format.size
+            except OSError:
+                n = 0
+            cached = self._maps.get(segment)
+            if cached is not None and cached[0] == n:
+                return cached[1]
+            if n:
+                records = np.memmap(path, dtype=PM_RECORD_DTYPE, mode='r', shape=(n,))
+            else:
+                records = np.empty(0, dtype=PM_RECORD_DTYPE)
+            self._maps[segment] = (n, records)
+            return records
+
+    def period_pm_records(self, ts_start, ts_end):
+        '''
+        Get PM measurement data records with timestamps in [ts_start, ts_end).
+
+        @return: list of records arrays, one per segment, ordered by timestamp. Arrays
+            are views of memory-mapped segment files.
+        '''
+        views = []
+        for segment in self._list_segments(ts_start, ts_end):
+            records = self._segment_records(segment)
+            tstamp = records['tstamp']
+            view = records[np.searchsorted(tstamp, ts_start):np.searchsorted(tstamp, ts_end)]
+            if len(view):
+                views.append(view)
+        return views
+
+    def last_period_pm_data(self, period):
+        '''
+        Get last PM measurement data for given period (in seconds).
+        '''
+        def to_rows(records):
+            # restore exact sensor values (0.1 ug/m^3 resolution) from float32 records
+            return [(tstamp, round(pm_25, 1), round(pm_10, 1))
+                    for tstamp, pm_25, pm_10 in records.tolist()]
+
+        ts_start = int(time.time()-period) + 1
+        ts_end = (self._last_tstamp or ts_start) + 1
+        return threads.deferToThread(self.period_pm_records, ts_start, ts_end) \
+            .addCallback(lambda views: [row for records in views for row in to_rows(records)])
+
+    def period_pm_columns(self, ts_start, ts_end):
+        '''
+        Get PM measurement data with timestamps in [ts_start, ts_end) as columns.
+
+        @return: a L{Deferred} which will fire a L{PmColumns}. If data are in a single
+            segment, columns are (strided) views of memory-mapped segment file, otherwise
+            every column is copied once.
+        '''
+        def to_columns(views):
+            if len(views) == 1:
+                records, = views
+                return PmColumns(records['tstamp'], records['pm25'], records['pm10'])
+            if not views:
+                views = [np.empty(0, dtype=PM_RECORD_DTYPE)]
+            return PmColumns(*[np.concatenate([records[field] for records in views])
+                               for field in ('tstamp', 'pm25', 'pm10')])
+
+        return threads.deferToThread(self.period_pm_records, int(ts_start), int(ts_end)) \
+            .addCallback(to_columns)
+
+    def binned_pm_data(self, ts_start, ts_end, n_bins, with_aqi=False):
+        '''
+        Get PM measurement data with timestamps in [ts_start, ts_end), aggregated
+        into C{n_bins} bins of equal width.
+
+        @return: a L{Deferred} which will fire a L{PmBins}.
+        '''
+        ts_start, ts_end = int(ts_start), int(ts_end)
+
+        def binned():
+            views = self.period_pm_records(ts_start, ts_end)
+            return bin_pm_records(views, ts_start, ts_end, n_bins, with_aqi)
+
+        return threads.deferToThread(binned)
+
+    def _segment_sketches(self, segment):
+        '''
+        Get quantile sketches of segment records, cached if segment is completed.
+        '''
+        with self._sketches_lock:
+            sketches = self._sketches.get(segment)
+            if sketches is not None:
+                self._sketches.move_to_end(segment)
+                return sketches
+        records = self._segment_records(segment)
+        sketches = sketch_pm_records(records['tstamp'], records['pm25'], records['pm10'],
+                                     self.sketch_level)
+        # records are appended to the last segment only, deleted segments aren't cached
+        with self._segments_lock:
+            completed = self._is_listed(segment) and segment < self._segments[-1]
+        if completed:
+            with self._sketches_lock:
+                self._sketches[segment] = sketches
+                while len(self._sketches) > self.sketch_cache_size:
+                    self._sketches.popitem(last=False)
+        return sketches
+
+    def banded_pm_data(self, ts_start, ts_end, n_bins, quantiles=DEFAULT_BAND_QUANTILES):
+        '''
+        Get means and quantile bands of PM measurement data and their AQI values with
+        timestamps in [ts_start, ts_end), aggregated into C{n_bins} bins of equal width.
+
+        @return: a L{Deferred} which will fire a L{PmBands}, or fail with L{ValueError}
+            if bin boundaries are not aligned to sketch buckets.
+        '''
+        ts_start, ts_end = int(ts_start), int(ts_end)
+        if ts_start % self.sketch_level or (ts_end-ts_start) % (n_bins*self.sketch_level):
+            return defer.fail(ValueError('Bins are not aligned to sketch buckets'))
+
+        def banded():
+            sketches = [self._segment_sketches(segment)
+                        for segment in self._list_segments(ts_start, ts_end)]
+            if sketches:
+                sketches = PmSketches(*[np.concatenate(c) for c in zip(*sketches)])
+            else:
+                sketches = sketch_pm_records([], [], [], self.sketch_level)
+            return band_pm_sketches(sketches, ts_start, ts_end, n_bins, quantiles)
+
+        return threads.deferToThread(banded)
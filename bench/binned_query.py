@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+'''
+Benchmark of binned PM data queries over synthetic PM data in a temporary SQLite
+database, at every plot window:
+
+ - C{python}: raw samples are fetched and binned in Python, like plots did before
+   binning was done by database;
+ - C{sql_raw}: raw samples are binned by database (bins not aligned to rollups);
+ - C{sql_rollup}: rollup buckets are binned by database (bins aligned to rollups,
+   like plots do), also C{with_aqi}, which reads AQI sums of quantile sketches.
+
+Bins are as wide as whole rollup buckets of the coarsest level giving at least 20 bins,
+with at most 48 bins.
+
+Usage::
+
+    python -m bench.binned_query [--polls 10,60,180] [--windows 1h,1d,30d] [--repeat 5]
+
+'''
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+from twisted.internet import defer, task
+
+from bench.pipeline import parse_duration, make_pm_rows, measure
+
+DEFAULT_POLLS = (10, 60, 180)
+DEFAULT_WINDOWS = ('1h', '1d', '30d')
+DEFAULT_REPEAT = 5
+MIN_BINS = 20
+MAX_BINS = 48
+
+
+def bin_width(window, levels):
+    level = max([level for level in levels if window // level >= MIN_BINS] or [min(levels)])
+    return level * -(-window // level // MAX_BINS)
+
+
+@defer.inlineCallbacks
+def run_window(storage, window, repeat):
+    from aqimon.binning import bin_series
+
+    width = bin_width(window, storage.rollup_levels)
+    n_bins = window // width
+    now = int(time.time())
+    # unaligned window for raw paths, aligned window (ending with current bin) for rollups
+    ts_start, ts_end = now - window, now
+    aligned_end = (now // width + 1) * width
+    aligned_start = aligned_end - window
+    assert storage.rollup_level(aligned_start, aligned_end, n_bins) is not None
+
+    @defer.inlineCallbacks
+    def python_binning():
+        pm_data = yield storage.last_period_pm_data(window)
+        ts, pm_25, pm_10 = (np.asarray(c) for c in zip(*pm_data))
+        bin_series(ts, (pm_10, pm_25), np.linspace(ts_start, ts_end, n_bins+1))
+
+    pm_data = yield storage.last_period_pm_data(window)
+    paths = [
+        ('python', python_binning),
+        ('sql_raw', lambda: storage.binned_pm_data(ts_start, ts_end, n_bins)),
+        ('sql_rollup', lambda: storage.binned_pm_data(aligned_start, aligned_end, n_bins)),
+        ('sql_raw_aqi',
+         lambda: storage.binned_pm_data(ts_start, ts_end, n_bins, with_aqi=True)),
+        ('sql_rollup_aqi',
+         lambda: storage.binned_pm_data(aligned_start, aligned_end, n_bins, with_aqi=True)),
+    ]
+    times = {}
+    for name, path in paths:
+        r = yield measure(path, repeat)
+        times[name] = r['median_s']
+    defer.returnValue((len(pm_data), n_bins, width, times))
+
+
+@defer.inlineCallbacks
+def run(args):
+    from db import DbSession
+    from aqimon.storage import AqiStorage
+
+    polls = [parse_duration(s) for s in args.polls.split(',')]
+    windows = [parse_duration(s) for s in args.windows.split(',')]
+    rng = np.random.default_rng(args.seed)
+    names = ('python', 'sql_raw', 'sql_rollup', 'sql_raw_aqi', 'sql_rollup_aqi')
+    print('%6s %8s %8s %5s %6s  %s' % ('poll', 'window', 'samples', 'bins', 'width',
+                                       ' '.join('%14s' % name for name in names)))
+    for poll_period in polls:
+        db_dir = tempfile.mkdtemp(prefix='aqimon-bench-')
+        try:
+            db_session = DbSession(os.path.join(db_dir, 'bench.sqlite'))
+            storage = AqiStorage(db_session, retention=None)
+            storage.startService()
+            yield storage.when_ready()
+            yield storage.import_pm_data(make_pm_rows(rng, int(time.time()), max(windows),
+                                                      poll_period))
+            for window in windows:
+                samples, n_bins, width, times = yield run_window(storage, window, args.repeat)
+                print('%6d %8d %8d %5d %6d  %s' % (
+                    poll_period, window, samples, n_bins, width,
+                    ' '.join('%11.2f ms' % (times[name] * 1000) for name in names)))
+            yield storage.stopService()
+            db_session.close()
+        finally:
+            shutil.rmtree(db_dir)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.binned_query')
+    parser.add_argument('--polls', default=','.join(str(p) for p in DEFAULT_POLLS),
+                        help='comma-separated sensor poll periods, in seconds '
+                        '(default: %(default)s)')
+    parser.add_argument('--windows', default=','.join(DEFAULT_WINDOWS),
+                        help='comma-separated plot periods, with m/h/d suffixes '
+                        '(default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='number of timed runs of every query (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='synthetic data random seed (default: %(default)s)')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    task.react(lambda reactor: run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+'''
+Round-trip checks of PM data export and import by L{aqimon.datatool}, over synthetic
+PM data in a temporary SQLite database with raw data retention, so part of the data
+are archived.
+
+For every format, all data are exported and imported back into the same database,
+which must not change stored data, archive, rollups and quantile sketches. Exported
+data are also imported into an empty database, which must export the same data.
+Failed checks are reported and make the script exit with non-zero status.
+
+Usage::
+
+    python -m bench.datatool_roundtrip [--formats csv,ndjson,npz] [--days 60]
+
+'''
+
+import io
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import traceback
+
+import numpy as np
+
+from twisted.internet import defer, task
+
+from bench.pipeline import make_pm_rows
+
+DEFAULT_FORMATS = ('csv', 'ndjson', 'npz')
+DEFAULT_DAYS = 60
+RETENTION_DAYS = 30
+IMPORT_CHUNK = 10000
+
+
+def check(condition, message, *args):
+    if not condition:
+        raise AssertionError(message % args)
+
+
+@defer.inlineCallbacks
+def open_storage(data_dir):
+    from db import DbSession
+    from aqimon.archive import PmArchive
+    from aqimon.storage import AqiStorage
+    storage = AqiStorage(DbSession(os.path.join(data_dir, 'db.sqlite')),
+                         retention=RETENTION_DAYS*86400,
+                         archive=PmArchive(os.path.join(data_dir, 'archive')))
+    yield storage.migrate()
+    defer.returnValue(storage)
+
+
+@defer.inlineCallbacks
+def storage_state(storage):
+    '''
+    Get numbers of stored and archived records, and total numbers of records
+    counted by rollups and sketches of every level.
+    '''
+    db_session = storage.db_session
+    stored = yield db_session.runQuery('SELECT count(*) FROM pm_data')
+    archived = len(storage.archive.read(0, 2**62))
+    rollups = yield db_session.runQuery(
+        'SELECT level, sum(n) FROM pm_rollup GROUP BY level ORDER BY level')
+    sketches = yield db_session.runQuery(
+        'SELECT level, sum(n) FROM pm_sketch GROUP BY level ORDER BY level')
+    defer.returnValue({'stored': stored[0][0], 'archived': archived,
+                       'rollups': [tuple(r) for r in rollups],
+                       'sketches': [tuple(r) for r in sketches]})
+
+
+def export_data(storage, fmt, path):
+    from aqimon import datatool
+    progress = datatool.Progress('exported', out=io.StringIO())
+    return storage.export_pm_data(0, 2**63-1, datatool.WRITERS[fmt](path, progress))
+
+
+@defer.inlineCallbacks
+def import_data(storage, fmt, path):
+    from aqimon import datatool
+    added = []
+    for rows in datatool.READERS[fmt](path, IMPORT_CHUNK):
+        n = yield storage.import_pm_data(rows)
+        added.append(n)
+    defer.returnValue(sum(added))
+
+
+@defer.inlineCallbacks
+def check_format(fmt, work_dir, rows):
+    source_dir = os.path.join(work_dir, 'source')
+    target_dir = os.path.join(work_dir, 'target')
+    os.makedirs(source_dir)
+    os.makedirs(target_dir)
+    source = yield open_storage(source_dir)
+    target = yield open_storage(target_dir)
+    try:
+        # import all data into database, then move expired ones to archive
+        source.retention = None
+        added = yield source.import_pm_data(rows)
+        check(added == len(rows), '%d record(s) of %d imported', added, len(rows))
+        source.retention = RETENTION_DAYS*86400
+        yield source.apply_retention()
+        before = yield storage_state(source)
+        check(before['archived'] > 0, 'no archived records')
+        check(before['stored'] + before['archived'] == len(rows),
+              '%d stored and %d archived record(s) of %d', before['stored'],
+              before['archived'], len(rows))
+        for level, n in before['rollups'] + before['sketches']:
+            check(n == len(rows), 'level %d counts %d record(s) of %d', level, n, len(rows))
+
+        exported = os.path.join(work_dir, 'exported.' + fmt)
+        yield export_data(source, fmt, exported)
+        added = yield import_data(source, fmt, exported)
+        check(added == 0, '%d exported record(s) imported again', added)
+        after = yield storage_state(source)
+        check(after == before, 'storage changed by import of exported data: %r != %r',
+              after, before)
+
+        # expired data are moved right to archive on import
+        added = yield import_data(target, fmt, exported)
+        check(added == len(rows), '%d record(s) of %d imported into empty database',
+              added, len(rows))
+        imported = yield storage_state(target)
+        check(imported == before, 'imported storage differs: %r != %r', imported, before)
+        reexported = os.path.join(work_dir, 'reexported.' + fmt)
+        yield export_data(target, fmt, reexported)
+        with open(exported, 'rb') as f1, open(reexported, 'rb') as f2:
+            check(f1.read() == f2.read(), 're-exported data differ')
+    finally:
+        source.db_session.close()
+        target.db_session.close()
+
+
+@defer.inlineCallbacks
+def run(args):
+    now = int(time.time())
+    rows = make_pm_rows(np.random.default_rng(args.seed), now - 300, args.days * 86400, 60)
+    failed = 0
+    for fmt in args.formats.split(','):
+        work_dir = tempfile.mkdtemp(prefix='aqimon-roundtrip-')
+        try:
+            yield check_format(fmt, work_dir, rows)
+        except Exception:
+            failed += 1
+            print('%-8s FAIL' % fmt)
+            traceback.print_exc(file=sys.stdout)
+        else:
+            print('%-8s ok' % fmt)
+        finally:
+            shutil.rmtree(work_dir)
+    if failed:
+        raise SystemExit('%d check(s) failed' % failed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.datatool_roundtrip')
+    parser.add_argument('--formats', default=','.join(DEFAULT_FORMATS),
+                        help='comma-separated data file formats (default: %(default)s)')
+    parser.add_argument('--days', type=int, default=DEFAULT_DAYS,
+                        help='number of days of data, %d of them are kept in database '
+                        '(default: %%(default)s)' % RETENTION_DAYS)
+    parser.add_argument('--seed', type=int, default=0,
+                        help='synthetic data random seed (default: %(default)s)')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    task.react(lambda reactor: run(args))
+
+
+if __name__ == '__main__':
+    main()
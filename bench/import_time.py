@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+'''
+Import time benchmark of application modules, driven by C{python -X importtime}.
+
+Each module is imported in a fresh interpreter. Reports wall time of import (best
+of several runs), number of imported modules and the heaviest top-level packages.
+With C{--check}, fails if twistd plugin discovery loads heavy dependencies.
+
+Usage::
+
+    python -m bench.import_time [--runs 5] [--top 5] [--check] [module ...]
+
+'''
+
+import sys
+import argparse
+import subprocess
+
+from collections import defaultdict
+
+DEFAULT_RUNS = 5
+DEFAULT_TOP = 5
+
+DEFAULT_MODULES = (
+    'twisted.plugins.bot_plugin',
+    'aqimon',
+    'aqimon.storage',
+    'aqimon.monitor',
+    'aqimon.plot',
+    'aqimon.pilrender',
+    'aqimon.mplrender',
+)
+
+# Module to check and dependencies it must not load
+LIGHT_MODULE = 'twisted.plugins.bot_plugin'
+HEAVY_MODULES = ('numpy', 'matplotlib', 'PIL', 'serial', 'babel', 'TelegramBot',
+                 'TelegramBotAPI', 'mqtt', 'aqimon.storage', 'aqimon.plot')
+
+MARK = '--- import benchmark ---'
+
+
+def import_time(module, runs):
+    # wall time without -X importtime overhead
+    code = ('import time; t = time.perf_counter(); import %s; '
+            'print(time.perf_counter() - t)' % module)
+    times = []
+    for _ in range(runs):
+        out = subprocess.check_output([sys.executable, '-c', code])
+        times.append(float(out))
+    return min(times)
+
+
+def import_tree(module):
+    '''
+    Get imported modules of given module with their self times, in microseconds.
+    '''
+    code = 'import sys; sys.stderr.write(%r); import %s' % (MARK + '\n', module)
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    lines = proc.stderr.split(MARK + '\n', 1)[1].splitlines()
+    modules = {}
+    for line in lines:
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = int(self_us)
+    return modules
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.import_time')
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES,
+                        help='modules to import (default: application modules)')
+    parser.add_argument('--runs', type=int, default=DEFAULT_RUNS,
+                        help='number of import runs (default: %(default)s)')
+    parser.add_argument('--top', type=int, default=DEFAULT_TOP,
+                        help='number of heaviest packages to show (default: %(default)s)')
+    parser.add_argument('--check', action='store_true',
+                        help='fail if %s loads heavy dependencies' % LIGHT_MODULE)
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    print('%-28s %10s %8s  %s' % ('module', 'time, ms', 'modules', 'heaviest packages, ms'))
+    for module in args.modules:
+        modules = import_tree(module)
+        packages = defaultdict(int)
+        for name, self_us in modules.items():
+            packages[name.split('.')[0]] += self_us
+        heaviest = sorted(packages.items(), key=lambda p: p[1], reverse=True)[:args.top]
+        print('%-28s %10.1f %8d  %s' % (
+            module, import_time(module, args.runs) * 1000, len(modules),
+            ', '.join('%s %.1f' % (name, us / 1000.) for name, us in heaviest)))
+
+    if args.check:
+        loaded = [m for m in import_tree(LIGHT_MODULE)
+                  if any(m == h or m.startswith(h + '.') for h in HEAVY_MODULES)]
+        if loaded:
+            sys.exit('%s loads heavy modules: %s' % (LIGHT_MODULE, ', '.join(sorted(loaded))))
+        print('%s loads no heavy modules' % LIGHT_MODULE)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+'''
+Benchmark of plot pipeline stages: storage queries, binning, AQI conversion, plot
+rendering and PNG encoding, over synthetic PM data in a temporary SQLite database.
+
+Every stage is timed separately (median and best of several runs) and its peak
+memory allocation is recorded by a separate run under C{tracemalloc}. Results are
+written as JSON, so runs can be compared with C{--compare}.
+
+Usage::
+
+    python -m bench.pipeline [--polls 10,60,180] [--windows 1h,1d,7d,30d,90d]
+                             [--backends pillow,matplotlib] [--repeat 5] [--output FILE]
+    python -m bench.pipeline --compare BASELINE.json RESULTS.json
+
+'''
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+
+import numpy as np
+
+from twisted.internet import defer, task
+
+DEFAULT_POLLS = (10, 60, 180)
+DEFAULT_WINDOWS = ('1h', '1d', '7d', '30d', '90d')
+DEFAULT_BACKENDS = ('pillow', 'matplotlib')
+DEFAULT_REPEAT = 5
+DEFAULT_BINS = 48
+
+TIME_UNITS = {'m': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_duration(s):
+    if s[-1] in TIME_UNITS:
+        return int(s[:-1]) * TIME_UNITS[s[-1]]
+    return int(s)
+
+
+def make_pm_rows(rng, ts_end, window, poll_period):
+    '''
+    Generate PM measurement records for given time window, sampled every
+    C{poll_period} seconds (with jitter) and rounded to sensor resolution.
+    '''
+    ts = np.arange(ts_end - window, ts_end, poll_period)
+    if poll_period >= 4:
+        ts += rng.integers(0, poll_period // 4, len(ts))
+    # slowly changing background level with noise, within AQI range
+    level = 20 + 15 * np.sin(ts / 43200. * np.pi)
+    pm_25 = np.clip(np.round(level + rng.gamma(2., 5., len(ts)), 1), 0, 500)
+    pm_10 = np.clip(np.round(pm_25 * 1.6 + rng.gamma(2., 3., len(ts)), 1), 0, 604)
+    return list(zip(ts.tolist(), pm_25.tolist(), pm_10.tolist()))
+
+
+@defer.inlineCallbacks
+def measure(stage, repeat):
+    '''
+    Time stage function (which may return a L{Deferred}) and measure its peak
+    memory allocation.
+
+    @return: a L{Deferred} which will fire with stage results dict.
+    '''
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        yield defer.maybeDeferred(stage)
+        times.append(time.perf_counter() - started)
+    tracemalloc.start()
+    try:
+        yield defer.maybeDeferred(stage)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    defer.returnValue({'median_s': float(np.median(times)), 'min_s': min(times),
+                       'peak_kb': peak // 1024})
+
+
+def png_encoder(png):
+    # encode the same raster as rendered plot, like both renderers do
+    from PIL import Image
+    image = Image.open(io.BytesIO(png))
+    image.load()
+
+    def encode():
+        buf = io.BytesIO()
+        image.save(buf, format='PNG')
+        return buf.getvalue()
+    return encode
+
+
+@defer.inlineCallbacks
+def run_scenario(storage, poll_period, window, backends, repeat):
+    from aqimon import aqicalc
+    from aqimon.binning import bin_series
+    from aqimon.plot import AqiPlot
+    from aqimon.render import PlotSpec, render_plot
+
+    ts_end = time.time()
+    ts_start = ts_end - window
+    stages = {}
+    stages['query'] = yield measure(lambda: storage.last_period_pm_data(window), repeat)
+    stages['binned_query'] = yield measure(
+        lambda: storage.binned_pm_data(ts_start, ts_end, DEFAULT_BINS-1), repeat)
+
+    pm_data = yield storage.last_period_pm_data(window)
+    ts, pm_25, pm_10 = (np.asarray(c) for c in zip(*pm_data)) if pm_data else \
+        (np.zeros(0),) * 3
+    # raw samples binned in memory, like recent data history does
+    ts_bins = np.linspace(ts_start, ts_end, DEFAULT_BINS)
+    stages['binning'] = yield measure(lambda: bin_series(ts, (pm_10, pm_25), ts_bins),
+                                      repeat)
+    stages['aqi'] = yield measure(lambda: aqicalc.to_aqi(pm_25, pm_10), repeat)
+
+    aqi_bins = bin_series(ts, (aqicalc.to_aqi(pm_25, pm_10),), ts_bins)[0].mean
+    colors = [AqiPlot.aqi_colors[level]
+              for level in aqicalc.to_aqi_level(np.nan_to_num(aqi_bins))]
+    spec = PlotSpec(ts_bins, [aqi_bins], ts_start, ts_end, DEFAULT_BINS, [colors],
+                    [None], 'Daily AQI values', 'AQI')
+    for backend in backends:
+        render_plot(spec, backend)  # load plotting library and create template
+        stages['render_' + backend] = yield measure(lambda: render_plot(spec, backend),
+                                                    repeat)
+        stages['png_encode_' + backend] = yield measure(
+            png_encoder(render_plot(spec, backend)), repeat)
+
+    defer.returnValue({'poll_period': poll_period, 'window': window,
+                       'samples': len(pm_data), 'stages': stages})
+
+
+@defer.inlineCallbacks
+def run(args):
+    from db import DbSession
+    from aqimon.storage import AqiStorage
+
+    polls = [parse_duration(s) for s in args.polls.split(',')]
+    windows = [parse_duration(s) for s in args.windows.split(',')]
+    backends = [b for b in args.backends.split(',') if b]
+    rng = np.random.default_rng(args.seed)
+    results = []
+    print('%6s %8s %8s  %s' % ('poll', 'window', 'samples', 'stage median, ms (peak, KiB)'),
+          file=sys.stderr)
+    for poll_period in polls:
+        db_dir = tempfile.mkdtemp(prefix='aqimon-bench-')
+        try:
+            db_session = DbSession(os.path.join(db_dir, 'bench.sqlite'))
+            storage = AqiStorage(db_session, retention=None)
+            storage.startService()
+            yield storage.when_ready()
+            yield storage.import_pm_data(make_pm_rows(rng, int(time.time()), max(windows),
+                                                      poll_period))
+            for window in windows:
+                r = yield run_scenario(storage, poll_period, window, backends, args.repeat)
+                results.append(r)
+                print('%6d %8d %8d  %s' % (
+                    poll_period, window, r['samples'],
+                    ', '.join('%s %.2f (%d)' % (name, s['median_s'] * 1000, s['peak_kb'])
+                              for name, s in r['stages'].items())), file=sys.stderr)
+            yield storage.stopService()
+            db_session.close()
+        finally:
+            shutil.rmtree(db_dir)
+
+    import resource
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'args': vars(args),
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+def compare(baseline_file, results_file):
+    '''
+    Print stage time ratios of two benchmark runs.
+    '''
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    with open(results_file) as f:
+        results = json.load(f)
+    old = {(r['poll_period'], r['window']): r['stages'] for r in baseline['results']}
+    print('%6s %8s %-24s %12s %12s %8s' % ('poll', 'window', 'stage', 'old, ms', 'new, ms',
+                                          'ratio'))
+    for r in results['results']:
+        old_stages = old.get((r['poll_period'], r['window']), {})
+        for name, s in r['stages'].items():
+            if name not in old_stages:
+                continue
+            t_old, t_new = old_stages[name]['median_s'], s['median_s']
+            print('%6d %8d %-24s %12.2f %12.2f %7.2fx' % (
+                r['poll_period'], r['window'], name, t_old * 1000, t_new * 1000,
+                t_new / t_old if t_old else float('nan')))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.pipeline')
+    parser.add_argument('--polls', default=','.join(str(p) for p in DEFAULT_POLLS),
+                        help='comma-separated sensor poll periods, in seconds '
+                        '(default: %(default)s)')
+    parser.add_argument('--windows', default=','.join(DEFAULT_WINDOWS),
+                        help='comma-separated plot periods, with m/h/d suffixes '
+                        '(default: %(default)s)')
+    parser.add_argument('--backends', default=','.join(DEFAULT_BACKENDS),
+                        help='comma-separated plot renderer backends (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='number of timed runs of every stage (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='synthetic data random seed (default: %(default)s)')
+    parser.add_argument('--output', '-o', help='JSON results file (default: stdout)')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'RESULTS'),
+                        help='compare two JSON results files')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    task.react(lambda reactor: run(args))
+
+
+if __name__ == '__main__':
+    main()
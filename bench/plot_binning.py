@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+'''
+Micro-benchmark of plot data binning: per-bin masks vs. single-pass bin_series().
+
+Usage::
+
+    python -m bench.plot_binning [--sizes 10000,100000,1000000,10000000] [--bins 48]
+
+'''
+
+import sys
+import time
+import argparse
+
+import numpy as np
+
+from aqimon.binning import bin_series
+
+DEFAULT_SIZES = (10000, 100000, 1000000, 10000000)
+DEFAULT_BINS = 48
+
+
+def masked_binning(ts, series, ts_bins):
+    # former AqiPlot.plot_data() binning
+    d_bins = np.digitize(ts, ts_bins)
+    data_bins = []
+    for d in series:
+        b = []
+        d = np.array(d)
+        for i in range(1, len(ts_bins)):
+            d_bin_i = d[d_bins == i]
+            if len(d_bin_i) > 0:
+                b.append(np.mean(d_bin_i))
+            else:
+                b.append(float('nan'))
+        data_bins.append(b)
+    return data_bins
+
+
+def best_time(f, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = f(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.plot_binning')
+    parser.add_argument('--sizes', default=','.join(str(n) for n in DEFAULT_SIZES),
+                        help='comma-separated sample counts (default: %(default)s)')
+    parser.add_argument('--bins', type=int, default=DEFAULT_BINS,
+                        help='number of bins (default: %(default)s)')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    rng = np.random.default_rng(0)
+    ts_bins = np.linspace(0, 86400, args.bins + 1)
+    print('%10s %12s %12s %8s' % ('samples', 'masked, s', 'vector, s', 'speedup'))
+    for n in [int(s) for s in args.sizes.split(',')]:
+        ts = np.sort(rng.uniform(0, 86400, n))
+        series = (rng.integers(0, 1000, n) / 10., rng.integers(0, 1000, n) / 10.)
+        t_masked, expected = best_time(masked_binning, ts, series, ts_bins)
+        t_vector, bins = best_time(bin_series, ts, series, ts_bins)
+        for b, e in zip(bins, expected):
+            assert np.array_equal(b.mean, np.array(e), equal_nan=True)
+        print('%10d %12.4f %12.4f %7.1fx' % (n, t_masked, t_vector, t_masked / t_vector))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+'''
+Benchmark of "Refresh" button latency against a local fake Telegram API, which
+answers every method after network round trip time, plus upload time of photos.
+
+Refresh is handled either like before messages were edited in place (callback query
+answered after command, then old message deleted and new one sent), or by
+L{Bot.on_callback_query}. Both text (C{/aqi}) and plot (C{/aqi_daily}) refreshes are
+measured, with changed and unchanged content. Time is simulated.
+
+Usage::
+
+    python -m bench.refresh_latency [--rtt 0.1] [--uplink 1000000] [--render 0.3]
+                                    [--image-size 60000]
+
+'''
+
+import io
+import sys
+import json
+import time
+import argparse
+import builtins
+
+from twisted.internet import defer, task
+
+from TelegramBotAPI.types.methods import answerCallbackQuery, deleteMessage, Method
+
+from telegram.bot import Bot
+from telegram.methods import editMessageText, editMessageMedia
+
+
+class FakePhotoSize(object):
+    def __init__(self, file_id):
+        self.file_id = file_id
+
+
+class FakeMessage(object):
+    def __init__(self, chat_id, message_id, content=None, file_id=None):
+        self.chat = FakeChat(chat_id)
+        self.message_id = message_id
+        self.content = content
+        self.photo = [FakePhotoSize(file_id)] if file_id is not None else None
+
+
+class FakeChat(object):
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+
+class FakeCallbackQuery(object):
+    def __init__(self, query_id, data, message):
+        self.id = query_id
+        self.data = data
+        self.message = message
+
+
+class FakeTelegramApi(object):
+    '''
+    Fake Telegram API: every method takes C{rtt} seconds, photo uploads take extra
+    time at C{uplink} bytes per second. Edits to the same content fail with
+    "message is not modified" error, like Telegram does.
+    '''
+    def __init__(self, clock, rtt, uplink):
+        self.clock = clock
+        self.rtt = rtt
+        self.uplink = uplink
+        self.calls = []
+        self.uploaded = 0
+        self._messages = {}
+        self._next_id = 1
+
+    @staticmethod
+    def _content(method):
+        '''
+        Get message text, photo file_id or uploaded photo data.
+        '''
+        if isinstance(method, editMessageMedia):
+            media = json.loads(method.media)['media']
+            return method.photo.getvalue() if media.startswith('attach://') else media
+        try:
+            return method.text
+        except KeyError:
+            pass
+        photo = method.photo
+        return photo.getvalue() if hasattr(photo, 'getvalue') else photo
+
+    def send(self, method):
+        self.calls.append(type(method).__name__)
+        delay = self.rtt
+        file_id = None
+        if isinstance(method, (answerCallbackQuery, deleteMessage)):
+            if isinstance(method, deleteMessage):
+                self._messages.pop(method.message_id, None)
+            result = True
+        else:
+            content = self._content(method)
+            if isinstance(content, bytes):
+                delay += len(content) / float(self.uplink)
+                self.uploaded += len(content)
+                file_id = 'file-%d' % hash(content)
+            elif content is not None and content.startswith('file-'):
+                file_id = content
+            if isinstance(method, (editMessageText, editMessageMedia)):
+                message_id = method.message_id
+                if self._messages.get(message_id) in (content, file_id):
+                    return task.deferLater(self.clock, delay, self._not_modified)
+            else:
+                message_id = self._next_id
+                self._next_id += 1
+            self._messages[message_id] = file_id if file_id is not None else content
+            result = FakeMessage(method.chat_id, message_id, content, file_id)
+        return task.deferLater(self.clock, delay, lambda: result)
+
+    @staticmethod
+    def _not_modified():
+        raise Exception('Bad Request: message is not modified')
+
+
+class FakeL10nSupport(object):
+    locale = 'en'
+
+
+class FakeAqiMonitor(object):
+    def __init__(self):
+        self.pm_timestamp = time.time()
+        self.aqi = 42
+        self.aqi_level = 0
+
+
+class FakeAqiPlot(object):
+    def __init__(self, clock, render, image_size):
+        self.clock = clock
+        self.render = render
+        self.image = b'\x89PNG' + b'\0' * image_size
+
+    def plot_daily_aqi_data(self):
+        def image():
+            buf = io.BytesIO(self.image)
+            buf.name = 'plot.png'
+            return buf
+        return task.deferLater(self.clock, self.render, image)
+
+
+@defer.inlineCallbacks
+def replace_refresh(bot, callback_query):
+    '''
+    Handle refresh like before messages were edited in place.
+    '''
+    cmd = callback_query.data
+    msg = callback_query.message
+    cmd_result = yield bot.on_command(cmd, cmd_msg=msg)
+
+    m = answerCallbackQuery()
+    m.callback_query_id = callback_query.id
+    yield bot.send_method(m)
+
+    m = deleteMessage()
+    m.chat_id = msg.chat.id
+    m.message_id = msg.message_id
+    yield bot.send_method(m)
+
+    if not isinstance(cmd_result, Method):
+        cmd_result = bot.cmd_response(msg.chat.id, cmd_result, cmd)
+    yield bot.send_method(cmd_result)
+
+
+def run_case(args, mode, cmd, changed):
+    clock = task.Clock()
+    api = FakeTelegramApi(clock, args.rtt, args.uplink)
+    aqi_monitor = FakeAqiMonitor()
+    aqi_plot = FakeAqiPlot(clock, args.render, args.image_size)
+    bot = Bot(FakeL10nSupport(), aqi_plot)
+    bot.aqi_monitor = aqi_monitor
+    bot.send_now = api.send
+    chat = FakeChat(1)
+
+    def run(d):
+        done = []
+        d.addBoth(done.append)
+        while not done:
+            clock.advance(min(c.getTime() for c in clock.getDelayedCalls()) - clock.seconds())
+        if isinstance(done[0], Exception) or hasattr(done[0], 'raiseException'):
+            done[0].raiseException()
+        return done[0]
+
+    # message being refreshed, sent in response to command
+    sent = run(defer.maybeDeferred(bot.on_command, cmd, cmd_msg=FakeMessage(chat.id, 0))
+               .addCallback(bot.send_method))
+    if changed:
+        aqi_monitor.aqi += 1
+        aqi_plot.image += b'\1'
+
+    api.calls = []
+    api.uploaded = 0
+    started = clock.seconds()
+    answered = []
+    send = bot.send_now
+
+    def send_now(method):
+        d = send(method)
+        if isinstance(method, answerCallbackQuery):
+            d.addCallback(lambda r: answered.append(clock.seconds()-started) or r)
+        return d
+
+    bot.send_now = send_now
+    query = FakeCallbackQuery('q', cmd, FakeMessage(chat.id, sent.message_id))
+    if mode == 'replace':
+        run(replace_refresh(bot, query))
+    else:
+        run(bot.on_callback_query(query))
+    return {'mode': mode, 'cmd': cmd, 'changed': changed, 'answered_s': answered[0],
+            'updated_s': clock.seconds()-started, 'calls': api.calls,
+            'uploaded': api.uploaded}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.refresh_latency')
+    parser.add_argument('--rtt', type=float, default=0.1,
+                        help='Telegram API round trip time, s (default: %(default)s)')
+    parser.add_argument('--uplink', type=float, default=1000000,
+                        help='upload rate, bytes/s (default: %(default)s)')
+    parser.add_argument('--render', type=float, default=0.3,
+                        help='plot rendering time, s (default: %(default)s)')
+    parser.add_argument('--image-size', type=int, default=60000,
+                        help='plot image size, bytes (default: %(default)s)')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    if not hasattr(builtins, '_'):
+        builtins._ = lambda s: s
+
+    print('%-10s %-10s %-8s %9s %9s %9s  %s' % ('cmd', 'content', 'mode', 'answer, s',
+                                              'update, s', 'uploaded', 'calls'))
+    for cmd in ('aqi', 'aqi_daily'):
+        for changed in (True, False):
+            for mode in ('replace', 'edit'):
+                r = run_case(args, mode, cmd, changed)
+                print('%-10s %-10s %-8s %9.2f %9.2f %9d  %s' % (
+                    cmd, 'changed' if changed else 'unchanged', mode, r['answered_s'],
+                    r['updated_s'], r['uploaded'], ', '.join(r['calls'])))
+
+
+if __name__ == '__main__':
+    main()
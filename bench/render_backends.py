@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+'''
+Comparison of plot renderer backends: import time, render time and memory usage.
+
+Each backend is measured in a fresh interpreter, so import costs and memory usage
+are not affected by other backend.
+
+Usage::
+
+    python -m bench.render_backends [--plots 200] [--backend matplotlib --backend pillow]
+
+'''
+
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+import numpy as np
+
+from aqimon.render import BACKENDS
+
+DEFAULT_PLOTS = 200
+
+
+def measure(backend, plots):
+    from bench.render_soak import rss_kb, make_spec
+
+    rss_start = rss_kb()
+    started = time.perf_counter()
+    from aqimon.render import render_plot, make_renderer
+    make_renderer(backend)
+    import_time = time.perf_counter() - started
+    rss_import = rss_kb()
+
+    rng = np.random.default_rng(0)
+    specs = [make_spec(rng, i) for i in range(plots)]
+    started = time.perf_counter()
+    render_plot(specs[0], backend)
+    first_time = time.perf_counter() - started
+    times = []
+    sizes = []
+    for spec in specs[1:]:
+        started = time.perf_counter()
+        sizes.append(len(render_plot(spec, backend)))
+        times.append(time.perf_counter() - started)
+    return {
+        'backend': backend,
+        'import_ms': import_time * 1000,
+        'first_render_ms': first_time * 1000,
+        'render_ms': float(np.mean(times)) * 1000,
+        'render_p95_ms': float(np.percentile(times, 95)) * 1000,
+        'png_kb': float(np.mean(sizes)) / 1024,
+        'import_rss_kb': rss_import - rss_start,
+        'rss_kb': rss_kb(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.render_backends')
+    parser.add_argument('--plots', type=int, default=DEFAULT_PLOTS,
+                        help='number of plots to render (default: %(default)s)')
+    parser.add_argument('--backend', action='append', choices=BACKENDS,
+                        help='backend to measure (default: all)')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    if args.child:
+        json.dump(measure(args.backend[0], args.plots), sys.stdout)
+        return
+
+    print('%-12s %10s %10s %10s %10s %8s %12s %10s' % (
+        'backend', 'import, ms', 'first, ms', 'mean, ms', 'p95, ms', 'png, KiB',
+        'import, KiB', 'rss, KiB'))
+    for backend in args.backend or BACKENDS:
+        out = subprocess.check_output([sys.executable, '-m', 'bench.render_backends',
+                                       '--child', '--backend', backend,
+                                       '--plots', str(args.plots)])
+        r = json.loads(out)
+        print('%-12s %10.1f %10.1f %10.2f %10.2f %8.1f %12d %10d' % (
+            backend, r['import_ms'], r['first_render_ms'], r['render_ms'],
+            r['render_p95_ms'], r['png_kb'], r['import_rss_kb'], r['rss_kb']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+'''
+Soak test of plot rendering: renders many plots and reports process memory usage.
+
+Usage::
+
+    python -m bench.render_soak [--plots 100000] [--report 1000]
+
+'''
+
+import sys
+import time
+import argparse
+
+import numpy as np
+
+from aqimon.render import PlotSpec, render_plot
+
+DEFAULT_PLOTS = 100000
+DEFAULT_REPORT = 1000
+
+
+def rss_kb():
+    # current (not peak) resident set size
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * 4
+
+
+def make_spec(rng, i):
+    n_bins, period = (48, 86400) if i % 2 else (20, 3600)
+    ts_end = time.time()
+    ts_bins = np.linspace(ts_end-period, ts_end, n_bins)
+    if i % 4 < 2:
+        data_bins = [rng.random(n_bins-1) * 150, rng.random(n_bins-1) * 80]
+        return PlotSpec(ts_bins, data_bins, ts_end-period, ts_end, n_bins,
+                        ['steelblue', 'firebrick'], ['PM10', 'PM2.5'],
+                        'PM concentrations', '$\\mu g/m^3$')
+    aqi = rng.random(n_bins-1) * 200
+    colors = ['green' if a <= 50 else 'gold' if a <= 100 else 'orange' for a in aqi]
+    return PlotSpec(ts_bins, [aqi], ts_end-period, ts_end, n_bins,
+                    [colors], [None], 'AQI values', 'AQI')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.render_soak')
+    parser.add_argument('--plots', type=int, default=DEFAULT_PLOTS,
+                        help='number of plots to render (default: %(default)s)')
+    parser.add_argument('--report', type=int, default=DEFAULT_REPORT,
+                        help='report memory usage every this number of plots '
+                        '(default: %(default)s)')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    rng = np.random.default_rng(0)
+    started = time.perf_counter()
+    print('%10s %10s %10s' % ('plots', 'rss, KiB', 'ms/plot'))
+    for i in range(1, args.plots+1):
+        render_plot(make_spec(rng, i))
+        if i % args.report == 0 or i == args.plots:
+            elapsed = time.perf_counter() - started
+            print('%10d %10d %10.1f' % (i, rss_kb(), elapsed * 1000 / i))
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+'''
+Benchmark of outbound Telegram send scheduling against a local fake Telegram API,
+which enforces rate limits like Telegram does and fails sends exceeding them with
+"Too Many Requests: retry after N" errors.
+
+Scenario is an air quality alert: every subscribed chat gets a bulk notification,
+while many chats send commands (some of them pressing refresh repeatedly). Sends
+are made directly (dropping throttled messages, or retrying them after requested
+time) or by L{SendScheduler}. Time is simulated, so run takes only a few seconds.
+
+Usage::
+
+    python -m bench.send_scheduler [--chats 200] [--groups 20] [--commands 300]
+                                   [--refreshes 5] [--subscribers 500]
+
+'''
+
+import sys
+import math
+import argparse
+import collections
+
+import numpy as np
+
+from twisted.internet import defer, task
+
+from telegram.scheduler import SendScheduler, TokenBucket, PRIORITY_INTERACTIVE, \
+    PRIORITY_BULK, retry_after
+
+API_LATENCY = 0.08
+
+
+class FakeMethod(object):
+    def __init__(self, chat_id, kind, sent):
+        self.chat_id = chat_id
+        self.kind = kind
+        self.sent = sent
+
+
+class FakeTelegramApi(object):
+    '''
+    Fake Telegram API: up to 30 messages in any second overall, one message per
+    second in private chat (with bursts up to 5 messages) and 20 messages in any
+    minute in group chat.
+    '''
+    def __init__(self, clock, latency=API_LATENCY):
+        self.clock = clock
+        self.latency = latency
+        self.calls = 0
+        self.throttled = 0
+        self._global = collections.deque()
+        self._groups = collections.defaultdict(collections.deque)
+        self._chats = {}
+
+    @staticmethod
+    def _window_wait(sent, now, limit, window):
+        while sent and sent[0] <= now-window:
+            sent.popleft()
+        return sent[0]+window-now if len(sent) >= limit else 0
+
+    def send(self, method):
+        self.calls += 1
+        now = self.clock.seconds()
+        chat_id = method.chat_id
+        wait = self._window_wait(self._global, now, 30, 1)
+        if chat_id < 0:
+            wait = max(wait, self._window_wait(self._groups[chat_id], now, 20, 60))
+        else:
+            bucket = self._chats.setdefault(chat_id, TokenBucket(1, 5, now))
+            wait = max(wait, bucket.delay(now))
+        d = defer.Deferred()
+        if wait > 0:
+            self.throttled += 1
+            error = Exception('Too Many Requests: retry after %d' % math.ceil(wait))
+            self.clock.callLater(self.latency, d.errback, error)
+            return d
+        self._global.append(now)
+        if chat_id < 0:
+            self._groups[chat_id].append(now)
+        else:
+            self._chats[chat_id].take(now)
+        self.clock.callLater(self.latency, d.callback, method)
+        return d
+
+
+def retrying(send, clock):
+    '''
+    Wrap send function to retry throttled sends after requested time.
+    '''
+    def send_retrying(method):
+        def throttled(f):
+            delay = retry_after(f)
+            if delay is None:
+                return f
+            return task.deferLater(clock, delay, send_retrying, method)
+        return send(method).addErrback(throttled)
+    return send_retrying
+
+
+def make_sends(rng, args):
+    '''
+    Generate (time, chat_id, kind, merge_key) sends of alert scenario.
+    '''
+    chats = list(range(1, args.chats+1)) + list(range(-1, -args.groups-1, -1))
+    sends = [(0., chat_id, 'bulk', None)
+             for chat_id in rng.choice(chats, min(args.subscribers, len(chats)),
+                                       replace=False).tolist()]
+    for i in range(args.commands):
+        t = float(rng.uniform(0, 10))
+        chat_id = int(rng.choice(chats))
+        n = args.refreshes if i % 10 == 0 else 1
+        for k in range(n):
+            sends.append((t + 0.3*k, chat_id, 'interactive', 'aqi_daily'))
+    sends.sort(key=lambda s: s[0])
+    return sends
+
+
+def run_mode(mode, sends):
+    clock = task.Clock()
+    api = FakeTelegramApi(clock)
+    if mode == 'scheduler':
+        scheduler = SendScheduler(api.send, clock=clock)
+        scheduler.startService()
+    send = retrying(api.send, clock) if mode == 'retry' else api.send
+    latency = {'interactive': [], 'bulk': []}
+    lost = collections.Counter()
+    merged = collections.Counter()
+
+    def sent(result, kind, started):
+        if result is None:
+            merged[kind] += 1
+        else:
+            latency[kind].append(clock.seconds()-started)
+
+    def failed(f, kind):
+        lost[kind] += 1
+
+    def start(chat_id, kind, merge_key):
+        method = FakeMethod(chat_id, kind, clock.seconds())
+        if mode == 'scheduler':
+            priority = PRIORITY_INTERACTIVE if kind == 'interactive' else PRIORITY_BULK
+            d = scheduler.send(method, priority, merge_key)
+        else:
+            d = send(method)
+        d.addCallbacks(sent, failed, callbackArgs=(kind, clock.seconds()),
+                       errbackArgs=(kind,))
+
+    for t, chat_id, kind, merge_key in sends:
+        clock.callLater(t, start, chat_id, kind, merge_key)
+    while clock.getDelayedCalls():
+        clock.advance(max(0., min(c.getTime() for c in clock.getDelayedCalls())
+                          - clock.seconds()))
+
+    result = {'mode': mode, 'api_calls': api.calls, 'throttled': api.throttled,
+              'duration_s': clock.seconds()}
+    for kind, times in latency.items():
+        times = np.array(times) if times else np.zeros(1)
+        result[kind] = {'delivered': len(latency[kind]), 'merged': merged[kind],
+                        'lost': lost[kind], 'p50_s': float(np.percentile(times, 50)),
+                        'p95_s': float(np.percentile(times, 95)), 'max_s': float(times.max())}
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.send_scheduler')
+    parser.add_argument('--chats', type=int, default=200,
+                        help='number of private chats (default: %(default)s)')
+    parser.add_argument('--groups', type=int, default=20,
+                        help='number of group chats (default: %(default)s)')
+    parser.add_argument('--commands', type=int, default=300,
+                        help='number of commands in 10 seconds (default: %(default)s)')
+    parser.add_argument('--refreshes', type=int, default=5,
+                        help='number of repeated refreshes of every 10th command '
+                        '(default: %(default)s)')
+    parser.add_argument('--subscribers', type=int, default=200,
+                        help='number of chats notified at once (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed (default: %(default)s)')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    sends = make_sends(np.random.default_rng(args.seed), args)
+    print('%-10s %6s %6s %8s  %-46s  %s' % (
+        'mode', 'calls', '429s', 'time, s', 'interactive: sent/merged/lost p50/p95/max, s',
+        'bulk: sent/lost p50/p95/max, s'))
+    for mode in ('direct', 'retry', 'scheduler'):
+        r = run_mode(mode, sends)
+        i, b = r['interactive'], r['bulk']
+        print(('%-10s %6d %6d %8.1f  %4d/%4d/%4d %6.2f/%6.2f/%6.2f %13s ' +
+               '%4d/%4d %6.2f/%6.2f/%6.2f') % (
+            mode, r['api_calls'], r['throttled'], r['duration_s'],
+            i['delivered'], i['merged'], i['lost'], i['p50_s'], i['p95_s'], i['max_s'], '',
+            b['delivered'], b['lost'], b['p50_s'], b['p95_s'], b['max_s']))
+
+
+if __name__ == '__main__':
+    main()
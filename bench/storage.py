@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+'''
+Benchmark of storage backends over synthetic PM data in a temporary directory:
+append rate of PM data (one record at a time, as sensor polls add them) and read
+queries of every L{IAqiStorage} method at every window.
+
+Usage::
+
+    python -m bench.storage [--backends sqlite,tslog] [--poll 60] [--days 30]
+                            [--windows 1h,1d,30d] [--repeat 5]
+
+'''
+
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+from twisted.internet import defer, task
+
+from bench.pipeline import parse_duration, make_pm_rows, measure
+from bench.storage_conformance import open_storage
+
+DEFAULT_BACKENDS = ('sqlite', 'tslog')
+DEFAULT_WINDOWS = ('1h', '1d', '30d')
+DEFAULT_REPEAT = 5
+
+QUERIES = ('last_period', 'columns', 'binned', 'binned_aqi', 'banded')
+
+
+def bin_width(window):
+    # 3 minutes for hourly windows, hours up to a week, days for longer windows
+    if window < 86400:
+        return 180
+    return 3600 if window <= 7 * 86400 else 86400
+
+
+@defer.inlineCallbacks
+def run_backend(backend, rows, windows, repeat):
+    data_dir = tempfile.mkdtemp(prefix='aqimon-bench-')
+    try:
+        storage = open_storage(backend, data_dir)
+        storage.startService()
+        yield storage.when_ready()
+        started = time.perf_counter()
+        for row in rows:
+            storage.add_pm_data(*row)
+        yield storage.flush()
+        append_rate = len(rows) / (time.perf_counter() - started)
+
+        results = []
+        now = int(time.time())
+        for window in windows:
+            # aligned bins, as plots use them
+            width = bin_width(window)
+            ts_end = (now // width + 1) * width
+            ts_start = ts_end - window
+            n_bins = window // width
+            queries = {
+                'last_period': lambda: storage.last_period_pm_data(window),
+                'columns': lambda: storage.period_pm_columns(ts_start, ts_end),
+                'binned': lambda: storage.binned_pm_data(ts_start, ts_end, n_bins),
+                'binned_aqi': lambda: storage.binned_pm_data(ts_start, ts_end, n_bins,
+                                                             with_aqi=True),
+                'banded': lambda: storage.banded_pm_data(ts_start, ts_end, n_bins),
+            }
+            times = {}
+            for name in QUERIES:
+                if name == 'banded' and width % 3600:
+                    # bands are aligned to hours
+                    continue
+                r = yield measure(queries[name], repeat)
+                times[name] = r['median_s']
+            results.append((window, times))
+        yield storage.stopService()
+    finally:
+        shutil.rmtree(data_dir)
+    defer.returnValue((append_rate, results))
+
+
+@defer.inlineCallbacks
+def run(args):
+    windows = [parse_duration(s) for s in args.windows.split(',')]
+    now = int(time.time())
+    rows = make_pm_rows(np.random.default_rng(args.seed), now - args.poll,
+                        args.days * 86400, args.poll)
+    print('%d records, every %d s, over %d days' % (len(rows), args.poll, args.days))
+    print('%-8s %10s %8s  %s' % ('backend', 'appends/s', 'window',
+                                 ' '.join('%14s' % name for name in QUERIES)))
+    for backend in args.backends.split(','):
+        append_rate, results = yield run_backend(backend, rows, windows, args.repeat)
+        for i, (window, times) in enumerate(results):
+            print('%-8s %10s %8d  %s' % (
+                backend, '%.0f' % append_rate if i == 0 else '', window,
+                ' '.join('%11.2f ms' % (times[name] * 1000) if name in times else
+                         '%14s' % '-' for name in QUERIES)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.storage')
+    parser.add_argument('--backends', default=','.join(DEFAULT_BACKENDS),
+                        help='comma-separated storage backends (default: %(default)s)')
+    parser.add_argument('--poll', type=int, default=60,
+                        help='sensor poll period, in seconds (default: %(default)s)')
+    parser.add_argument('--days', type=int, default=30,
+                        help='number of days of stored data (default: %(default)s)')
+    parser.add_argument('--windows', default=','.join(DEFAULT_WINDOWS),
+                        help='comma-separated query periods, with m/h/d suffixes '
+                        '(default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='number of timed runs of every query (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='synthetic data random seed (default: %(default)s)')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    task.react(lambda reactor: run(args))
+
+
+if __name__ == '__main__':
+    main()
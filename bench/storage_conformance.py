@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+'''
+Conformance checks of L{IAqiStorage} backends, run against every backend with
+the same synthetic PM data in a temporary directory.
+
+Every check stores known data and compares storage results with the expected ones,
+computed from the data by NumPy. Failed checks are reported and make the script
+exit with non-zero status.
+
+Usage::
+
+    python -m bench.storage_conformance [--backends sqlite,tslog]
+
+'''
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import traceback
+
+import numpy as np
+
+from twisted.internet import defer, task
+
+from bench.pipeline import make_pm_rows
+
+DEFAULT_BACKENDS = ('sqlite', 'tslog')
+
+
+def open_storage(backend, data_dir):
+    '''
+    Create storage service of given backend, storing data in C{data_dir}.
+    '''
+    if backend == 'sqlite':
+        from db import DbSession
+        from aqimon.storage import AqiStorage
+        return AqiStorage(DbSession(os.path.join(data_dir, 'db.sqlite')))
+    if backend == 'tslog':
+        from aqimon.tslog import PmLogStorage
+        return PmLogStorage(os.path.join(data_dir, 'pm_log'))
+    raise ValueError('Unknown storage backend: %s' % backend)
+
+
+def check(condition, message, *args):
+    if not condition:
+        raise AssertionError(message % args)
+
+
+def check_close(actual, expected, message):
+    check(np.allclose(np.asarray(actual, dtype=np.float64),
+                      np.asarray(expected, dtype=np.float64), equal_nan=True),
+          '%s: %r != %r', message, actual, expected)
+
+
+def expected_bins(rows, ts_start, ts_end, n_bins):
+    '''
+    Get expected bin counts and PM2.5 means of (tstamp, pm25, pm10) rows.
+    '''
+    ts, pm_25, _ = (np.asarray(c) for c in zip(*rows))
+    inside = (ts >= ts_start) & (ts < ts_end)
+    bins = (ts[inside] - ts_start) * n_bins // (ts_end - ts_start)
+    count = np.bincount(bins, minlength=n_bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(bins, weights=pm_25[inside], minlength=n_bins) / count
+    return count, mean
+
+
+class Conformance(object):
+    '''
+    Conformance checks of a storage backend. Checks are run in order of definition,
+    later ones use data stored by earlier ones.
+    '''
+    def __init__(self, backend, data_dir, rows):
+        self.backend = backend
+        self.data_dir = data_dir
+        self.rows = rows
+        self.storage = None
+
+    @defer.inlineCallbacks
+    def start(self):
+        self.storage = open_storage(self.backend, self.data_dir)
+        self.storage.startService()
+        yield self.storage.when_ready()
+
+    @defer.inlineCallbacks
+    def check_interface(self):
+        from zope.interface.verify import verifyObject  # @UnresolvedImport
+        from aqimon.interfaces import IAqiStorage
+        yield self.start()
+        check(verifyObject(IAqiStorage, self.storage), 'IAqiStorage is not provided')
+        check(self.storage.name == 'aqi_storage', 'wrong service name: %s',
+              self.storage.name)
+
+    @defer.inlineCallbacks
+    def check_add_and_flush(self):
+        for row in self.rows:
+            self.storage.add_pm_data(*row)
+        yield self.storage.flush()
+        check(self.storage.pending_count == 0, '%d record(s) pending after flush',
+              self.storage.pending_count)
+
+    @defer.inlineCallbacks
+    def check_duplicates_ignored(self):
+        tstamp, pm_25, pm_10 = self.rows[-1]
+        self.storage.add_pm_data(tstamp, pm_25 + 1, pm_10 + 1)
+        yield self.storage.flush()
+        pm_data = yield self.storage.last_period_pm_data(time.time() - tstamp + 1)
+        check([tuple(row) for row in pm_data] == [self.rows[-1]],
+              'duplicate timestamp is stored: %r', pm_data)
+
+    @defer.inlineCallbacks
+    def check_last_period(self):
+        period = 6 * 3600
+        ts_start = time.time() - period
+        pm_data = yield self.storage.last_period_pm_data(period)
+        expected = [row for row in self.rows if row[0] > ts_start]
+        check([tuple(row) for row in pm_data] == expected,
+              'last period data differ: %d record(s) instead of %d',
+              len(pm_data), len(expected))
+
+    @defer.inlineCallbacks
+    def check_period_columns(self):
+        # range spanning day boundaries, ends excluded
+        ts_start, ts_end = self.rows[100][0], self.rows[-100][0]
+        columns = yield self.storage.period_pm_columns(ts_start, ts_end)
+        expected = [row for row in self.rows if ts_start <= row[0] < ts_end]
+        ts, pm_25, pm_10 = (np.asarray(c) for c in zip(*expected))
+        check(np.array_equal(columns.tstamp, ts), 'timestamps differ')
+        check(columns.tstamp.dtype == np.int64, 'timestamps dtype is %s',
+              columns.tstamp.dtype)
+        check(columns.pm_25.dtype == columns.pm_10.dtype == np.float32,
+              'PM values dtype is %s', columns.pm_25.dtype)
+        check_close(columns.pm_25, pm_25.astype(np.float32), 'PM2.5 values differ')
+        check_close(columns.pm_10, pm_10.astype(np.float32), 'PM10 values differ')
+        empty = yield self.storage.period_pm_columns(ts_end + 86400, ts_end + 2*86400)
+        check(len(empty.tstamp) == len(empty.pm_25) == len(empty.pm_10) == 0,
+              'data after the last record: %r', empty)
+
+    @defer.inlineCallbacks
+    def check_binned(self):
+        # bins not aligned to anything, then bins aligned to hours
+        now = int(time.time())
+        hour_end = (now // 3600 + 1) * 3600
+        for ts_start, ts_end, n_bins in ((now - 86400 + 17, now, 47),
+                                         (hour_end - 86400, hour_end, 24)):
+            count, mean = expected_bins(self.rows, ts_start, ts_end, n_bins)
+            for with_aqi in (False, True):
+                bins = yield self.storage.binned_pm_data(ts_start, ts_end, n_bins,
+                                                         with_aqi=with_aqi)
+                check(np.array_equal(bins.count, count), 'bin counts differ: %r != %r',
+                      bins.count, count)
+                check_close(bins.pm_25, mean, 'PM2.5 bin means differ')
+                check(np.all(np.isnan(bins.pm_25_min) == (count == 0)),
+                      'empty bins are not NaN')
+                check((bins.aqi is not None) == with_aqi, 'AQI bins: %r', bins.aqi)
+                if with_aqi:
+                    check(np.all((bins.aqi[count > 0] >= 0) & (bins.aqi[count > 0] <= 500)),
+                          'AQI bin means out of range: %r', bins.aqi)
+
+    @defer.inlineCallbacks
+    def check_banded(self):
+        hour_end = (int(time.time()) // 3600 + 1) * 3600
+        ts_start, ts_end = hour_end - 86400, hour_end
+        count, mean = expected_bins(self.rows, ts_start, ts_end, 24)
+        bands = yield self.storage.banded_pm_data(ts_start, ts_end, 24)
+        check(np.array_equal(bands.count, count), 'band counts differ: %r != %r',
+              bands.count, count)
+        check_close(bands.pm_25, mean, 'PM2.5 band means differ')
+        nonempty = count > 0
+        check(np.all(bands.pm_25_low[nonempty] <= bands.pm_25_high[nonempty]),
+              'band bounds are not ordered')
+        try:
+            yield self.storage.banded_pm_data(ts_start + 1, ts_end + 1, 24)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('unaligned bands did not fail')
+
+    @defer.inlineCallbacks
+    def check_persistence(self):
+        yield self.storage.stopService()
+        yield self.start()
+        pm_data = yield self.storage.last_period_pm_data(time.time() - self.rows[0][0] + 1)
+        check(len(pm_data) == len(self.rows), '%d record(s) of %d persisted',
+              len(pm_data), len(self.rows))
+
+    checks = ('check_interface', 'check_add_and_flush', 'check_duplicates_ignored',
+              'check_last_period', 'check_period_columns', 'check_binned', 'check_banded',
+              'check_persistence')
+
+    @defer.inlineCallbacks
+    def run(self, out):
+        failed = 0
+        try:
+            for name in self.checks:
+                try:
+                    yield getattr(self, name)()
+                except Exception:
+                    failed += 1
+                    print('%-8s %-28s FAIL' % (self.backend, name), file=out)
+                    traceback.print_exc(file=out)
+                else:
+                    print('%-8s %-28s ok' % (self.backend, name), file=out)
+        finally:
+            if self.storage is not None and self.storage.running:
+                yield self.storage.stopService()
+        defer.returnValue(failed)
+
+
+@defer.inlineCallbacks
+def run(args):
+    now = int(time.time())
+    # 3 days of data, up to a few minutes ago
+    rows = make_pm_rows(np.random.default_rng(args.seed), now - 300, 3 * 86400, 60)
+    failed = 0
+    for backend in args.backends.split(','):
+        data_dir = tempfile.mkdtemp(prefix='aqimon-conformance-')
+        try:
+            failed += yield Conformance(backend, data_dir, rows).run(sys.stdout)
+        finally:
+            shutil.rmtree(data_dir)
+    if failed:
+        raise SystemExit('%d check(s) failed' % failed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.storage_conformance')
+    parser.add_argument('--backends', default=','.join(DEFAULT_BACKENDS),
+                        help='comma-separated storage backends (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='synthetic data random seed (default: %(default)s)')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    task.react(lambda reactor: run(args))
+
+
+if __name__ == '__main__':
+    main()
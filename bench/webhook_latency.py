@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+
+'''
+Benchmark of update-to-reply latency of webhook vs long polling, over local HTTP.
+
+Fake Telegram gets updates at random times (recorded updates from NDJSON file, or
+synthetic C{/aqi} commands from many chats) and delivers them to the bot either by
+long polling of its local C{getUpdates} endpoint, or by POSTing them to local
+L{WebhookResource} with up to C{max_connections} requests at once, like Telegram does.
+Network latency between Telegram and bot is simulated by delaying every request and
+response. Bot replies to update after handling time; latency is measured from update
+arrival at Telegram to reply.
+
+Recorded updates may also be POSTed to a running webhook by hand, e.g.::
+
+    curl -H 'X-Telegram-Bot-Api-Secret-Token: <secret>' -H 'Content-Type: application/json' \\
+         -d @update.json http://127.0.0.1:8080/aqi-telegram-bot
+
+Usage::
+
+    python -m bench.webhook_latency [--updates FILE] [--count 300] [--rate 50]
+                                    [--latency 0.05] [--handling 0.02] [--poll-interval 0]
+                                    [--concurrency 8] [--connections 40] [--queue 100]
+
+'''
+
+import io
+import sys
+import json
+import random
+import argparse
+
+import numpy as np
+
+from twisted.internet import defer, task
+from twisted.web import resource, server
+from twisted.web.client import Agent, HTTPConnectionPool, FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
+
+from TelegramBotAPI.types import Update
+
+from telegram.webhook import UpdateDispatcher, WebhookResource, SECRET_TOKEN_HEADER, \
+    update_chat_id
+
+SECRET_TOKEN = 'bench-secret-token'
+POLL_TIMEOUT = 10
+
+
+def synthetic_updates(count, chats, rng):
+    for i in range(count):
+        chat_id = rng.randint(1, chats)
+        yield {'message': {'message_id': i+1, 'date': 0, 'text': '/aqi',
+                           'chat': {'id': chat_id, 'type': 'private'},
+                           'from': {'id': chat_id, 'first_name': 'User'}}}
+
+
+def recorded_updates(filename, count):
+    with open(filename) as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+    return [updates[i % len(updates)] for i in range(count)]
+
+
+class FakeTelegram(object):
+    '''
+    Fake Telegram: queues arriving updates for getUpdates, or delivers them to webhook.
+    '''
+    def __init__(self, reactor, latency):
+        self.reactor = reactor
+        self.latency = latency
+        self.next_update_id = 1
+        self.arrived = {}
+        self.pending = []
+        self._polls = []
+        self._webhook = None
+
+    def arrive(self, raw):
+        raw = dict(raw, update_id=self.next_update_id)
+        self.next_update_id += 1
+        self.arrived[raw['update_id']] = self.reactor.seconds()
+        if self._webhook is not None:
+            self._webhook.deliver(raw)
+            return
+        self.pending.append(raw)
+        polls, self._polls = self._polls, []
+        for poll in polls:
+            self._answer(poll)
+
+    def get_updates(self, offset):
+        '''
+        Long polling: fire pending updates after C{offset}, waiting for ones to arrive.
+        '''
+        self.pending = [raw for raw in self.pending if raw['update_id'] >= offset]
+        d = defer.Deferred()
+        if self.pending:
+            self._answer(d)
+        else:
+            self._polls.append(d)
+            self.reactor.callLater(POLL_TIMEOUT, self._timeout, d)
+        return d
+
+    def _answer(self, d):
+        if not d.called:
+            d.callback(self.pending[:100])
+
+    def _timeout(self, d):
+        if d in self._polls:
+            self._polls.remove(d)
+            d.callback([])
+
+
+class GetUpdatesResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, telegram):
+        resource.Resource.__init__(self)
+        self.telegram = telegram
+
+    def render_POST(self, request):
+        offset = json.loads(request.content.read()).get('offset', 0)
+
+        def respond(updates):
+            # response goes back to bot with network latency
+            body = json.dumps({'ok': True, 'result': updates}).encode('utf-8')
+            self.telegram.reactor.callLater(self.telegram.latency, finish, body)
+
+        def finish(body):
+            request.write(body)
+            request.finish()
+
+        self.telegram.get_updates(offset).addCallback(respond)
+        return server.NOT_DONE_YET
+
+
+class WebhookSender(object):
+    '''
+    Telegram side of webhook: POSTs updates to webhook URL, at most C{max_connections}
+    at once, resending rejected ones after a second.
+    '''
+    def __init__(self, reactor, url, latency, max_connections):
+        self.reactor = reactor
+        self.url = url.encode('ascii')
+        self.latency = latency
+        self.max_connections = max_connections
+        self.rejected = 0
+        self._queue = []
+        self._sending = 0
+        pool = HTTPConnectionPool(reactor)
+        pool.maxPersistentPerHost = max_connections
+        self._agent = Agent(reactor, pool=pool)
+
+    def deliver(self, raw):
+        self._queue.append(raw)
+        self._pump()
+
+    def _pump(self):
+        while self._queue and self._sending < self.max_connections:
+            self._sending += 1
+            # request reaches bot with network latency
+            self.reactor.callLater(self.latency, self._post, self._queue.pop(0))
+
+    def _post(self, raw):
+        headers = Headers({b'Content-Type': [b'application/json'],
+                           SECRET_TOKEN_HEADER: [SECRET_TOKEN.encode('ascii')]})
+        body = FileBodyProducer(io.BytesIO(json.dumps(raw).encode('utf-8')))
+        d = self._agent.request(b'POST', self.url, headers, body)
+        d.addCallback(lambda response: readBody(response).addCallback(
+            lambda _: response.code))
+        d.addBoth(lambda code: self.reactor.callLater(self.latency, self._posted, raw, code))
+
+    def _posted(self, raw, code):
+        self._sending -= 1
+        if code != 200:
+            self.rejected += 1
+            self.reactor.callLater(1, self.deliver, raw)
+        self._pump()
+
+
+class Poller(object):
+    '''
+    Long polling client: requests updates after the last received one, dispatches
+    them all at once, and requests again (after C{poll_interval}, if any).
+    '''
+    def __init__(self, reactor, url, latency, poll_interval, on_update):
+        self.reactor = reactor
+        self.url = url.encode('ascii')
+        self.latency = latency
+        self.poll_interval = poll_interval
+        self.on_update = on_update
+        self.offset = 0
+        self.running = True
+        self._agent = Agent(reactor, pool=HTTPConnectionPool(reactor))
+
+    def poll(self):
+        if not self.running:
+            return
+        body = FileBodyProducer(io.BytesIO(json.dumps({'offset': self.offset,
+                                                       'timeout': POLL_TIMEOUT}).encode()))
+        d = self._agent.request(b'POST', self.url, None, body)
+        d.addCallback(readBody)
+        d.addCallback(self._polled)
+        d.addErrback(lambda f: None if not self.running else f)
+
+    def _polled(self, body):
+        for raw in json.loads(body)['result']:
+            self.offset = raw['update_id'] + 1
+            update = Update()
+            update._from_raw(raw)
+            self.on_update(update)
+        # request reaches Telegram with network latency
+        self.reactor.callLater(self.poll_interval + self.latency, self.poll)
+
+
+@defer.inlineCallbacks
+def run_mode(reactor, mode, updates, args):
+    telegram = FakeTelegram(reactor, args.latency)
+    replied = {}
+
+    def on_update(update):
+        def reply():
+            replied[update.update_id] = reactor.seconds()
+        return task.deferLater(reactor, args.handling, reply)
+
+    site = server.Site(resource.Resource())
+    if mode == 'webhook':
+        dispatcher = UpdateDispatcher(on_update, args.concurrency, args.queue)
+        site.resource = WebhookResource(dispatcher, SECRET_TOKEN, b'/webhook')
+    else:
+        site.resource = GetUpdatesResource(telegram)
+    site.noisy = False
+    port = reactor.listenTCP(0, site, interface='127.0.0.1')
+    url = 'http://127.0.0.1:%d/%s' % (port.getHost().port,
+                                      'webhook' if mode == 'webhook' else 'getUpdates')
+    if mode == 'webhook':
+        sender = WebhookSender(reactor, url, args.latency, args.connections)
+        telegram._webhook = sender
+    else:
+        poller = Poller(reactor, url, args.latency, args.poll_interval, on_update)
+        reactor.callLater(args.latency, poller.poll)
+        yield task.deferLater(reactor, 0.5, lambda: None)
+
+    rng = random.Random(args.seed)
+    t = 0.
+    for raw in updates:
+        t += rng.expovariate(args.rate)
+        reactor.callLater(t, telegram.arrive, raw)
+    while len(replied) < len(updates):
+        yield task.deferLater(reactor, 0.1, lambda: None)
+
+    if mode == 'polling':
+        poller.running = False
+        for d in list(telegram._polls):
+            telegram._timeout(d)
+    yield port.stopListening()
+    latencies = np.array([replied[i] - telegram.arrived[i] for i in replied])
+    result = {'mode': mode, 'updates': len(replied),
+              'p50_s': float(np.percentile(latencies, 50)),
+              'p95_s': float(np.percentile(latencies, 95)),
+              'max_s': float(latencies.max())}
+    if mode == 'webhook':
+        result['rejected'] = sender.rejected
+    defer.returnValue(result)
+
+
+@defer.inlineCallbacks
+def run(reactor, args):
+    if args.updates:
+        updates = recorded_updates(args.updates, args.count)
+    else:
+        updates = list(synthetic_updates(args.count, args.chats, random.Random(args.seed)))
+    chats = len(set(update_chat_id(raw) for raw in updates))
+    print('%d updates from %d chats, %.0f updates/s, latency %.0f ms, handling %.0f ms' % (
+        len(updates), chats, args.rate, args.latency*1000, args.handling*1000))
+    print('%-8s %8s %8s %8s %8s  %s' % ('mode', 'updates', 'p50, s', 'p95, s', 'max, s',
+                                        'rejected'))
+    for mode in ('polling', 'webhook'):
+        r = yield run_mode(reactor, mode, updates, args)
+        print('%-8s %8d %8.3f %8.3f %8.3f  %s' % (mode, r['updates'], r['p50_s'], r['p95_s'],
+                                                  r['max_s'], r.get('rejected', '-')))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.webhook_latency')
+    parser.add_argument('--updates', help='NDJSON file with recorded updates '
+                        '(default: synthetic /aqi commands)')
+    parser.add_argument('--count', type=int, default=300,
+                        help='number of updates (default: %(default)s)')
+    parser.add_argument('--chats', type=int, default=100,
+                        help='number of chats of synthetic updates (default: %(default)s)')
+    parser.add_argument('--rate', type=float, default=50,
+                        help='mean rate of updates per second (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='network latency between Telegram and bot, s '
+                        '(default: %(default)s)')
+    parser.add_argument('--handling', type=float, default=0.02,
+                        help='update handling time, s (default: %(default)s)')
+    parser.add_argument('--poll-interval', type=float, default=0,
+                        help='delay between getUpdates requests, s (default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='number of updates handled at once by webhook '
+                        '(default: %(default)s)')
+    parser.add_argument('--connections', type=int, default=40,
+                        help='max number of concurrent webhook requests '
+                        '(default: %(default)s)')
+    parser.add_argument('--queue', type=int, default=100,
+                        help='webhook dispatch queue size (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed (default: %(default)s)')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    task.react(run, (args,))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 
 from db.session import DbSession
+from db.migrations import Migrator
 
 __all__ = [
-    DbSession
+    DbSession, Migrator
 ]
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+from twisted.internet import defer
+from twisted.logger import Logger
+
+log = Logger()
+
+
+class Migrator(object):
+    '''
+    Versioned database schema migrations.
+
+    Every component using the database keeps its own schema version in
+    C{schema_version} table. Migrations are applied in order, each one is a function
+    called with L{DbSession} and returning a L{Deferred} (or nothing). Schema version
+    is updated after every successfully applied migration, so migrations interrupted
+    before that are re-run from the beginning and must be idempotent.
+
+    '''
+    def __init__(self, db_session, component, migrations):
+        self.db_session = db_session
+        self.component = component
+        self.migrations = migrations
+
+    @property
+    def latest_version(self):
+        return len(self.migrations)
+
+    def _get_version(self, txn):
+        txn.execute(
+            'CREATE TABLE IF NOT EXISTS schema_version ' +
+            '(component TEXT PRIMARY KEY, version INTEGER)')
+        txn.execute('SELECT version FROM schema_version WHERE component = ?',
+                    (self.component,))
+        row = txn.fetchone()
+        return row[0] if row is not None else 0
+
+    @defer.inlineCallbacks
+    def migrate(self):
+        '''
+        Apply all pending migrations.
+
+        @return: a L{Deferred} which will fire with resulting schema version.
+        '''
+        version = yield self.db_session.runInteraction(self._get_version)
+        if version > self.latest_version:
+            raise RuntimeError('Database schema version of %s (%d) is newer than supported (%d)'
+                               % (self.component, version, self.latest_version))
+        for migration in self.migrations[version:]:
+            version += 1
+            log.info("Migrating {component} schema to version {version}",
+                     component=self.component, version=version)
+            yield defer.maybeDeferred(migration, self.db_session)
+            yield self.db_session.runOperation(
+                'INSERT OR REPLACE INTO schema_version (component, version) VALUES (?, ?)',
+                (self.component, version))
+        defer.returnValue(version)
@@ -1,22 +1,111 @@
 # -*- coding: utf-8 -*-
 
+import os
+import re
+import sqlite3
+
+from urllib.request import pathname2url
+
 from twisted.enterprise import adbapi
 
+DEFAULT_READ_POOL_SIZE = 3
+
+# Default connection PRAGMAs
+DEFAULT_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'cache_size': '-2000',  # 2 MiB
+    'mmap_size': '0',
+    'temp_store': 'MEMORY',
+}
+
 
 class DbSession(object):
     '''
     Database session.
 
+    Database is opened in WAL mode. All writes go through a single writer connection,
+    while reads are served by a separate pool of read-only connections, so readers
+    and the writer never block each other.
+
     '''
-    def __init__(self, db_filename):
+    def __init__(self, db_filename, read_pool_size=DEFAULT_READ_POOL_SIZE, pragmas=None):
+        self.db_filename = db_filename
+        self.pragmas = dict(DEFAULT_PRAGMAS)
+        if pragmas:
+            self.pragmas.update(pragmas)
+        for name, value in self.pragmas.items():
+            if not re.match(r'^[-\w]+$', str(value)):
+                raise ValueError('Invalid value for PRAGMA %s: %r' % (name, value))
+        # create database, if needed, and switch it to WAL mode (persistent)
+        conn = sqlite3.connect(db_filename)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+        finally:
+            conn.close()
+        self._connect_hooks = []
         # open database
-        self._pool = adbapi.ConnectionPool("sqlite3", db_filename, check_same_thread=False)
+        self._writer = adbapi.ConnectionPool("sqlite3", db_filename, check_same_thread=False,
+                                             cp_min=1, cp_max=1, cp_openfun=self._on_connect)
+        db_uri = 'file:%s?mode=ro' % pathname2url(os.path.abspath(db_filename))
+        self._readers = adbapi.ConnectionPool("sqlite3", db_uri, uri=True,
+                                              check_same_thread=False,
+                                              cp_min=1, cp_max=read_pool_size,
+                                              cp_openfun=self._on_connect)
+
+    def _on_connect(self, conn):
+        for name, value in self.pragmas.items():
+            conn.execute('PRAGMA %s=%s' % (name, value))
+        for hook in self._connect_hooks:
+            hook(conn)
+
+    def add_connect_hook(self, hook):
+        """
+        Add a function to be called with every newly opened DB-API connection,
+        e.g. to register SQL functions. Connections are opened lazily, so hooks
+        should be added before the first query is run.
+        """
+        self._connect_hooks.append(hook)
 
     def runQuery(self, *args, **kw):
         """
-        Execute an SQL query and return the result.
+        Execute a read-only SQL query and return the result.
 
         @return: a L{Deferred} which will fire the return value of a DB-API
             cursor's 'fetchall' method, or a L{twisted.python.failure.Failure}.
         """
-        return self._pool.runQuery(*args, **kw)
+        return self._readers.runQuery(*args, **kw)
+
+    def runReadInteraction(self, interaction, *args, **kw):
+        """
+        Run a function using a read-only connection and return its result.
+
+        @return: a L{Deferred} which will fire the return value of
+            C{interaction(cursor, *args, **kw)}, or a L{twisted.python.failure.Failure}.
+        """
+        return self._readers.runInteraction(interaction, *args, **kw)
+
+    def runOperation(self, *args, **kw):
+        """
+        Execute a modifying SQL query using the writer connection.
+
+        @return: a L{Deferred} which will fire with C{None}, or a
+            L{twisted.python.failure.Failure}.
+        """
+        return self._writer.runOperation(*args, **kw)
+
+    def runInteraction(self, interaction, *args, **kw):
+        """
+        Run a function in a database transaction using the writer connection
+        and return its result.
+
+        @return: a L{Deferred} which will fire the return value of
+            C{interaction(cursor, *args, **kw)}, or a L{twisted.python.failure.Failure}.
+        """
+        return self._writer.runInteraction(interaction, *args, **kw)
+
+    def close(self):
+        """
+        Close all database connections.
+        """
+        self._readers.close()
+        self._writer.close()
@@ -1,20 +1,35 @@
 # -*- coding: utf-8 -*-
 
+import json
 import time
+import hashlib
+
+from collections import OrderedDict, namedtuple
 
 import babel.dates
 
 from datetime import timedelta
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.application import service
+from twisted.logger import Logger
+from twisted.python.failure import Failure
 
 from TelegramBot.plugin.bot import BotPlugin
 from TelegramBotAPI.types import InlineKeyboardMarkup, InlineKeyboardButton
 from TelegramBotAPI.types.methods import Method, sendMessage, answerCallbackQuery, \
     deleteMessage, sendPhoto
 
-from aqimon import monitor
+from aqimon import aqicalc
+from telegram.methods import editMessageText, editMessageMedia
+from telegram.scheduler import PRIORITY_INTERACTIVE, PRIORITY_BULK, forbidden, \
+    not_modified
+from telegram.subscriptions import DEFAULT_THRESHOLD, MIN_THRESHOLD, MAX_THRESHOLD
+
+log = Logger()
+
+# Command response message, with digest of its content (text or plot image)
+Response = namedtuple('Response', ['method', 'chat_id', 'cmd', 'digest', 'text', 'image'])
 
 
 class Bot(service.Service, BotPlugin):
@@ -26,13 +41,199 @@ class Bot(service.Service, BotPlugin):
 
     aqi_symbols = u'😃😐😕☹️😧😵'
 
-    def __init__(self, l10n_support, aqi_plot):
+    # Max number of AQI alerts being sent at once
+    alert_concurrency = 50
+
+    # Max number of sent messages with remembered contents
+    contents_cache_size = 1000
+
+    def __init__(self, l10n_support, aqi_plot, send_scheduler=None, subscriptions=None):
         BotPlugin.__init__(self)
         self.l10n_support = l10n_support
         self.aqi_plot = aqi_plot
+        self.send_scheduler = send_scheduler
+        self.subscriptions = subscriptions
+        if send_scheduler is not None:
+            send_scheduler.sender = self.send_now
+        # uploaded plot image digest -> Telegram file_id
+        self.photo_ids = {}
+        # id of command response message -> L{Response}, until it's sent
+        self._responses = {}
+        # (chat id, message id) -> digest of sent message content
+        self._contents = OrderedDict()
 
     def startService(self):
-        self.aqi_monitor = self.parent.getServiceNamed(monitor.AqiMonitor.name)
+        # aqimon.monitor imports this module
+        from aqimon.monitor import AqiMonitor
+        self.aqi_monitor = self.parent.getServiceNamed(AqiMonitor.name)
+        self.aqi_monitor.add_listener(self)
+
+    def pm_data_updated(self, pm_25, pm_10, aqi):
+        # AqiMonitor listener: uploaded plots are outdated by new data
+        self.photo_ids.clear()
+        # don't keep responses never sent by send_method()
+        self._responses.clear()
+        if self.subscriptions is not None:
+            rising, falling = self.subscriptions.update(aqi)
+            if rising or falling:
+                self.send_alerts(aqi, rising, falling)
+
+    def send_alerts(self, aqi, rising, falling):
+        '''
+        Send AQI alerts to chats subscribed to thresholds AQI just crossed.
+
+        Alerts are sent with bulk priority, at most C{alert_concurrency} at once,
+        so any number of chats is notified without flooding send queue.
+
+        @return: a L{Deferred} which will fire when all alerts are sent.
+        '''
+        aqi_symbol = self.aqi_symbols[aqicalc.to_aqi_level(aqi)]
+        texts = (_(u'AQI rose above %(threshold)s: *%(aqi)s* %(aqi_symbol)s'),
+                 _(u'AQI dropped below %(threshold)s: *%(aqi)s* %(aqi_symbol)s'))
+        n = sum(len(chat_ids) for crossed in (rising, falling) for t, chat_ids in crossed)
+        log.info("Sending AQI {aqi} alert to {n} chat(s)", aqi=aqi, n=n)
+
+        def alerts():
+            for crossed, text in zip((rising, falling), texts):
+                for threshold, chat_ids in crossed:
+                    alert = text % {'threshold': threshold, 'aqi': aqi, 'aqi_symbol': aqi_symbol}
+                    for chat_id in chat_ids:
+                        yield self.send_alert(chat_id, alert)
+
+        work = alerts()
+        return defer.DeferredList([task.coiterate(work)
+                                   for i in range(self.alert_concurrency)])
+
+    def send_alert(self, chat_id, text):
+        def failed(f):
+            if forbidden(f):
+                # bot was blocked by user or removed from chat
+                log.info("Unsubscribing unavailable chat {chat_id}", chat_id=chat_id)
+                return self.subscriptions.unsubscribe(chat_id).addErrback(
+                    lambda f: log.failure("Can't unsubscribe chat {chat_id}", f,
+                                          chat_id=chat_id))
+            log.failure("Can't send AQI alert to chat {chat_id}", f, chat_id=chat_id)
+
+        m = self.cmd_response(chat_id, text, 'aqi')
+        return self.send_method(m, PRIORITY_BULK).addErrback(failed)
+
+    @staticmethod
+    def sent_file_id(msg):
+        '''
+        Get file_id of the largest photo size of sent message, if any.
+        '''
+        try:
+            return list(msg.photo)[-1].file_id
+        except Exception:
+            return None
+
+    def photo_response(self, chat_id, img, cmd):
+        '''
+        Create photo message for plot image. If the same image was already uploaded,
+        it's sent by its Telegram file_id instead.
+        '''
+        digest = hashlib.sha1(img.getvalue()).hexdigest()
+        file_id = self.photo_ids.get(digest)
+        m = sendPhoto()
+        m.chat_id = chat_id
+        m.photo = file_id if file_id is not None else img
+        m.reply_markup = self.cmd_refresh_button(cmd)
+        self._responses[id(m)] = Response(m, chat_id, cmd, digest, None, img)
+        return m
+
+    @staticmethod
+    def set_photo(method, photo):
+        '''
+        Set photo (file_id or file-like object to upload) of sendPhoto or
+        editMessageMedia method.
+        '''
+        if not isinstance(method, editMessageMedia):
+            method.photo = photo
+        elif isinstance(photo, str):
+            method.media = json.dumps({'type': 'photo', 'media': photo})
+        else:
+            method.media = json.dumps({'type': 'photo', 'media': 'attach://photo'})
+            method.photo = photo
+
+    def edit_response(self, msg, response):
+        '''
+        Create method editing message to show command response instead.
+        '''
+        if response.image is None:
+            m = editMessageText()
+            m.text = response.text
+            m.parse_mode = 'Markdown'
+        else:
+            m = editMessageMedia()
+            file_id = self.photo_ids.get(response.digest)
+            self.set_photo(m, file_id if file_id is not None else response.image)
+        m.chat_id = msg.chat.id
+        m.message_id = msg.message_id
+        m.reply_markup = self.cmd_refresh_button(response.cmd)
+        return m
+
+    def remember_content(self, chat_id, message_id, digest):
+        self._contents[(chat_id, message_id)] = digest
+        self._contents.move_to_end((chat_id, message_id))
+        while len(self._contents) > self.contents_cache_size:
+            self._contents.popitem(last=False)
+
+    def send_now(self, method):
+        '''
+        Send method to Telegram right away.
+        '''
+        return BotPlugin.send_method(self, method)
+
+    def schedule_send(self, method, priority=PRIORITY_INTERACTIVE, merge_key=None):
+        '''
+        Send method by send scheduler, if any, or right away otherwise.
+        '''
+        if self.send_scheduler is None:
+            return self.send_now(method)
+        return self.send_scheduler.send(method, priority, merge_key)
+
+    def send_method(self, method, priority=PRIORITY_INTERACTIVE):
+        '''
+        Send method. Response to command supersedes not yet sent response to the same
+        command in the same chat.
+        '''
+        response = self._responses.pop(id(method), None)
+        if response is None or response.method is not method:
+            return self.schedule_send(method, priority)
+        return self.send_response(method, response, priority, response.cmd)
+
+    @defer.inlineCallbacks
+    def send_response(self, method, response, priority=PRIORITY_INTERACTIVE, merge_key=None):
+        '''
+        Send command response message, or method editing a message to show it.
+        File_ids of uploaded plot images and contents of sent messages are remembered.
+        '''
+        image = response.image
+        file_id = self.photo_ids.get(response.digest) if image is not None else None
+        if file_id is not None:
+            try:
+                result = yield self.schedule_send(method, priority, merge_key)
+                self.sent_response(result, response)
+                defer.returnValue(result)
+            except Exception:
+                # file_id was rejected, upload image again
+                log.failure("Can't send photo by file_id {file_id}", file_id=file_id)
+                self.photo_ids.pop(response.digest, None)
+                self.set_photo(method, image)
+        result = yield self.schedule_send(method, priority, merge_key)
+        file_id = self.sent_file_id(result) if image is not None else None
+        if file_id is not None:
+            self.photo_ids[response.digest] = file_id
+        self.sent_response(result, response)
+        defer.returnValue(result)
+
+    def sent_response(self, msg, response):
+        try:
+            message_id = msg.message_id
+        except Exception:
+            # not sent, e.g. superseded by newer response
+            return
+        self.remember_content(response.chat_id, message_id, response.digest)
 
     def format_timedelta(self, from_timestamp_secs, to_timestamp_secs=None):
         if to_timestamp_secs is None:
@@ -55,8 +256,14 @@ class Bot(service.Service, BotPlugin):
                  u'/pm - show current PM values\n' +
                  u'/aqi\_hourly - show hourly AQI stats\n' +
                  u'/aqi\_daily - show daily AQI stats\n' +
+                 u'/aqi\_weekly - show weekly AQI stats\n' +
+                 u'/aqi\_monthly - show monthly AQI stats\n' +
                  u'/pm\_hourly - show hourly PM stats\n' +
-                 u'/pm\_daily - show daily PM stats')
+                 u'/pm\_daily - show daily PM stats\n' +
+                 u'/pm\_weekly - show weekly PM stats\n' +
+                 u'/pm\_monthly - show monthly PM stats\n' +
+                 u'/subscribe - notify when AQI rises above given value\n' +
+                 u'/unsubscribe - stop AQI notifications')
 
     def cmd_response(self, chat_id, text, cmd):
         m = sendMessage()
@@ -64,6 +271,8 @@ class Bot(service.Service, BotPlugin):
         m.text = text
         m.parse_mode = 'Markdown'
         m.reply_markup = self.cmd_refresh_button(cmd)
+        digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        self._responses[id(m)] = Response(m, chat_id, cmd, digest, text, None)
         return m
 
     def cmd_refresh_button(self, cmd):
@@ -102,44 +311,82 @@ class Bot(service.Service, BotPlugin):
         img = yield self.aqi_plot.plot_hourly_pm_data()
         if img is None:
             return _(u'Hourly PM data is unavailable.')
-        m = sendPhoto()
-        m.chat_id = msg.chat.id
-        m.photo = img
-        m.reply_markup = self.cmd_refresh_button('pm_hourly')
-        return m
+        return self.photo_response(msg.chat.id, img, 'pm_hourly')
 
     @defer.inlineCallbacks
     def on_command_pm_daily(self, _args, msg):
         img = yield self.aqi_plot.plot_daily_pm_data()
         if img is None:
             return _(u'Daily PM data is unavailable.')
-        m = sendPhoto()
-        m.chat_id = msg.chat.id
-        m.photo = img
-        m.reply_markup = self.cmd_refresh_button('pm_daily')
-        return m
+        return self.photo_response(msg.chat.id, img, 'pm_daily')
+
+    @defer.inlineCallbacks
+    def on_command_pm_weekly(self, _args, msg):
+        img = yield self.aqi_plot.plot_weekly_pm_data()
+        if img is None:
+            return _(u'Weekly PM data is unavailable.')
+        return self.photo_response(msg.chat.id, img, 'pm_weekly')
+
+    @defer.inlineCallbacks
+    def on_command_pm_monthly(self, _args, msg):
+        img = yield self.aqi_plot.plot_monthly_pm_data()
+        if img is None:
+            return _(u'Monthly PM data is unavailable.')
+        return self.photo_response(msg.chat.id, img, 'pm_monthly')
 
     @defer.inlineCallbacks
     def on_command_aqi_hourly(self, _args, msg):
         img = yield self.aqi_plot.plot_hourly_aqi_data()
         if img is None:
             return _(u'Hourly AQI data is unavailable.')
-        m = sendPhoto()
-        m.chat_id = msg.chat.id
-        m.photo = img
-        m.reply_markup = self.cmd_refresh_button('aqi_hourly')
-        return m
+        return self.photo_response(msg.chat.id, img, 'aqi_hourly')
 
     @defer.inlineCallbacks
     def on_command_aqi_daily(self, _args, msg):
         img = yield self.aqi_plot.plot_daily_aqi_data()
         if img is None:
             return _(u'Daily AQI data is unavailable.')
-        m = sendPhoto()
-        m.chat_id = msg.chat.id
-        m.photo = img
-        m.reply_markup = self.cmd_refresh_button('aqi_daily')
-        return m
+        return self.photo_response(msg.chat.id, img, 'aqi_daily')
+
+    @defer.inlineCallbacks
+    def on_command_aqi_weekly(self, _args, msg):
+        img = yield self.aqi_plot.plot_weekly_aqi_data()
+        if img is None:
+            return _(u'Weekly AQI data is unavailable.')
+        return self.photo_response(msg.chat.id, img, 'aqi_weekly')
+
+    @defer.inlineCallbacks
+    def on_command_aqi_monthly(self, _args, msg):
+        img = yield self.aqi_plot.plot_monthly_aqi_data()
+        if img is None:
+            return _(u'Monthly AQI data is unavailable.')
+        return self.photo_response(msg.chat.id, img, 'aqi_monthly')
+
+    @defer.inlineCallbacks
+    def on_command_subscribe(self, args, msg):
+        if self.subscriptions is None:
+            return _(u'AQI notifications are unavailable.')
+        if isinstance(args, str):
+            args = args.split()
+        try:
+            threshold = int(args[0]) if args else DEFAULT_THRESHOLD
+            yield self.subscriptions.subscribe(msg.chat.id, threshold)
+        except ValueError:
+            return _(u'Please specify AQI value from %(min)s to %(max)s, ' +
+                     u'e.g. /subscribe %(default)s') % \
+                {'min': MIN_THRESHOLD, 'max': MAX_THRESHOLD, 'default': DEFAULT_THRESHOLD}
+        return _(u'You will be notified when AQI rises above *%(threshold)s* ' +
+                 u'and drops back below it.\nTo stop notifications, use /unsubscribe.') % \
+            {'threshold': threshold}
+
+    @defer.inlineCallbacks
+    def on_command_unsubscribe(self, _args, msg):
+        if self.subscriptions is None:
+            return _(u'AQI notifications are unavailable.')
+        subscribed = yield self.subscriptions.unsubscribe(msg.chat.id)
+        if not subscribed:
+            return _(u'You are not subscribed to AQI notifications.')
+        return _(u'AQI notifications are stopped.')
 
     @defer.inlineCallbacks
     def on_command_sensor_info(self, _args, _msg):
@@ -148,17 +395,47 @@ class Bot(service.Service, BotPlugin):
 
     @defer.inlineCallbacks
     def on_callback_query(self, callback_query):
-        # get callback command result
         cmd = callback_query.data
         msg = callback_query.message
-        cmd_result = yield self.on_command(cmd, cmd_msg=msg)
 
-        # create callback query result
+        # answer callback query while command is running
         m = answerCallbackQuery()
         m.callback_query_id = callback_query.id
-        yield self.send_method(m)
+        answered = self.send_method(m).addErrback(
+            lambda f: log.failure("Can't answer callback query", f))
+
+        # get callback command result
+        cmd_result = yield self.on_command(cmd, cmd_msg=msg)
+        if not isinstance(cmd_result, Method):
+            cmd_result = self.cmd_response(msg.chat.id, cmd_result, cmd)
+
+        response = self._responses.pop(id(cmd_result), None)
+        if response is None or response.method is not cmd_result:
+            yield self.replace_message(msg, cmd_result)
+        elif self._contents.get((msg.chat.id, msg.message_id)) != response.digest:
+            # update message in place
+            edit = self.edit_response(msg, response)
+            try:
+                yield self.send_response(edit, response, merge_key=(cmd, msg.message_id))
+            except Exception:
+                f = Failure()
+                if not_modified(f):
+                    self.remember_content(msg.chat.id, msg.message_id, response.digest)
+                else:
+                    # e.g. text message can't be edited to photo one
+                    log.failure("Can't edit message {message_id}", f,
+                                message_id=msg.message_id)
+                    self._responses[id(cmd_result)] = response
+                    yield self.replace_message(msg, cmd_result)
 
-        # delete old message, if possible
+        yield answered
+        defer.returnValue(True)
+
+    @defer.inlineCallbacks
+    def replace_message(self, msg, method):
+        '''
+        Delete message, if possible, and send method instead.
+        '''
         m = deleteMessage()
         m.chat_id = msg.chat.id
         m.message_id = msg.message_id
@@ -166,10 +443,5 @@ class Bot(service.Service, BotPlugin):
             yield self.send_method(m)
         except Exception:
             pass
-
-        # send message with callback command result
-        if not isinstance(cmd_result, Method):
-            cmd_result = self.cmd_response(msg.chat.id, cmd_result, cmd)
-        yield self.send_method(cmd_result)
-
-        defer.returnValue(True)
+        result = yield self.send_method(method)
+        defer.returnValue(result)
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+'''
+Telegram Bot API methods missing in TelegramBotAPI library, or lacking parameters there.
+
+'''
+
+from TelegramBotAPI.types import Message, InlineKeyboardMarkup
+from TelegramBotAPI.types.field import Field
+from TelegramBotAPI.types.methods import Method
+from TelegramBotAPI.types.primitive import Boolean, Integer, String, InputFile
+
+
+class editMessageText(Method):
+    _response = Message
+
+    chat_id = Field(Integer, String)
+    message_id = Field(Integer)
+    text = Field(String)
+    parse_mode = Field(String, optional=True)
+    reply_markup = Field(InlineKeyboardMarkup, optional=True)
+
+
+class editMessageMedia(Method):
+    _response = Message
+
+    chat_id = Field(Integer, String)
+    message_id = Field(Integer)
+    # JSON-serialized InputMedia, new file is referred as "attach://<field name>"
+    media = Field(String)
+    photo = Field(InputFile, optional=True)
+    reply_markup = Field(InlineKeyboardMarkup, optional=True)
+
+
+class setWebhook(Method):
+    _response = Boolean
+
+    url = Field(String)
+    certificate = Field(InputFile, optional=True)
+    max_connections = Field(Integer, optional=True)
+    # sent back in "X-Telegram-Bot-Api-Secret-Token" header of every webhook request
+    secret_token = Field(String, optional=True)
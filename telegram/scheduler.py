@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+
+import re
+import collections
+
+from twisted.application import service
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from twisted.logger import Logger
+
+log = Logger()
+
+# Telegram limits: about 30 messages per second overall, one message per second
+# in a chat (short bursts are allowed) and 20 messages per minute in a group
+DEFAULT_GLOBAL_RATE = 30.
+DEFAULT_CHAT_RATE = 1.
+DEFAULT_GROUP_RATE = 20 / 60.
+DEFAULT_CHAT_BURST = 3
+DEFAULT_QUEUE_SIZE = 1000
+DEFAULT_MAX_RETRIES = 3
+
+# Min delay of scheduled sending, in seconds
+MIN_DELAY = 0.001
+
+# Send priorities, the highest first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_BULK)
+
+# "Too Many Requests: retry after 5" description or "retry_after": 5 parameter
+RETRY_AFTER_RE = re.compile(r'retry[ _]after\D{0,3}(\d+)', re.IGNORECASE)
+
+# "Forbidden: bot was blocked by the user" description or 403 error code
+FORBIDDEN_RE = re.compile(r'Forbidden|\b403\b')
+
+# "Bad Request: message is not modified" description
+NOT_MODIFIED_RE = re.compile(r'message is not modified', re.IGNORECASE)
+
+
+class SendError(Exception):
+    pass
+
+
+class SendQueueFull(SendError):
+    pass
+
+
+def retry_after(failure):
+    '''
+    Get number of seconds to wait before retry from Telegram "Too Many Requests"
+    error, or C{None} if it's another error.
+    '''
+    e = failure.value
+    for obj in (e, getattr(e, 'parameters', None)):
+        value = getattr(obj, 'retry_after', None)
+        if value is not None:
+            return int(value)
+    m = RETRY_AFTER_RE.search(str(e))
+    return int(m.group(1)) if m is not None else None
+
+
+def forbidden(failure):
+    '''
+    Check if method failed with Telegram "Forbidden" error, e.g. bot was blocked
+    by user or removed from group.
+    '''
+    return FORBIDDEN_RE.search(str(failure.value)) is not None
+
+
+def not_modified(failure):
+    '''
+    Check if message edit failed since new message content is the same as old one.
+    '''
+    return NOT_MODIFIED_RE.search(str(failure.value)) is not None
+
+
+def method_chat_id(method):
+    '''
+    Get chat_id of method, or C{None} if method isn't sent to a chat.
+    '''
+    try:
+        return method.chat_id
+    except (AttributeError, KeyError):
+        return None
+
+
+class TokenBucket(object):
+    '''
+    Token bucket: holds up to C{burst} tokens, refilled at C{rate} tokens per second.
+    '''
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        # time of the last refill, in the future while bucket is blocked
+        self.updated = now
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now-self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now):
+        '''
+        Get number of seconds until a token is available.
+        '''
+        self._refill(now)
+        return max(0., self.updated-now) + max(0., 1-self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, now, seconds):
+        '''
+        Make the next token available no earlier than in given number of seconds.
+        '''
+        self._refill(now)
+        self.tokens = min(self.tokens, 1.)
+        self.updated = max(self.updated, now+seconds)
+
+    def full(self, now):
+        self._refill(now)
+        return now >= self.updated and self.tokens >= self.burst
+
+
+class _Send(object):
+    __slots__ = ('method', 'chat_id', 'priority', 'merge_key', 'waiters', 'retries')
+
+    def __init__(self, method, chat_id, priority, merge_key, d):
+        self.method = method
+        self.chat_id = chat_id
+        self.priority = priority
+        self.merge_key = merge_key
+        self.waiters = [d]
+        self.retries = 0
+
+
+class _Chat(object):
+    __slots__ = ('bucket', 'queues', 'sending')
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.queues = [collections.deque() for _ in PRIORITIES]
+        self.sending = 0
+
+    def idle(self):
+        return not self.sending and not any(self.queues)
+
+
+class SendScheduler(service.Service):
+    '''
+    Outbound Telegram methods scheduler.
+
+    Methods are sent by C{sender} function (returning a L{Deferred}) within global
+    and per-chat rate limits, enforced by token buckets. Methods to a chat are sent
+    one at a time, in order of priority and then of arrival; chats are served round
+    robin. Method failed with "Too Many Requests" error is put back to its queue and
+    chat (or all chats, for methods not sent to a chat) is paused for the requested
+    time, up to C{max_retries} times.
+
+    Queued method with the same chat, priority and merge key as a new one is
+    superseded by it: the new method takes its place in queue, and the superseded
+    send fires C{None}.
+
+    '''
+    name = 'send_scheduler'
+
+    def __init__(self, sender=None, global_rate=DEFAULT_GLOBAL_RATE,
+                 chat_rate=DEFAULT_CHAT_RATE, group_rate=DEFAULT_GROUP_RATE,
+                 chat_burst=DEFAULT_CHAT_BURST, queue_size=DEFAULT_QUEUE_SIZE,
+                 max_retries=DEFAULT_MAX_RETRIES, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.sender = sender
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.queue_size = queue_size
+        self.max_retries = max_retries
+        self.clock = clock
+        self._global = TokenBucket(global_rate, global_rate, clock.seconds())
+        # chat_id -> chat queues and rate limit, while chat is throttled or has sends
+        self._chats = {}
+        # per priority, ids of chats with queued sends, in order of service
+        self._pending = [collections.OrderedDict() for _ in PRIORITIES]
+        # (chat_id, priority, merge_key) -> queued send
+        self._merging = {}
+        self._queued = 0
+        self._wakeup = None
+        self._swept = clock.seconds()
+        self.sent = 0
+        self.merged = 0
+        self.throttled = 0
+
+    @property
+    def queued(self):
+        return self._queued
+
+    @property
+    def stats(self):
+        return {'sent': self.sent, 'merged': self.merged, 'throttled': self.throttled,
+                'queued': self._queued}
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._wakeup is not None and self._wakeup.active():
+            self._wakeup.cancel()
+        self._wakeup = None
+        for chat in self._chats.values():
+            for queue in chat.queues:
+                while queue:
+                    for d in queue.popleft().waiters:
+                        d.errback(SendError('Send scheduler stopped'))
+        self._chats.clear()
+        for pending in self._pending:
+            pending.clear()
+        self._merging.clear()
+        self._queued = 0
+
+    def send(self, method, priority=PRIORITY_INTERACTIVE, merge_key=None):
+        '''
+        Schedule method sending.
+
+        @param merge_key: if not C{None}, method supersedes queued method to the same
+            chat with the same priority and merge key.
+        @return: a L{Deferred} which will fire with method response, or C{None} if
+            method was superseded.
+        '''
+        if not self.running:
+            return defer.fail(SendError('Send scheduler is not running'))
+        chat_id = method_chat_id(method)
+        d = defer.Deferred()
+        if merge_key is not None:
+            queued = self._merging.get((chat_id, priority, merge_key))
+            if queued is not None:
+                superseded, queued.waiters = queued.waiters, [d]
+                queued.method = method
+                self.merged += 1
+                for waiter in superseded:
+                    waiter.callback(None)
+                return d
+        if self._queued >= self.queue_size:
+            return defer.fail(SendQueueFull('Too many methods queued for sending'))
+        entry = _Send(method, chat_id, priority, merge_key, d)
+        self._enqueue(entry)
+        self._pump()
+        return d
+
+    def _chat(self, chat_id):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            if chat_id is None:
+                bucket = None
+            else:
+                # groups and channels have negative ids
+                rate = self.group_rate if int(chat_id) < 0 else self.chat_rate
+                bucket = TokenBucket(rate, self.chat_burst, self.clock.seconds())
+            chat = self._chats[chat_id] = _Chat(bucket)
+        return chat
+
+    def _enqueue(self, entry, first=False):
+        queue = self._chat(entry.chat_id).queues[entry.priority]
+        if first:
+            queue.appendleft(entry)
+        else:
+            queue.append(entry)
+        self._pending[entry.priority][entry.chat_id] = None
+        if entry.merge_key is not None:
+            self._merging.setdefault((entry.chat_id, entry.priority, entry.merge_key), entry)
+        self._queued += 1
+
+    def _dequeue(self, chat_id, chat, priority):
+        pending = self._pending[priority]
+        queue = chat.queues[priority]
+        entry = queue.popleft()
+        if queue:
+            pending.move_to_end(chat_id)
+        else:
+            del pending[chat_id]
+        key = (chat_id, priority, entry.merge_key)
+        if self._merging.get(key) is entry:
+            del self._merging[key]
+        self._queued -= 1
+        return entry
+
+    def _pump(self):
+        '''
+        Send queued methods allowed by rate limits, and schedule the next pump
+        when the next method will be allowed.
+        '''
+        if not self.running:
+            return
+        now = self.clock.seconds()
+        wait = None
+        for priority, pending in enumerate(self._pending):
+            for chat_id in list(pending):
+                global_wait = self._global.delay(now)
+                if global_wait > 0:
+                    self._schedule(global_wait)
+                    return
+                chat = self._chats[chat_id]
+                if chat.bucket is not None:
+                    if chat.sending:
+                        continue
+                    chat_wait = chat.bucket.delay(now)
+                    if chat_wait > 0:
+                        wait = chat_wait if wait is None else min(wait, chat_wait)
+                        continue
+                    chat.bucket.take(now)
+                self._global.take(now)
+                self._dispatch(chat_id, chat, self._dequeue(chat_id, chat, priority))
+        if wait is not None:
+            self._schedule(wait)
+
+    def _schedule(self, delay):
+        # don't spin on rounding errors of token buckets
+        delay = max(delay, MIN_DELAY)
+        if self._wakeup is not None and self._wakeup.active():
+            if self._wakeup.getTime() <= self.clock.seconds()+delay:
+                return
+            self._wakeup.cancel()
+        self._wakeup = self.clock.callLater(delay, self._pump)
+
+    def _dispatch(self, chat_id, chat, entry):
+        chat.sending += 1
+        defer.maybeDeferred(self.sender, entry.method).addBoth(self._sent, chat_id, chat, entry)
+
+    def _sent(self, result, chat_id, chat, entry):
+        chat.sending -= 1
+        if isinstance(result, Failure):
+            delay = retry_after(result)
+            if delay is not None and entry.retries < self.max_retries and self.running:
+                entry.retries += 1
+                self.throttled += 1
+                log.warn("Sending to chat {chat_id} is throttled for {delay}s",
+                         chat_id=chat_id, delay=delay)
+                bucket = chat.bucket if chat.bucket is not None else self._global
+                bucket.block(self.clock.seconds(), delay)
+                self._enqueue(entry, first=True)
+                self._pump()
+                return None
+        else:
+            self.sent += 1
+        for d in entry.waiters:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        self._sweep()
+        self._pump()
+        return None
+
+    def _sweep(self):
+        '''
+        Forget idle chats with fully refilled rate limits, at most once per second.
+        '''
+        now = self.clock.seconds()
+        if now - self._swept < 1:
+            return
+        self._swept = now
+        for chat_id, chat in list(self._chats.items()):
+            if chat.idle() and (chat.bucket is None or chat.bucket.full(now)):
+                del self._chats[chat_id]
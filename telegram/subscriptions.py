@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+
+from twisted.application import service
+from twisted.internet import defer
+from twisted.logger import Logger
+
+from db.migrations import Migrator
+
+log = Logger()
+
+DEFAULT_THRESHOLD = 100
+DEFAULT_HYSTERESIS = 10
+MIN_THRESHOLD = 1
+MAX_THRESHOLD = 500
+
+
+class ThresholdIndex(object):
+    '''
+    Subscribed chats indexed by AQI threshold.
+    '''
+    def __init__(self):
+        # sorted list of distinct thresholds
+        self._thresholds = []
+        # threshold -> set of chat ids
+        self._chats = {}
+        # chat id -> threshold
+        self._subscriptions = {}
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def get(self, chat_id):
+        return self._subscriptions.get(chat_id)
+
+    def add(self, chat_id, threshold):
+        self.remove(chat_id)
+        chats = self._chats.get(threshold)
+        if chats is None:
+            chats = self._chats[threshold] = set()
+            bisect.insort(self._thresholds, threshold)
+        chats.add(chat_id)
+        self._subscriptions[chat_id] = threshold
+
+    def remove(self, chat_id):
+        threshold = self._subscriptions.pop(chat_id, None)
+        if threshold is None:
+            return False
+        chats = self._chats[threshold]
+        chats.discard(chat_id)
+        if not chats:
+            del self._chats[threshold]
+            del self._thresholds[bisect.bisect_left(self._thresholds, threshold)]
+        return True
+
+    def range(self, low, high):
+        '''
+        Get thresholds in [low, high) with lists of their subscribed chats.
+        '''
+        first = bisect.bisect_left(self._thresholds, low)
+        last = bisect.bisect_left(self._thresholds, high)
+        return [(t, list(self._chats[t])) for t in self._thresholds[first:last]]
+
+
+class Subscriptions(service.Service):
+    '''
+    Chat subscriptions to AQI threshold alerts, stored in the database.
+
+    Chat is alerted when AQI rises above its threshold, and when AQI drops back to
+    C{hysteresis} below the threshold. Since all chats follow the same AQI values,
+    alert state of every threshold is defined by a single boundary: thresholds below
+    it are alerted. So every AQI update looks up only thresholds between the old
+    and the new boundary, and chats of these thresholds.
+
+    '''
+    name = 'subscriptions'
+
+    def __init__(self, db_session, hysteresis=DEFAULT_HYSTERESIS):
+        self.db_session = db_session
+        self.hysteresis = hysteresis
+        self.index = ThresholdIndex()
+        # thresholds below boundary are alerted, unknown until the first AQI update
+        self.boundary = None
+        self._ready = False
+        self._ready_waiters = []
+
+    def startService(self):
+        service.Service.startService(self)
+        self.migrate().addCallback(lambda _: self.load()) \
+            .addCallbacks(self._loaded, self._load_failed)
+
+    def migrate(self):
+        '''
+        Bring database schema to the latest version.
+
+        @return: a L{Deferred} which will fire with resulting schema version.
+        '''
+        return Migrator(self.db_session, self.name, [self._migrate_initial]).migrate()
+
+    @staticmethod
+    def _migrate_initial(db_session):
+        return db_session.runInteraction(Subscriptions._create_table)
+
+    @staticmethod
+    def _create_table(txn):
+        txn.execute(
+            'CREATE TABLE IF NOT EXISTS subscription ' +
+            '(chat_id INTEGER PRIMARY KEY, threshold INTEGER)')
+        txn.execute(
+            'CREATE INDEX IF NOT EXISTS subscription_threshold_idx ' +
+            'ON subscription (threshold)')
+
+    @defer.inlineCallbacks
+    def load(self):
+        '''
+        Load subscriptions from the database.
+        '''
+        rows = yield self.db_session.runQuery('SELECT chat_id, threshold FROM subscription')
+        for chat_id, threshold in rows:
+            self.index.add(chat_id, threshold)
+        defer.returnValue(len(rows))
+
+    def _loaded(self, n):
+        log.info("Loaded {n} alert subscription(s)", n=n)
+        self._ready = True
+        waiters, self._ready_waiters = self._ready_waiters, []
+        for d in waiters:
+            d.callback(None)
+
+    def _load_failed(self, f):
+        log.failure("Can't load alert subscriptions", f)
+        waiters, self._ready_waiters = self._ready_waiters, []
+        for d in waiters:
+            d.errback(f)
+
+    def when_ready(self):
+        '''
+        Wait for subscriptions to be loaded.
+
+        @return: a L{Deferred} which will fire when subscriptions are ready to use.
+        '''
+        if self._ready:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._ready_waiters.append(d)
+        return d
+
+    def threshold(self, chat_id):
+        '''
+        Get AQI threshold of chat subscription, or C{None} if chat isn't subscribed.
+        '''
+        return self.index.get(chat_id)
+
+    @defer.inlineCallbacks
+    def subscribe(self, chat_id, threshold):
+        '''
+        Subscribe chat to alerts of AQI crossing given threshold, replacing its
+        previous subscription, if any.
+        '''
+        if not MIN_THRESHOLD <= threshold <= MAX_THRESHOLD:
+            raise ValueError('AQI threshold must be from %d to %d' %
+                             (MIN_THRESHOLD, MAX_THRESHOLD))
+        yield self.when_ready()
+        self.index.add(chat_id, threshold)
+        yield self.db_session.runOperation(
+            'INSERT OR REPLACE INTO subscription (chat_id, threshold) VALUES (?, ?)',
+            (chat_id, threshold))
+
+    @defer.inlineCallbacks
+    def unsubscribe(self, chat_id):
+        '''
+        Unsubscribe chat from alerts.
+
+        @return: a L{Deferred} which will fire C{True} if chat was subscribed.
+        '''
+        yield self.when_ready()
+        subscribed = self.index.remove(chat_id)
+        if subscribed:
+            yield self.db_session.runOperation(
+                'DELETE FROM subscription WHERE chat_id = ?', (chat_id,))
+        defer.returnValue(subscribed)
+
+    def update(self, aqi):
+        '''
+        Update alert state by new AQI value.
+
+        @return: tuple of lists of (threshold, chat ids) pairs, for thresholds AQI
+            just rose above, and for thresholds AQI just dropped back below.
+        '''
+        boundary = self.boundary
+        if boundary is None:
+            # don't alert of values observed before start
+            self.boundary = aqi
+            return [], []
+        if aqi > boundary:
+            self.boundary = aqi
+            return self.index.range(boundary, aqi), []
+        if aqi + self.hysteresis < boundary:
+            self.boundary = aqi + self.hysteresis
+            return [], self.index.range(self.boundary, boundary)
+        return [], []
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+import hmac
+import json
+import secrets
+import collections
+
+from urllib.parse import urlparse
+
+from twisted.application import service, strports
+from twisted.internet import defer
+from twisted.logger import Logger
+from twisted.python.failure import Failure
+from twisted.web import resource, server
+
+from TelegramBot.client.twistedclient import TwistedClient
+from TelegramBotAPI.types import Update
+
+from telegram.methods import setWebhook
+
+log = Logger()
+
+DEFAULT_PORT = 8080
+# Webhook is expected to be behind TLS-terminating reverse proxy
+DEFAULT_INTERFACE = '127.0.0.1'
+DEFAULT_CONCURRENCY = 8
+DEFAULT_QUEUE_SIZE = 100
+# Max number of concurrent Telegram requests to webhook, Telegram default
+DEFAULT_MAX_CONNECTIONS = 40
+
+SECRET_TOKEN_HEADER = b'X-Telegram-Bot-Api-Secret-Token'
+
+# Update fields with message (or callback query with message) in a chat
+CHAT_UPDATES = ('message', 'edited_message', 'channel_post', 'edited_channel_post',
+                'callback_query')
+
+
+def update_chat_id(raw):
+    '''
+    Get id of chat (or user, for inline callback queries) of raw update,
+    or C{None} if update isn't related to a chat.
+    '''
+    for key in CHAT_UPDATES:
+        obj = raw.get(key)
+        if not isinstance(obj, dict):
+            continue
+        if key == 'callback_query' and 'message' not in obj:
+            return obj.get('from', {}).get('id')
+        msg = obj.get('message', obj) if key == 'callback_query' else obj
+        return msg.get('chat', {}).get('id')
+    return None
+
+
+class UpdateDispatcher(object):
+    '''
+    Dispatch updates to C{on_update} handler, up to C{concurrency} updates at once.
+
+    Updates of the same chat are handled one at a time, in order of arrival. Up to
+    C{queue_size} updates wait for handling, newer updates are rejected.
+
+    '''
+    def __init__(self, on_update, concurrency=DEFAULT_CONCURRENCY,
+                 queue_size=DEFAULT_QUEUE_SIZE):
+        self.on_update = on_update
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        # (chat_id, update) pairs
+        self._queue = collections.deque()
+        # ids of chats with updates being handled
+        self._busy = set()
+        self._handling = 0
+        self.dispatched = 0
+        self.rejected = 0
+        self.failed = 0
+
+    @property
+    def queued(self):
+        return len(self._queue)
+
+    @property
+    def stats(self):
+        return {'dispatched': self.dispatched, 'rejected': self.rejected,
+                'failed': self.failed, 'handling': self._handling,
+                'queued': len(self._queue)}
+
+    def dispatch(self, update, chat_id=None):
+        '''
+        Queue update for handling.
+
+        @return: C{True} if update is queued, or C{False} if queue is full.
+        '''
+        if len(self._queue) >= self.queue_size:
+            self.rejected += 1
+            return False
+        self._queue.append((chat_id, update))
+        self._pump()
+        return True
+
+    def _pump(self):
+        # updates of busy chats keep their places in queue
+        skipped = []
+        while self._queue and self._handling < self.concurrency:
+            chat_id, update = self._queue.popleft()
+            if chat_id is not None and chat_id in self._busy:
+                skipped.append((chat_id, update))
+                continue
+            self._handle(chat_id, update)
+        self._queue.extendleft(reversed(skipped))
+
+    def _handle(self, chat_id, update):
+        self._handling += 1
+        if chat_id is not None:
+            self._busy.add(chat_id)
+        self.dispatched += 1
+        defer.maybeDeferred(self.on_update, update).addBoth(self._handled, chat_id)
+
+    def _handled(self, result, chat_id):
+        self._handling -= 1
+        self._busy.discard(chat_id)
+        if isinstance(result, Failure):
+            self.failed += 1
+            log.failure("Can't handle update", result)
+        self._pump()
+
+
+class WebhookResource(resource.Resource):
+    '''
+    Telegram webhook: updates POSTed to C{path} with valid secret token are queued
+    for dispatching and acknowledged right away. When dispatch queue is full, request
+    fails with 503 status, so Telegram delivers update again later.
+
+    '''
+    isLeaf = True
+
+    def __init__(self, dispatcher, secret_token, path=b'/'):
+        resource.Resource.__init__(self)
+        self.dispatcher = dispatcher
+        self.secret_token = secret_token.encode('ascii')
+        self.path = path
+
+    def render_POST(self, request):
+        if request.path != self.path:
+            request.setResponseCode(404)
+            return b''
+        token = request.getHeader(SECRET_TOKEN_HEADER)
+        if token is None or not hmac.compare_digest(token, self.secret_token):
+            log.warn("Rejected webhook request from {host}: invalid secret token",
+                     host=request.getClientAddress())
+            request.setResponseCode(403)
+            return b''
+        try:
+            raw = json.loads(request.content.read())
+            chat_id = update_chat_id(raw)
+            update = Update()
+            update._from_raw(raw)
+        except Exception as e:
+            log.warn("Can't parse webhook update: {error}", error=e)
+            request.setResponseCode(400)
+            return b''
+        if not self.dispatcher.dispatch(update, chat_id):
+            log.warn("Update {update_id} is rejected: dispatch queue is full",
+                     update_id=raw.get('update_id'))
+            request.setResponseCode(503)
+            request.setHeader(b'Retry-After', b'1')
+        return b''
+
+
+class SendingClient(TwistedClient):
+    '''
+    Telegram client only sending methods: Telegram doesn't allow to poll updates
+    while webhook is set.
+    '''
+    def startService(self):
+        service.Service.startService(self)
+
+    def stopService(self):
+        service.Service.stopService(self)
+
+
+class Webhook(service.MultiService):
+    '''
+    Receive Telegram updates by webhook instead of long polling.
+
+    Webhook listens on C{interface} and C{port} for requests to path of its public
+    C{url}, which is registered by C{setWebhook} method on start. Random secret
+    token is used if C{secret_token} isn't specified. Since updates are acknowledged
+    before handling, Telegram may send up to C{max_connections} requests at once
+    regardless of C{concurrency}.
+
+    '''
+    name = 'telegram_webhook'
+
+    def __init__(self, on_update, send_method, url, port=DEFAULT_PORT,
+                 interface=DEFAULT_INTERFACE, secret_token=None,
+                 concurrency=DEFAULT_CONCURRENCY, queue_size=DEFAULT_QUEUE_SIZE,
+                 max_connections=DEFAULT_MAX_CONNECTIONS):
+        service.MultiService.__init__(self)
+        self.send_method = send_method
+        self.url = url
+        self.max_connections = max_connections
+        self.secret_token = secret_token or secrets.token_urlsafe(32)
+        self.dispatcher = UpdateDispatcher(on_update, concurrency, queue_size)
+        path = urlparse(url).path or '/'
+        site = server.Site(WebhookResource(self.dispatcher, self.secret_token,
+                                           path.encode('utf-8')))
+        site.noisy = False
+        strports.service('tcp:%d:interface=%s' % (port, interface.replace(':', r'\:')),
+                         site).setServiceParent(self)
+
+    def startService(self):
+        service.MultiService.startService(self)
+        self.set_webhook().addCallbacks(
+            lambda _: log.info("Webhook is set to {url}", url=self.url),
+            lambda f: log.failure("Can't set webhook to {url}", f, url=self.url))
+
+    def set_webhook(self):
+        m = setWebhook()
+        m.url = self.url
+        m.secret_token = self.secret_token
+        m.max_connections = self.max_connections
+        return defer.maybeDeferred(self.send_method, m)
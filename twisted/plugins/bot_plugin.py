@@ -9,15 +9,6 @@ from twisted.plugin import IPlugin
 from twisted.application.service import IServiceMaker
 from twisted.application import service
 
-from TelegramBot.service.bot import BotService
-from TelegramBot.client.twistedclient import TwistedClient as TelegramClient
-
-from l10n import L10nSupport
-from aqimon import AqiMonitor, AqiStorage, AqiPlot
-from aqimon.plugins import mqtt
-from telegram.bot import Bot
-from db import DbSession
-
 from configparser import ConfigParser
 
 import codecs
@@ -26,11 +17,42 @@ TAP_NAME = "aqi-telegram-bot"
 
 DEFAULT_NICKNAME = TAP_NAME
 
+DEFAULT_DB_BACKEND = 'sqlite'
 DEFAULT_DB_FILENAME = 'db.sqlite'
+DEFAULT_DB_LOG_DIR = 'tslog'
+DEFAULT_DB_READ_POOL_SIZE = 3
+DEFAULT_DB_FLUSH_SIZE = 50
+DEFAULT_DB_FLUSH_INTERVAL = 300  # 5 min
+DEFAULT_DB_RETENTION_DAYS = 0  # keep all raw data in database
+DEFAULT_DB_ARCHIVE_DIR = 'archive'
+
+# Database connection PRAGMAs configurable in [db] section
+DB_PRAGMAS = ('synchronous', 'cache_size', 'mmap_size', 'temp_store')
 
 DEFAULT_SENSOR_DEVICE = '/dev/ttyUSB0'
 DEFAULT_SENSOR_BAUDRATE = 9600
 DEFAULT_SENSOR_POLL_PERIOD = 3  # 3 min
+DEFAULT_SENSOR_HISTORY_HOURS = 24
+
+DEFAULT_PLOT_CACHE_KB = 4096
+DEFAULT_PLOT_RENDERER = 'matplotlib'
+DEFAULT_PLOT_RENDER_PROCESSES = 2
+DEFAULT_PLOT_RENDER_QUEUE = 16
+DEFAULT_PLOT_RENDER_TIMEOUT = 30
+DEFAULT_PLOT_RENDER_MAX_TASKS = 100
+
+DEFAULT_TELEGRAM_SEND_RATE = 30  # messages per second, 0 to send without rate limits
+DEFAULT_TELEGRAM_CHAT_SEND_RATE = 1  # messages per second
+DEFAULT_TELEGRAM_GROUP_SEND_RATE = 20  # messages per minute
+DEFAULT_TELEGRAM_SEND_BURST = 3
+DEFAULT_TELEGRAM_SEND_QUEUE = 1000
+DEFAULT_TELEGRAM_SEND_RETRIES = 3
+DEFAULT_TELEGRAM_ALERT_HYSTERESIS = 10
+DEFAULT_TELEGRAM_WEBHOOK_PORT = 8080
+DEFAULT_TELEGRAM_WEBHOOK_INTERFACE = '127.0.0.1'
+DEFAULT_TELEGRAM_WEBHOOK_CONCURRENCY = 8
+DEFAULT_TELEGRAM_WEBHOOK_QUEUE = 100
+DEFAULT_TELEGRAM_WEBHOOK_CONNECTIONS = 40
 
 DEFAULT_LANG = 'en'
 
@@ -56,6 +78,27 @@ class ServiceManager(object):
     apps = []
 
     def makeService(self, options):
+        # application modules are imported here, so plugin discovery (e.g. by
+        # "twistd --help") doesn't load the whole application with its dependencies
+        from twisted.internet import reactor
+
+        from TelegramBot.service.bot import BotService
+        from TelegramBot.client.twistedclient import TwistedClient as TelegramClient
+
+        from l10n import L10nSupport
+        from aqimon import AqiMonitor, AqiStorage, AqiPlot
+        from aqimon.archive import PmArchive
+        from aqimon.tslog import PmLogStorage
+        from aqimon.plotcache import PlotCache
+        from aqimon.render import RenderPool, warm_up as render_warm_up, \
+            BACKENDS as RENDER_BACKENDS
+        from aqimon.plugins import mqtt
+        from telegram.bot import Bot
+        from telegram.scheduler import SendScheduler
+        from telegram.subscriptions import Subscriptions
+        from telegram.webhook import Webhook, SendingClient
+        from db import DbSession
+
         # create Twisted application
         application = service.Application(TAP_NAME)
         serviceCollection = service.IServiceCollection(application)
@@ -88,13 +131,22 @@ class ServiceManager(object):
 
         # initialize database session
         db_filename = cfg.get('db', 'filename', fallback=DEFAULT_DB_FILENAME)
-        db_session = DbSession(db_filename)
+        db_read_pool_size = int(cfg.get('db', 'read_pool_size',
+                                        fallback=DEFAULT_DB_READ_POOL_SIZE))
+        db_pragmas = {}
+        for pragma in DB_PRAGMAS:
+            if cfg.has_option('db', pragma):
+                db_pragmas[pragma] = cfg.get('db', pragma)
+        db_session = DbSession(db_filename, read_pool_size=db_read_pool_size,
+                               pragmas=db_pragmas)
 
         # sensor parameters
         sensor_device = cfg.get('sensor', 'device', fallback=DEFAULT_SENSOR_DEVICE)
         sensor_baudrate = int(cfg.get('sensor', 'baudrate', fallback=DEFAULT_SENSOR_BAUDRATE))
         sensor_poll_period = int(cfg.get('sensor', 'poll_period',
                                          fallback=DEFAULT_SENSOR_POLL_PERIOD))
+        sensor_history_hours = int(cfg.get('sensor', 'history_hours',
+                                           fallback=DEFAULT_SENSOR_HISTORY_HOURS))
 
         if cfg.has_section('mqtt'):
             mqtt_section = cfg['mqtt']
@@ -107,21 +159,124 @@ class ServiceManager(object):
                                               mqtt_user, mqtt_password)
             plugin.setServiceParent(application)
 
-        aqi_storage = AqiStorage(db_session)
+        # storage write buffer parameters
+        db_flush_size = int(cfg.get('db', 'flush_size', fallback=DEFAULT_DB_FLUSH_SIZE))
+        db_flush_interval = int(cfg.get('db', 'flush_interval',
+                                        fallback=DEFAULT_DB_FLUSH_INTERVAL))
+
+        # raw data retention parameters
+        db_retention_days = int(cfg.get('db', 'retention_days',
+                                        fallback=DEFAULT_DB_RETENTION_DAYS))
+        db_archive_dir = cfg.get('db', 'archive_dir',
+                                 fallback=os.path.join(os.path.dirname(db_filename),
+                                                       DEFAULT_DB_ARCHIVE_DIR))
+
+        db_backend = cfg.get('db', 'backend', fallback=DEFAULT_DB_BACKEND)
+        if db_backend == 'sqlite':
+            aqi_storage = AqiStorage(db_session, flush_size=db_flush_size,
+                                     flush_interval=db_flush_interval,
+                                     retention=db_retention_days*86400,
+                                     archive=PmArchive(db_archive_dir))
+        elif db_backend == 'tslog':
+            db_log_dir = cfg.get('db', 'log_dir',
+                                 fallback=os.path.join(os.path.dirname(db_filename),
+                                                       DEFAULT_DB_LOG_DIR))
+            aqi_storage = PmLogStorage(db_log_dir, flush_interval=db_flush_interval,
+                                       retention=db_retention_days*86400)
+        else:
+            raise ConfigurationError('Unknown storage backend: %s' % db_backend)
+        aqi_storage.setServiceParent(application)
+
         aqi_monitor = AqiMonitor(aqi_storage, sensor_device, sensor_baudrate,
-                                 sensor_poll_period, debug=debug)
+                                 sensor_poll_period,
+                                 history_window=sensor_history_hours*3600, debug=debug)
         aqi_monitor.setServiceParent(application)
 
-        aqi_plot = AqiPlot(l10n_support, aqi_storage)
-
-        bot = Bot(l10n_support, aqi_plot)
+        # rendered plots cache
+        plot_cache_kb = int(cfg.get('plot', 'cache_kb', fallback=DEFAULT_PLOT_CACHE_KB))
+        plot_cache = PlotCache(plot_cache_kb*1024) if plot_cache_kb > 0 else None
+
+        # plot renderer backend
+        plot_renderer = cfg.get('plot', 'renderer', fallback=DEFAULT_PLOT_RENDERER)
+        if plot_renderer not in RENDER_BACKENDS:
+            raise ConfigurationError('Unknown plot renderer: %s' % plot_renderer)
+
+        # plot rendering worker processes
+        render_processes = int(cfg.get('plot', 'render_processes',
+                                       fallback=DEFAULT_PLOT_RENDER_PROCESSES))
+        if render_processes > 0:
+            render_pool = RenderPool(
+                render_processes,
+                queue_size=int(cfg.get('plot', 'render_queue',
+                                       fallback=DEFAULT_PLOT_RENDER_QUEUE)),
+                timeout=int(cfg.get('plot', 'render_timeout',
+                                    fallback=DEFAULT_PLOT_RENDER_TIMEOUT)),
+                max_tasks=int(cfg.get('plot', 'render_max_tasks',
+                                      fallback=DEFAULT_PLOT_RENDER_MAX_TASKS)),
+                backend=plot_renderer)
+            render_pool.setServiceParent(application)
+        else:
+            render_pool = None
+            # load plotting library in background once reactor is running
+            reactor.callWhenRunning(render_warm_up, plot_renderer)
+
+        aqi_plot = AqiPlot(l10n_support, aqi_storage, aqi_monitor.history, plot_cache,
+                           render_pool, plot_renderer)
+        aqi_monitor.add_listener(aqi_plot)
+
+        # outbound Telegram methods rate limits
+        send_rate = float(cfg.get('telegram', 'send_rate', fallback=DEFAULT_TELEGRAM_SEND_RATE))
+        if send_rate > 0:
+            send_scheduler = SendScheduler(
+                global_rate=send_rate,
+                chat_rate=float(cfg.get('telegram', 'chat_send_rate',
+                                        fallback=DEFAULT_TELEGRAM_CHAT_SEND_RATE)),
+                group_rate=float(cfg.get('telegram', 'group_send_rate',
+                                         fallback=DEFAULT_TELEGRAM_GROUP_SEND_RATE)) / 60,
+                chat_burst=int(cfg.get('telegram', 'send_burst',
+                                       fallback=DEFAULT_TELEGRAM_SEND_BURST)),
+                queue_size=int(cfg.get('telegram', 'send_queue',
+                                       fallback=DEFAULT_TELEGRAM_SEND_QUEUE)),
+                max_retries=int(cfg.get('telegram', 'send_retries',
+                                        fallback=DEFAULT_TELEGRAM_SEND_RETRIES)))
+            send_scheduler.setServiceParent(application)
+        else:
+            send_scheduler = None
+
+        # AQI alert subscriptions
+        subscriptions = Subscriptions(
+            db_session, hysteresis=int(cfg.get('telegram', 'alert_hysteresis',
+                                               fallback=DEFAULT_TELEGRAM_ALERT_HYSTERESIS)))
+        subscriptions.setServiceParent(application)
+
+        bot = Bot(l10n_support, aqi_plot, send_scheduler, subscriptions)
         bot.setServiceParent(application)
 
         telegramBot = BotService(plugins=[bot])
         telegramBot.setServiceParent(application)
 
-        client = TelegramClient(token, telegramBot.on_update, debug=debug)
-        client.setServiceParent(application)
+        # receive updates by webhook, if its public URL is configured, or by long polling
+        webhook_url = cfg.get('telegram', 'webhook_url', fallback=None)
+        if webhook_url:
+            client = SendingClient(token, telegramBot.on_update, debug=debug)
+            client.setServiceParent(application)
+            webhook = Webhook(
+                telegramBot.on_update, client.send_method, webhook_url,
+                port=int(cfg.get('telegram', 'webhook_port',
+                                 fallback=DEFAULT_TELEGRAM_WEBHOOK_PORT)),
+                interface=cfg.get('telegram', 'webhook_interface',
+                                  fallback=DEFAULT_TELEGRAM_WEBHOOK_INTERFACE),
+                secret_token=cfg.get('telegram', 'webhook_secret', fallback=None),
+                concurrency=int(cfg.get('telegram', 'webhook_concurrency',
+                                        fallback=DEFAULT_TELEGRAM_WEBHOOK_CONCURRENCY)),
+                queue_size=int(cfg.get('telegram', 'webhook_queue',
+                                       fallback=DEFAULT_TELEGRAM_WEBHOOK_QUEUE)),
+                max_connections=int(cfg.get('telegram', 'webhook_connections',
+                                            fallback=DEFAULT_TELEGRAM_WEBHOOK_CONNECTIONS)))
+            webhook.setServiceParent(application)
+        else:
+            client = TelegramClient(token, telegramBot.on_update, debug=debug)
+            client.setServiceParent(application)
 
         return serviceCollection
 